@@ -0,0 +1,252 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of fabric_navitia, the provisioning and deployment tool
+#     of Navitia, the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+"""
+Order of the upgrade binarizations (see tyr.launch_rebinarization_upgrade): longest first,
+from the durations recorded in the history (see fabfile.history) or the size of the last dataset,
+so that a big instance does not start last and stretch the upgrade.
+Their concurrency can follow the load of the tyr and db hosts (see AdaptiveConcurrency),
+or they can be spread on all the tyr hosts (see assign_slots).
+"""
+
+import multiprocessing
+import Queue
+from threading import Condition
+import time
+
+from fabric import state
+from fabric.api import env
+from fabric.colors import blue, yellow
+
+from fabfile import history
+from fabfile.utils import Parallel, run_command_on_host
+
+
+def predict_durations(instance_names, durations, sizes):
+    """ expected binarization time of instances
+        :param durations: {instance name: [seconds of its successful binarizations, oldest first]}
+        :param sizes: {instance name: size of its last dataset in bytes}
+        :return: {instance name: seconds}. An instance without history is estimated from its
+                 dataset size, at the median rate of the instances having both, or else at
+                 env.bina_input_rate; an instance with neither gets the median prediction.
+    """
+    predictions, rates = {}, []
+    for name in instance_names:
+        if durations.get(name):
+            predictions[name] = history.median(durations[name][-env.bina_history:])
+            if sizes.get(name) and predictions[name]:
+                rates.append(sizes[name] / predictions[name])
+    rate = history.median(rates) or env.bina_input_rate * 1024 * 1024
+    for name in instance_names:
+        if name not in predictions and sizes.get(name):
+            predictions[name] = float(sizes[name]) / rate
+    default = history.median(predictions.values()) or 0
+    for name in instance_names:
+        predictions.setdefault(name, default)
+    return predictions
+
+
+def longest_first(predictions):
+    """ instance names, longest expected binarization first """
+    return sorted(predictions, key=lambda name: (-predictions[name], name))
+
+
+def predict_makespan(predictions, order, slots):
+    """ duration of the binarization of all instances, started in the given order
+        as soon as one of the slots is free
+    """
+    workers = [0] * max(1, slots)
+    for name in order:
+        workers[workers.index(min(workers))] += predictions[name]
+    return max(workers)
+
+
+def assign_slots(predictions, order, slots):
+    """ spread the instances on the hosts, each one to the slot expected to be free first
+        :param slots: {host: number of parallel binarizations on this host}
+        :return: {host: [instance names, in the given order]}
+    """
+    workers = [[0, host] for host in sorted(slots) for _ in range(slots[host])]
+    assignment = {host: [] for host in slots}
+    for name in order:
+        worker = min(workers)
+        worker[0] += predictions[name]
+        assignment[worker[1]].append(name)
+    return assignment
+
+
+HOST_LOAD_SCRIPT = "nproc; cut -d' ' -f1 /proc/loadavg; grep MemAvailable /proc/meminfo | tr -s ' ' | cut -d' ' -f2"
+PG_BACKENDS_SCRIPT = ("su - postgres --command=\"psql --quiet --tuples-only --no-align "
+                      "--command=\\\"SELECT count(*) FROM pg_stat_activity WHERE state = 'active'\\\"\"")
+
+
+def parse_host_load(output):
+    """ :param output: output of HOST_LOAD_SCRIPT, optionally followed by the one of PG_BACKENDS_SCRIPT
+        :return: {'load': load average (1 min) per cpu, 'memory': available MB, 'backends': active
+                 postgres backends or None}
+    """
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    return {
+        'load': float(lines[1]) / max(1, int(lines[0])),
+        'memory': int(lines[2]) // 1024,
+        'backends': int(lines[3]) if len(lines) > 3 else None,
+    }
+
+
+def sample_load(hosts, db_hosts):
+    """ :return: {host: sample (see parse_host_load)}, the hosts which can not be sampled are missing
+        the postgres backends are only counted on db_hosts
+    """
+    samples = {}
+    for host in sorted(set(hosts) | set(db_hosts)):
+        script = HOST_LOAD_SCRIPT + ('; ' + PG_BACKENDS_SCRIPT if host in db_hosts else '')
+        try:
+            samples[host] = parse_host_load(run_command_on_host(host, script))
+        except Exception as e:
+            print(yellow("WARNING: could not sample the load of {}: {}".format(host, e)))
+    return samples
+
+
+def _sample_load_forever(hosts, db_hosts, interval, samples):
+    """ sampler process of AdaptiveConcurrency: its settings(host_string=...) only change its own env """
+    # the ssh connections of the main process are shared with it, it opens its own
+    state.connections.clear()
+    while True:
+        samples.put(sample_load(hosts, db_hosts))
+        time.sleep(interval)
+
+
+class AdaptiveConcurrency(object):
+    """ number of binarizations allowed to run at the same time, between minimum and maximum
+        it shrinks when one of the hosts is over env.bina_max_load, under env.bina_min_free_memory or
+        over env.bina_max_pg_backends, and grows when all the slots are used and all the hosts are
+        under env.bina_grow_ratio of these limits
+    """
+    def __init__(self, minimum, maximum, initial=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = min(max(initial or self.minimum, self.minimum), self.maximum)
+        self.running = 0
+        self.decisions = []
+        self.watching = False
+        self.condition = Condition()
+        self.samples = None
+        self.sampler = None
+
+    def acquire(self):
+        with self.condition:
+            while self.running >= self.limit:
+                self.condition.wait(1)
+            self.running += 1
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def decide(self, samples):
+        """ adjust the limit to the samples (see sample_load)
+            :return: the decision (date, old limit, new limit, reason), also logged and kept in self.decisions
+        """
+        if not samples:
+            return None
+        load = max(s['load'] for s in samples.values())
+        memory = min(s['memory'] for s in samples.values())
+        backends = max([s['backends'] for s in samples.values() if s['backends'] is not None] or [None])
+        overloaded = [reason for reason, over in (
+            ('load', load > env.bina_max_load),
+            ('memory', memory < env.bina_min_free_memory),
+            ('backends', backends is not None and backends > env.bina_max_pg_backends)) if over]
+        idle = (load < env.bina_grow_ratio * env.bina_max_load and
+                memory * env.bina_grow_ratio > env.bina_min_free_memory and
+                (backends is None or backends < env.bina_grow_ratio * env.bina_max_pg_backends))
+        with self.condition:
+            old = self.limit
+            if overloaded:
+                self.limit = max(self.minimum, self.limit - 1)
+                reason = 'overloaded ({})'.format(', '.join(overloaded))
+            elif idle and self.running >= self.limit:
+                self.limit = min(self.maximum, self.limit + 1)
+                reason = 'idle'
+            else:
+                reason = 'steady'
+            self.condition.notify_all()
+        decision = (time.strftime('%H:%M:%S'), old, self.limit, reason)
+        self.decisions.append(decision)
+        print((blue if old == self.limit else yellow)(
+            "bina concurrency {} -> {}: {}, max load/cpu {:.2f}, min free memory {}MB, pg backends {}, running {}"
+            .format(old, self.limit, reason, load, memory, backends, self.running)))
+        return decision
+
+    def start_sampler(self, hosts, db_hosts):
+        """ fork the process sampling the hosts every env.bina_sample_interval seconds (see sample_load):
+            sampling in a thread would change env.host_string under the binarizations.
+            Call it before starting threads (a forked thread lock may be held forever).
+        """
+        self.samples = multiprocessing.Queue()
+        self.sampler = multiprocessing.Process(target=_sample_load_forever,
+                                               args=(hosts, db_hosts, env.bina_sample_interval, self.samples))
+        self.sampler.daemon = True
+        self.sampler.start()
+
+    def watch(self):
+        """ adjust the limit to the samples of the sampler process (see start_sampler) until stop() """
+        self.watching = True
+        while self.watching:
+            try:
+                samples = self.samples.get(timeout=1)
+            except Queue.Empty:
+                continue
+            self.decide(samples)
+
+    def stop(self):
+        self.watching = False
+        if self.sampler:
+            self.sampler.terminate()
+            self.sampler.join()
+
+
+def run_adaptive(func, items, concurrency):
+    """ call func on the items in their order, at most concurrency.limit at the same time
+        :return: the results, like map
+    """
+    def job(item):
+        try:
+            return func(item)
+        finally:
+            concurrency.release()
+
+    results = []
+    with Parallel(concurrency.maximum) as pool:
+        for item in items:
+            concurrency.acquire()
+            results.append(pool.apply_async(job, (item,)))
+    return [r.get() for r in results]
@@ -0,0 +1,148 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of fabric_navitia, the provisioning and deployment tool
+#     of Navitia, the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+"""
+Synthetic journey requests sent to jormungandr to compare the latency of a coverage
+before and after the restart of its krakens (see kraken.restart_kraken).
+"""
+
+import time
+import urllib
+
+import requests
+from requests.auth import HTTPBasicAuth
+from fabric.api import env
+from fabric.colors import yellow
+
+# WARNING: the way fabric_navitia imports are done as a strong influence
+#          on the resulting naming of tasks, wich can break integration tests
+from fabfile.utils import Parallel
+
+
+def _coverage_url(instance_name, path):
+    return 'http://{}{}/v1/coverage/{}/{}'.format(env.jormungandr_url, env.jormungandr_url_prefix,
+                                                  instance_name, path)
+
+
+def _get(session, instance_name, path):
+    return session.get(_coverage_url(instance_name, path), headers={'Host': env.jormungandr_url},
+                       auth=HTTPBasicAuth(env.token, ''), timeout=env.kraken_canary_timeout)
+
+
+def canary_queries(instance, session=None):
+    """ the requests of the canary of an instance, relative to its coverage url:
+        instance.canary_queries if given, else places and journeys requests between
+        the first env.kraken_canary_size stop areas of the coverage
+    """
+    if instance.canary_queries:
+        return list(instance.canary_queries)
+    try:
+        response = _get(session or requests, instance.name, 'stop_areas?count={}'.format(env.kraken_canary_size))
+        stop_areas = response.json().get('stop_areas', [])
+    except Exception as e:
+        print(yellow("WARNING: cannot get the stop areas of {}: {}".format(instance.name, e)))
+        return []
+    queries = ['places?q={}'.format(urllib.quote(sa['name'].encode('utf-8'))) for sa in stop_areas]
+    queries.extend('journeys?from={}&to={}'.format(origin['id'], destination['id'])
+                   for origin, destination in zip(stop_areas, stop_areas[1:] + stop_areas[:1])
+                   if origin['id'] != destination['id'])
+    return queries
+
+
+def percentile(values, p):
+    """ nearest-rank percentile of values, None if empty """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+def measure(instance_name, queries, repeat=None):
+    """ send the queries repeat times (env.kraken_canary_repeat), one after the other
+        :return: {'p50': s, 'p95': s, 'errors': number of failed requests}
+    """
+    session = requests.Session()
+    latencies, errors = [], 0
+    for _ in range(repeat or env.kraken_canary_repeat):
+        for query in queries:
+            start = time.time()
+            try:
+                ok = _get(session, instance_name, query).status_code == 200
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.time() - start)
+            else:
+                errors += 1
+    return {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95), 'errors': errors}
+
+
+def is_degraded(baseline, current, ratio=None):
+    """ a coverage is degraded if its failed requests, or its p50 or p95 latency, are more than
+        ratio (env.kraken_canary_ratio) times over the baseline, and at least env.kraken_canary_min_errors
+        more requests fail or the latency is env.kraken_canary_min_increase seconds over the baseline
+    """
+    ratio = ratio or env.kraken_canary_ratio
+    errors = current['errors'] - baseline['errors']
+    if errors >= env.kraken_canary_min_errors and current['errors'] > baseline['errors'] * ratio:
+        return True
+    return any(baseline[p] is not None and current[p] is not None and
+               current[p] > baseline[p] * ratio and current[p] - baseline[p] > env.kraken_canary_min_increase
+               for p in ('p50', 'p95'))
+
+
+class KrakenCanary(object):
+    """
+    Latency baseline of coverages, measured before their krakens restart, all coverages at the same time
+    """
+    def __init__(self, instances):
+        instances = list(instances)
+        self.queries, self.baseline = {}, {}
+        if not instances:
+            return
+        with Parallel(min(len(instances), env.kraken_monitor_pool_size)) as pool:
+            queries = pool.map(canary_queries, instances)
+            self.queries = dict((i.name, q) for i, q in zip(instances, queries) if q)
+            names = sorted(self.queries)
+            baselines = pool.map(lambda name: measure(name, self.queries[name]), names)
+        self.baseline = dict(zip(names, baselines))
+        for instance in instances:
+            if instance.name not in self.queries:
+                print(yellow("WARNING: no canary requests for {}".format(instance.name)))
+
+    def check(self, instance_name):
+        """ :return: (degraded, baseline, current), degraded is False for a coverage without requests
+        """
+        if instance_name not in self.queries:
+            return False, None, None
+        current = measure(instance_name, self.queries[instance_name])
+        baseline = self.baseline[instance_name]
+        return is_degraded(baseline, current), baseline, current
@@ -66,12 +66,13 @@ def update_jormungandr_conf():
     require.files.directories([env.jormungandr_base_dir, env.jormungandr_instances_dir, env.jormungandr_log_dir],
                               owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
 
-    _upload_template('jormungandr/jormungandr.wsgi.jinja', env.jormungandr_wsgi_file,
+    changed = _upload_template('jormungandr/jormungandr.wsgi.jinja', env.jormungandr_wsgi_file,
                      context={
                          'env': env
                      })
-    _upload_template('jormungandr/settings.py.jinja', env.jormungandr_settings_file,
+    changed |= _upload_template('jormungandr/settings.py.jinja', env.jormungandr_settings_file,
                      context={'env': env})
+    return changed
 
 
 @task
@@ -304,7 +305,7 @@ def deploy_jormungandr_instance_conf(instance):
               'realtime_proxies': instance.realtime_proxies}
     if instance.street_network:
         config["street_network"] = instance.street_network
-    _upload_template("jormungandr/instance.json.jinja",
+    return _upload_template("jormungandr/instance.json.jinja",
                      instance.jormungandr_config_file,
                      context={
                          'json': json.dumps(config, indent=4)
@@ -30,9 +30,13 @@
 # www.navitia.io
 
 import os.path
+from pipes import quote
+import re
 from retrying import Retrying
 import simplejson as json
 import requests
+from requests.adapters import HTTPAdapter
+import time
 
 from fabric.api import task, env, sudo, execute
 from fabric.colors import blue, red, green, yellow
@@ -46,8 +50,12 @@ from fabtools import require, service, files, python
 # WARNING: the way fabric_navitia imports are done as a strong influence
 #          on the resulting naming of tasks, wich can break integration tests
 from fabfile.utils import (get_bool_from_cli, _install_packages, get_real_instance,
-                           show_version, update_init, get_host_addr,
-                           _upload_template, start_or_stop_with_delay, idempotent_symlink)
+                           show_version, update_init, get_host_addr, Parallel, time_that,
+                           _upload_template, start_or_stop_with_delay, idempotent_symlink,
+                           execute_parallel, run_command_on_host, control_services)
+from fabfile import history
+from fabfile.canary import KrakenCanary
+from fabfile.component import rabbitmq
 
 
 @task
@@ -72,6 +80,8 @@ def setup_kraken():
 @roles('eng')
 def upgrade_engine_packages():
     packages = ['logrotate', 'python2.7', 'gcc', 'python-dev', 'apache2', 'libapache2-mod-wsgi']
+    if env.kraken_local_staging:
+        packages.append('rsync')
     if env.distrib in ('ubuntu14.04', 'debian8'):
         packages.append('libzmq3-dev')
     elif env.distrib == 'debian7':
@@ -86,14 +96,16 @@ def upgrade_engine_packages():
 
 
 @task
-def rollback_instance(instance, test=True):
+def rollback_instance(instance, test=True, canary=None, blue_green=None):
     """ Use this only if something goes wrong during deployment of an instance
+        canary and blue_green are given to restart_kraken
     """
     test = get_bool_from_cli(test)
     instance = get_real_instance(instance)
     execute(swap_data_nav, instance, force=True)
     execute(set_kraken_binary, instance, old=True)
-    execute(restart_kraken, instance, wait=env.KRAKEN_RESTART_SCHEME if test else 'no_test')
+    execute(restart_kraken, instance, wait=env.KRAKEN_RESTART_SCHEME if test else 'no_test',
+            canary=canary, blue_green=blue_green)
 
 
 @task
@@ -120,21 +132,22 @@ def upgrade_monitor_kraken_packages():
 @task
 def get_no_data_instances():
     """ Get instances that have no data loaded ("status": null)"""
+    results = probe_krakens(kraken_pairs())
     for instance in env.instances.values():
         for host in instance.kraken_engines:
-            instance_has_data = test_kraken(instance, fail_if_error=False, hosts=[host])
-            if not instance_has_data:
-                target_file = instance.kraken_database
-                with settings(host_string=host):
-                    target_file_exists = exists(target_file)
-                if not target_file_exists:
-                    env.excluded_instances.append(instance.name)
-                    print(blue("NOTICE: no data for {}, append it to exclude list"
-                               .format(instance.name)))
-                else:
-                    print(red("CRITICAL: instance {} is not available but *has* a "
-                        "{}, please inspect manually".format(instance.name, target_file)))
-                break
+            if _kraken_has_data(results[instance.name][get_host_addr(host)]):
+                continue
+            target_file = instance.kraken_database
+            with settings(host_string=host):
+                target_file_exists = exists(target_file)
+            if not target_file_exists:
+                env.excluded_instances.append(instance.name)
+                print(blue("NOTICE: no data for {}, append it to exclude list"
+                           .format(instance.name)))
+            else:
+                print(red("CRITICAL: instance {} is not available but *has* a "
+                    "{}, please inspect manually".format(instance.name, target_file)))
+            break
 
 
 @task
@@ -144,15 +157,47 @@ def require_monitor_kraken_started():
 
 
 @task
-def restart_all_krakens(wait='serial'):
-    """restart and test all kraken instances"""
+def restart_all_krakens(wait='serial', prewarm=None, canary=None):
+    """ Restart and test all kraken instances.
+        Krakens of different instances are restarted at the same time, within the limits
+        of env.KRAKEN_RESTART_MAX_PER_ENGINE and env.KRAKEN_RESTART_MAX_TOTAL.
+        :param wait: string, see restart_kraken()
+               'serial': an instance restarts one kraken at a time
+               'parallel': an instance restarts all its krakens but one at a time
+               'no_test': restart all krakens at once, without test
+        In 'serial' and 'parallel' modes an instance always keeps a loaded kraken
+        (unless it runs on a single engine).
+        :param prewarm: read the data files into the page cache of the engines before
+               the krakens restart, default is env.kraken_prewarm
+        :param canary: compare the latency of each instance after its first kraken restarts
+               to the one before, default is env.kraken_canary (see _run_kraken_restarts)
+        :return: the krakens not loaded after their restart (none with wait='no_test')
+    """
+    if wait not in ('serial', 'parallel', 'no_test'):
+        abort(yellow("Error: wait parameter must be 'serial', 'parallel' or 'no_test', found '{}'".format(wait)))
     execute(require_monitor_kraken_started)
-    instances = tuple(env.instances)
-    for index, instance in enumerate(env.instances.values()):
-        restart_kraken(instance, wait=wait)
-        left = instances[index + 1:]
-        if left:
-            print(blue("Instances left: {}".format(','.join(left))))
+    # restart krakens that are also in the eng role,
+    # this works with the "pool" switch mechanism used in upgrade_all()
+    return restart_krakens(kraken_pairs(hosts=env.roledefs['eng']), wait, prewarm, canary)
+
+
+def restart_krakens(pairs, wait='serial', prewarm=None, canary=None):
+    """ restart the given (instance name, engine address) krakens, see restart_all_krakens
+        :return: the krakens not loaded after their restart
+    """
+    pairs = _stage_before_restart(pairs)
+    if wait == 'no_test':
+        _restart_kraken_pairs(pairs)
+        print(yellow("Warning krakens not tested: parameter wait='no_test'"))
+        return []
+    memory = KrakenMemoryPlan(pairs) if env.kraken_memory_budget else None
+    prewarm = env.kraken_prewarm if prewarm is None else get_bool_from_cli(prewarm)
+    scheduler = KrakenRestartScheduler(pairs, serial=wait == 'serial', memory=memory, backlog=_backlog_gate(pairs))
+    failed = _run_kraken_restarts(scheduler, prewarm, _get_canary(pairs, canary))
+    if failed:
+        print(red("ERROR: {} krakens are not loaded after restart: {}".format(
+            len(failed), ', '.join('{} on {}'.format(*pair) for pair in failed))))
+    return failed
 
 
 @task
@@ -167,15 +212,92 @@ def require_all_krakens_started():
 def test_all_krakens(wait=False):
     """test all kraken instances"""
     wait = get_bool_from_cli(wait)
-    for instance in env.instances.values():
-        test_kraken(instance, fail_if_error=False, wait=wait, loaded_is_ok=True)
+    pairs = kraken_pairs()
+    if wait:
+        results = wait_krakens_loaded(pairs)
+    else:
+        results = probe_krakens(pairs)
+    for instance_name, host in pairs:
+        _report_kraken_result(instance_name, host, results[instance_name][host])
+
+
+def _data_nav_paths(instance):
+    """ (plain, temp) data.nav.lz4 paths of an instance
+    """
+    plain_target = get_real_instance(instance).target_lz4_file
+    return plain_target, os.path.join(os.path.dirname(plain_target), 'temp', os.path.basename(plain_target))
+
+
+def stat_files(paths, host=None):
+    """ get the mtime and size of the given remote files in a single call
+        :param host: default is the current host
+        :return: a dict {path: (mtime, size)}, missing files are absent
+    """
+    paths = sorted(set(paths))
+    if not paths:
+        return {}
+    with settings(warn_only=True):
+        output = run_command_on_host(host or env.host_string,
+                                     "stat -c '%Y %s %n' {} 2>/dev/null".format(' '.join(quote(p) for p in paths)))
+    states = {}
+    for line in output.splitlines():
+        fields = line.strip().split(' ', 2)
+        if len(fields) == 3 and fields[2] in paths and fields[0].isdigit() and fields[1].isdigit():
+            states[fields[2]] = (int(fields[0]), int(fields[1]))
+    return states
+
+
+def plan_data_nav_swaps(instances, states, force=False):
+    """ decide what to do with the data.nav.lz4 of the instances, given the states
+        of their files (see stat_files)
+        :return: a list of (instance name, action, plain path, temp path), action
+                 being 'swap' (exchange plain and temp) or 'move' (temp becomes plain).
+                 Instances with nothing to do are absent.
+    """
+    plan = []
+    for instance in instances:
+        plain_target, temp_target = _data_nav_paths(instance)
+        if temp_target not in states:
+            continue
+        if plain_target not in states:
+            plan.append((get_real_instance(instance).name, 'move', plain_target, temp_target))
+        elif force or states[temp_target][0] > states[plain_target][0]:
+            plan.append((get_real_instance(instance).name, 'swap', plain_target, temp_target))
+    return plan
+
+
+def _data_nav_swap_script(plan):
+    """ one shell script applying a plan of plan_data_nav_swaps.
+        A swap hard links plain aside, then renames temp over plain, so that plain
+        is always a complete file.
+    """
+    commands = []
+    for _, action, plain_target, temp_target in plan:
+        if action == 'move':
+            commands.append('mv -f {1} {0}'.format(quote(plain_target), quote(temp_target)))
+        else:
+            aside = quote(temp_target + '.swap')
+            commands.append('ln -f {0} {2} && mv -f {1} {0} && mv -f {2} {1}'.format(
+                quote(plain_target), quote(temp_target), aside))
+    return ' && '.join('( {} )'.format(c) for c in commands)
+
+
+def _swap_data_navs(instances, force=False):
+    """ swap old/new data.nav.lz4 of instances on the current host, in 2 remote calls
+    """
+    instances = [get_real_instance(i) for i in instances]
+    states = stat_files(p for i in instances for p in _data_nav_paths(i))
+    plan = plan_data_nav_swaps(instances, states, force)
+    if plan:
+        print(blue("Swapping data.nav.lz4 of {}".format(', '.join(name for name, _, _, _ in plan))))
+        run(_data_nav_swap_script(plan))
+    return plan
 
 
 @task
 @roles('tyr_master')
 def swap_all_data_nav(force=False):
-    for instance in env.instances.values():
-        swap_data_nav(instance, force)
+    _swap_data_navs(env.instances.values(), get_bool_from_cli(force))
 
 
 @task
@@ -183,17 +305,7 @@ def swap_all_data_nav(force=False):
 def swap_data_nav(instance, force=False):
     """ swap old/new data.nav.lz4, only if new is still in temp directory
     """
-    plain_target = get_real_instance(instance).target_lz4_file
-    temp_target = os.path.join(os.path.dirname(plain_target), 'temp', os.path.basename(plain_target))
-    if exists(plain_target):
-        if exists(temp_target) and \
-           (force or (files.getmtime(temp_target) > files.getmtime(plain_target))):
-            swap_temp = os.path.join(os.path.dirname(temp_target), 'x')
-            files.move(plain_target, swap_temp)
-            files.move(temp_target, plain_target)
-            files.move(swap_temp, temp_target)
-    elif exists(temp_target):
-        files.move(temp_target, plain_target)
+    _swap_data_navs([instance], get_bool_from_cli(force))
 
 
 @task
@@ -205,41 +317,66 @@ def purge_data_nav(force=False):
     - temp data file is more recent than actual data file
     - temp data file exists but actual data file is missing
     """
-    if not force:
+    instances = env.instances.values()
+    states = stat_files(p for i in instances for p in _data_nav_paths(i))
+    if not get_bool_from_cli(force):
         print("Checking lz4 temp files purge conditions before proceeding...")
         reason = {}
-        for instance in env.instances.values():
-            plain_target = get_real_instance(instance).target_lz4_file
-            temp_target = os.path.join(os.path.dirname(plain_target), 'temp', os.path.basename(plain_target))
-            if exists(plain_target):
-                if exists(temp_target) and files.getmtime(temp_target) > files.getmtime(plain_target):
-                    reason[instance.name] = "{} is more recent than {}".format(temp_target, plain_target)
-            elif exists(temp_target):
-                reason[instance.name] = "{} does not exists".format(plain_target)
+        for instance_name, action, plain_target, temp_target in plan_data_nav_swaps(instances, states):
+            if action == 'swap':
+                reason[instance_name] = "{} is more recent than {}".format(temp_target, plain_target)
+            else:
+                reason[instance_name] = "{} does not exists".format(plain_target)
         if reason:
             print(yellow("Error: Can't purge lz4 temp files, reasons:"))
             for k, v in reason.iteritems():
                 print("  {}: {}".format(k, v))
             exit(1)
 
-    for instance in env.instances.values():
-        plain_target = get_real_instance(instance).target_lz4_file
-        temp_target = os.path.join(os.path.dirname(plain_target), 'temp', os.path.basename(plain_target))
-        if exists(temp_target):
-            files.remove(temp_target)
+    temp_targets = [temp_target for _, temp_target in (_data_nav_paths(i) for i in instances)
+                    if temp_target in states]
+    if temp_targets:
+        run('rm -f {}'.format(' '.join(quote(t) for t in temp_targets)))
+
+
+@task
+def kraken_load_report(instance=None, last=10, ratio=1.5):
+    """ Report the load times of the krakens recorded in env.kraken_history_file:
+        for each instance, compare the last run to the median of the 'last' previous runs,
+        and show the outliers (krakens slower than ratio * median, or not loaded)
+    """
+    if not env.kraken_history_file or not os.path.exists(env.kraken_history_file):
+        abort(yellow("No kraken load history found, env.kraken_history_file={}".format(env.kraken_history_file)))
+    last, ratio = int(last), float(ratio)
+    for instance_name, records in sorted(history.get_kraken_loads(instance).iteritems()):
+        report = history.analyze_kraken_loads(records, last=last, outlier_ratio=ratio)
+        line = "{}: last load {} over {} runs, reference {}".format(
+            instance_name,
+            '{:.1f}s'.format(report['last']) if report['last'] is not None else 'failed',
+            report['runs'],
+            '{:.1f}s'.format(report['reference']) if report['reference'] is not None else 'unknown')
+        if report['trend']:
+            line += " ({:+.0%})".format(report['trend'] - 1)
+        if report['size_trend']:
+            line += ", data size {:+.0%}".format(report['size_trend'] - 1)
+        if report['kraken_version']:
+            line += ", kraken {}".format(report['kraken_version'])
+        if report['prewarmed'] and report['cold']:
+            line += ", {:.1f}s prewarmed vs {:.1f}s cold".format(report['prewarmed'], report['cold'])
+        regressing = (report['trend'] or 0) > ratio or \
+            (report['last'] or 0) > 0.8 * env.KRAKEN_READY_MAX_DELAY
+        print((yellow if regressing or report['outliers'] else green)(line))
+        for record in report['outliers']:
+            print(yellow("  outlier: {host} {state} after {elapsed:.1f}s on {date}".format(
+                state='loaded' if record['loaded'] else 'not loaded', **record)))
 
 
 @task
 def check_dead_instances():
-    dead = 0
     threshold = env.kraken_threshold * len(env.instances)
-    for instance in env.instances.values():
-        for host in instance.kraken_engines_url:
-            request = 'http://{}:{}/{}/?instance={}'.format(host,
-                env.kraken_monitor_port, env.kraken_monitor_location_dir, instance.name)
-            result = _test_kraken(request, fail_if_error=False)
-            if not result or result['status'] == 'timeout' or result['loaded'] is False:
-                dead += 1
+    results = probe_krakens(kraken_pairs())
+    dead = sum(1 for hosts in results.itervalues() for result in hosts.itervalues()
+               if _kraken_is_dead(result))
     if dead > int(threshold):
         print(red("The threshold of allowed dead instances is exceeded: "
                   "Found {} dead instances out of {}.".format(dead, len(env.instances))))
@@ -255,7 +392,7 @@ def check_dead_instances():
 
 
 @task
-def restart_kraken(instance, wait='serial'):
+def restart_kraken(instance, wait='serial', prewarm=None, blue_green=None, canary=None):
     """ Restart all krakens of an instance (using pool), serially or in parallel,
         then test them. Testing serially assures that krakens are restarted serially.
         :param wait: string.
@@ -265,34 +402,894 @@ def restart_kraken(instance, wait='serial'):
                'no_test': explicitely skip tests (faster but dangerous)
         The default value is 'serial' because it is the safest scenario
         to restart the krakens of an instance in production.
+        :param prewarm: read the data file into the page cache of the engines before
+               the krakens restart, default is env.kraken_prewarm
+        :param blue_green: restart the krakens without downtime (see restart_krakens_blue_green),
+               default is env.kraken_blue_green
+        :param canary: compare the latency of the instance after its first kraken restarts
+               to the one before, default is env.kraken_canary (see _run_kraken_restarts)
+        :return: the krakens not loaded after their restart (none with wait='no_test')
     """
     if wait not in ('serial', 'parallel', 'no_test'):
         abort(yellow("Error: wait parameter must be 'serial', 'parallel' or 'no_test', found '{}'".format(wait)))
     instance = get_real_instance(instance)
-    excluded = instance.name in env.excluded_instances
     # restart krakens of this instance that are also in the eng role,
     # this works with the "pool" switch mechanism used in upgrade_all()
-    for host in set(instance.kraken_engines).intersection(env.roledefs['eng']):
-        restart_kraken_on_host(instance, host)
-        if wait == 'serial' and not excluded:
-            test_kraken(instance, fail_if_error=False, wait=True, hosts=[host])
-    if wait == 'parallel' and not excluded:
-        test_kraken(instance, fail_if_error=False, wait=True)
-    if wait != 'no_test' and excluded:
-        print(yellow("Coverage '{}' has no data, not testing it".format(instance.name)))
+    pairs = _stage_before_restart(kraken_pairs([instance], hosts=env.roledefs['eng']))
+    blue_green = env.kraken_blue_green if blue_green is None else get_bool_from_cli(blue_green)
+    if blue_green and wait != 'no_test':
+        pairs = restart_krakens_blue_green(pairs)
+        if not pairs:
+            return []
     if wait == 'no_test':
+        _restart_kraken_pairs(pairs)
         print(yellow("Warning Coverage '{}' not tested: parameter wait='no_test'".format(instance.name)))
+        return []
+    prewarm = env.kraken_prewarm if prewarm is None else get_bool_from_cli(prewarm)
+    if wait == 'serial':
+        scheduler = KrakenRestartScheduler(pairs, serial=True, backlog=_backlog_gate(pairs))
+    else:
+        scheduler = KrakenRestartScheduler(pairs, max_per_engine=len(pairs), max_total=len(pairs),
+                                           serial=False, keep_loaded=False, backlog=_backlog_gate(pairs))
+    return _run_kraken_restarts(scheduler, prewarm, _get_canary(pairs, canary))
 
 
 @task
-def restart_kraken_on_host(instance, host):
+def restart_kraken_on_host(instance, host, blue_green=None):
     """ Restart a kraken of an instance on a given server
+        :param blue_green: restart it without downtime (see restart_krakens_blue_green),
+               default is env.kraken_blue_green
     """
     instance = get_real_instance(instance)
+    blue_green = env.kraken_blue_green if blue_green is None else get_bool_from_cli(blue_green)
+    if blue_green and not restart_krakens_blue_green([(instance.name, get_host_addr(host))]):
+        return
     with settings(host_string=host):
-        kraken = 'kraken_' + instance.name
-        start_or_stop_with_delay(kraken, 4000, 500, start=False, only_once=True)
-        start_or_stop_with_delay(kraken, 4000, 500, only_once=env.KRAKEN_START_ONLY_ONCE)
+        control_services(['kraken_' + instance.name], 'restart', only_once=env.KRAKEN_START_ONLY_ONCE)
+
+
+def _standby_names(instance_name):
+    """ the standby krakens of an instance run in their own directory, seen by the monitor as an
+        instance of this name. After a switch the standby kraken serves the instance from its
+        directory, so the next standby kraken uses the other one.
+    """
+    return instance_name + '_standby', instance_name + '_standby2'
+
+
+def _start_standby_script(instance_name):
+    """ shell script starting a standby kraken of the instance: same binary and configuration,
+        but its own zmq socket, pid and log files, in the standby directory the kraken serving
+        the instance does not run from. Prints 'STANDBY <instance name> <standby name> started'.
+    """
+    main = os.path.join(env.kraken_basedir, instance_name)
+    first, second = _standby_names(instance_name)
+    ini = 'sed -e "s#^zmq_socket = .*#zmq_socket = ipc://$standby/kraken.sock#" -e "s#/{}\\.log\\$#/$slot.log#" ' \
+          '{} > "$standby/kraken.ini"'.format(re.escape(instance_name), quote(main + '/kraken.ini'))
+    return ('live=$(readlink -f /proc/$(cat {main}/kraken.pid 2>/dev/null)/cwd 2>/dev/null); '
+            'if [ "$live" = {basedir}/{first} ]; then slot={second}; else slot={first}; fi; standby={basedir}/$slot; '
+            'mkdir -p "$standby" && cp -Pf {main}/kraken "$standby/kraken" && {ini} && '
+            'chown -R {user}: "$standby" && rm -f "$standby/kraken.pid" && '
+            'start-stop-daemon --start --background --make-pidfile --pidfile "$standby/kraken.pid" '
+            '-c {user} -g {user} --chdir "$standby" --exec "$standby/kraken" && '
+            'echo "STANDBY {name} $slot started"').format(
+        main=quote(main), basedir=quote(env.kraken_basedir), first=quote(first), second=quote(second),
+        ini=ini, user=env.KRAKEN_USER, name=instance_name)
+
+
+def _switch_standby_script(instance_name, standby_name):
+    """ shell script giving the socket of the instance to its standby kraken, then stopping the old kraken.
+        The socket is switched with a rename, so that clients always find a kraken; the standby socket is
+        hard linked first: the old kraken may remove the socket path when it stops, it is then restored.
+        The pid file of the service is updated, the init script then manages the new kraken.
+    """
+    main = os.path.join(env.kraken_basedir, instance_name)
+    standby = os.path.join(env.kraken_basedir, standby_name)
+    return ('old=$(cat {main}/kraken.pid 2>/dev/null); '
+            'ln -f {standby}/kraken.sock {main}/kraken.sock.new && mv -f {main}/kraken.sock.new {main}/kraken.sock && '
+            'cp {standby}/kraken.pid {main}/kraken.pid && '
+            '{{ [ -z "$old" ] || {{ kill $old; for i in $(seq 50); do kill -0 $old 2>/dev/null || break; sleep 0.2; '
+            'done; kill -9 $old 2>/dev/null; true; }}; }} && '
+            '{{ [ -S {main}/kraken.sock ] || ln -f {standby}/kraken.sock {main}/kraken.sock; }} && '
+            'echo "SWITCHED {name} {standby_name}"').format(main=quote(main), standby=quote(standby),
+                                                          name=instance_name, standby_name=standby_name)
+
+
+def _stop_standby_script(instance_name, standby_name):
+    standby = os.path.join(env.kraken_basedir, standby_name)
+    return ('start-stop-daemon --stop --pidfile {standby}/kraken.pid --retry 5; '
+            'rm -f {standby}/kraken.pid; echo "STOPPED {name} {standby_name}"').format(
+        standby=quote(standby), name=instance_name, standby_name=standby_name)
+
+
+def _standby_krakens_on_host(plan, make_script, tag):
+    """ run make_script(*item) for the items plan[env.host_string] on the current host
+        :return: the (instance name, standby name) for which the script printed
+                 '<tag> <instance name> <standby name> ...'
+    """
+    with settings(warn_only=True):
+        output = sudo('; '.join(make_script(*item) for item in plan[env.host_string]))
+    return [tuple(line.split()[1:3]) for line in output.splitlines() if line.startswith(tag + ' ')]
+
+
+def _standby_plan(standby):
+    """ {ssh host: [(instance name, standby name), ...]} of {(instance name, engine address): standby name} """
+    plan = {}
+    for ssh_host, names in _ssh_hosts(standby).iteritems():
+        host = get_host_addr(ssh_host)
+        plan[ssh_host] = [(name, standby[(name, host)]) for name in names]
+    return plan
+
+
+def _get_available_memory():
+    """ memory available on the current host, in bytes """
+    with settings(warn_only=True):
+        output = run_command_on_host(env.host_string, "awk '/^MemAvailable:/ {print $2}' /proc/meminfo")
+    return int(output.strip()) * 1024 if output.strip().isdigit() else 0
+
+
+def plan_blue_green(pairs, available, rss, sizes):
+    """ split krakens between those that can be restarted blue/green and the others:
+        an engine must have kraken_blue_green_margin times the memory of its standby krakens
+        available, the biggest krakens are left out first
+        :param available: {engine address: available memory in bytes}
+        :param rss: {engine address: {instance name: rss in bytes}}
+        :param sizes: {instance name: data.nav.lz4 size in bytes}
+        :return: (krakens to restart blue/green, krakens to restart normally)
+    """
+    def expected(pair):
+        instance_name, host = pair
+        return max(rss.get(host, {}).get(instance_name, 0), sizes.get(instance_name, 0) * env.kraken_lz4_memory_ratio)
+
+    blue_green, others, needed = [], [], {}
+    for pair in sorted(pairs, key=expected):
+        host = pair[1]
+        if (needed.get(host, 0) + expected(pair)) * env.kraken_blue_green_margin <= available.get(host, 0):
+            needed[host] = needed.get(host, 0) + expected(pair)
+            blue_green.append(pair)
+        else:
+            others.append(pair)
+    return blue_green, others
+
+
+def restart_krakens_blue_green(pairs):
+    """ restart krakens without downtime: on each engine, a standby kraken loads the new data on
+        another socket while the old kraken keeps serving, then it takes the socket of the instance
+        and the old kraken is stopped. A standby kraken that does not load in time is stopped and
+        the old kraken keeps serving until its normal restart.
+        This needs ipc zmq sockets and init scripts, and the memory for a second kraken.
+        The load times of the standby krakens are recorded in the history (see fabfile.history).
+        :return: the krakens that could not be restarted this way and must be restarted normally:
+                 krakens of excluded instances, without the memory for a standby kraken, or whose
+                 standby kraken failed
+    """
+    excluded = [p for p in pairs if p[0] in env.excluded_instances]
+    pairs = [p for p in pairs if p not in excluded]
+    if not env.use_zmq_socket_file or env.use_systemd:
+        print(yellow("WARNING: blue/green restarts need ipc zmq sockets and init scripts"))
+        return pairs + excluded
+    if not pairs:
+        return excluded
+    names = set(i for i, _ in pairs)
+    hosts = _ssh_hosts(pairs)
+    sizes = get_data_nav_sizes(names)
+    available = dict((get_host_addr(h), m) for h, m in execute_parallel(_get_available_memory, hosts.keys()).iteritems())
+    blue_green, others = plan_blue_green(pairs, available, get_krakens_rss(hosts.keys()), sizes)
+    for instance_name, host in others:
+        print(yellow("WARNING: not enough memory on {} for a standby kraken {}".format(host, instance_name)))
+    if not blue_green:
+        return others + excluded
+
+    print(blue("Starting standby krakens: {}".format(', '.join('{} on {}'.format(*p) for p in blue_green))))
+    plan = dict((h, [(name,) for name in names]) for h, names in _ssh_hosts(blue_green).iteritems())
+    started = execute_parallel(_standby_krakens_on_host, plan.keys(), plan, _start_standby_script, 'STANDBY')
+    # {(instance name, engine address): standby name}
+    standby = dict(((name, get_host_addr(h)), standby_name)
+                   for h, items in started.iteritems() for name, standby_name in items or [])
+    standby_pairs = [(standby_name, host) for (_, host), standby_name in standby.iteritems()]
+    readiness = KrakenReadiness(names, sizes)
+    readiness.alias(dict((standby_name, name) for (name, _), standby_name in standby.iteritems()))
+    ready_at, start = {}, time.time()
+    results = wait_krakens_loaded(standby_pairs, readiness, ready_at=ready_at)
+    _record_loads(dict((pair, (standby_name, pair[1])) for pair, standby_name in standby.iteritems()),
+                  results, ready_at, time.time() - start, sizes)
+
+    loaded = [pair for pair, standby_name in standby.iteritems() if (standby_name, pair[1]) in ready_at]
+    failed = [p for p in blue_green if p not in loaded]
+    if loaded:
+        plan = _standby_plan(dict((p, standby[p]) for p in loaded))
+        switched = execute_parallel(_standby_krakens_on_host, plan.keys(), plan, _switch_standby_script, 'SWITCHED')
+        for ssh_host, items in plan.iteritems():
+            failed.extend((name, get_host_addr(ssh_host)) for name, standby_name in items
+                          if (name, standby_name) not in (switched.get(ssh_host) or []))
+        print(green("Krakens switched: {}".format(', '.join('{} on {}'.format(*p) for p in loaded if p not in failed))))
+    stopped = [p for p in failed if p in standby]
+    if stopped:
+        plan = _standby_plan(dict((p, standby[p]) for p in stopped))
+        execute_parallel(_standby_krakens_on_host, plan.keys(), plan, _stop_standby_script, 'STOPPED')
+    if failed:
+        print(red("ERROR: standby krakens not loaded, restarting normally: {}".format(
+            ', '.join('{} on {}'.format(*p) for p in failed))))
+    return others + failed + excluded
+
+
+class KrakenRestartScheduler(object):
+    """
+    Decide which krakens can be restarted at the same time.
+    A kraken is a pair (instance name, engine address), it can be restarted when:
+     - less than max_per_engine krakens are restarting on its engine,
+     - less than max_total krakens are restarting on the platform,
+     - its instance keeps a kraken that is not restarting (1 kraken at a time
+       in serial mode, no limit if not keep_loaded); a single engine instance is
+       restarted anyway,
+     - the memory plan, if any, accepts it,
+     - the backlog gate, if any, does not hold it.
+    Krakens are considered in the given order, or biggest first with a memory plan,
+    and krakens held by the backlog gate last.
+    """
+    def __init__(self, pairs, max_per_engine=None, max_total=None, serial=True, memory=None, keep_loaded=True,
+                 backlog=None):
+        self.memory = memory
+        self.backlog = backlog
+        self.pending = sorted(pairs, key=memory.peak, reverse=True) if memory else list(pairs)
+        if backlog:
+            self.pending.sort(key=backlog.holds)
+        self.running = []
+        self.done = []
+        self.max_per_engine = max_per_engine or env.KRAKEN_RESTART_MAX_PER_ENGINE
+        self.max_total = max_total or env.KRAKEN_RESTART_MAX_TOTAL
+        self.serial = serial
+        self.keep_loaded = keep_loaded
+        self.nb_engines = {}
+        for instance_name, _ in self.pending:
+            self.nb_engines[instance_name] = self.nb_engines.get(instance_name, 0) + 1
+
+    def max_per_instance(self, instance_name):
+        if self.serial:
+            return 1
+        if not self.keep_loaded:
+            return self.nb_engines[instance_name]
+        return max(1, self.nb_engines[instance_name] - 1)
+
+    def can_start(self, pair):
+        instance_name, host = pair
+        return len(self.running) < self.max_total and \
+            sum(1 for _, h in self.running if h == host) < self.max_per_engine and \
+            sum(1 for i, _ in self.running if i == instance_name) < self.max_per_instance(instance_name) and \
+            (not self.memory or self.memory.fits(pair, self.running)) and \
+            not (self.backlog and self.backlog.holds(pair))
+
+    def next_batch(self):
+        """ return the krakens to restart now, they are then considered as running
+        """
+        if self.backlog and any(self.backlog.holds(pair) for pair in self.pending):
+            self.backlog.refresh()
+        batch = []
+        for pair in list(self.pending):
+            if self.can_start(pair):
+                self.pending.remove(pair)
+                self.running.append(pair)
+                batch.append(pair)
+        return batch
+
+    def finish(self, pair):
+        self.running.remove(pair)
+        self.done.append(pair)
+        if self.memory:
+            self.memory.finish(pair)
+
+    def cancel(self, instance_name):
+        """ do not restart the pending krakens of an instance
+            :return: the cancelled krakens
+        """
+        cancelled = [p for p in self.pending if p[0] == instance_name]
+        self.pending = [p for p in self.pending if p[0] != instance_name]
+        return cancelled
+
+    def instances_left(self):
+        return sorted(set(i for i, _ in self.pending + self.running))
+
+    def __nonzero__(self):
+        return bool(self.pending or self.running)
+
+
+def get_kraken_queue_depths(pairs, admin=None):
+    """ depth and consumer rate of the rt queues of the given krakens, in a single API call
+        :return: {(instance name, engine address): {'messages': n, 'rate': messages acked per second}}
+    """
+    queues = dict((rabbitmq.kraken_queue_names(name, host)[0], (name, host)) for name, host in pairs)
+    depths = {}
+    for queue in (admin or rabbitmq.RabbitMQAdmin(vhost=env.kraken_broker_vhost)).list_queues(
+            prefix='kraken_', columns=('name', 'messages', 'message_stats')):
+        if queue['name'] in queues:
+            stats = queue.get('message_stats') or {}
+            depths[queues[queue['name']]] = {
+                'messages': queue.get('messages') or 0,
+                'rate': (stats.get('ack_details') or stats.get('deliver_get_details') or {}).get('rate', 0)}
+    return depths
+
+
+class KrakenBacklogGate(object):
+    """
+    Hold the restart of the realtime krakens whose rt queue holds more than
+    env.kraken_rt_backlog_threshold messages, until the queue drains or
+    env.kraken_rt_backlog_max_wait seconds are elapsed.
+    The depths are read in a single API call, at most every env.kraken_rt_backlog_poll seconds.
+    """
+    def __init__(self, pairs, admin=None):
+        self.pairs = [p for p in pairs if env.instances[p[0]].enable_realtime and env.instances[p[0]].rt_topics]
+        self.admin = admin
+        self.deadline = time.time() + env.kraken_rt_backlog_max_wait
+        self.checked = 0
+        self.depths = {}
+        self.refresh(force=True)
+        held = [p for p in self.pairs if self.holds(p)]
+        if held:
+            print(yellow("Restart delayed by the rt queue backlog: {}".format(
+                ', '.join('{} on {} ({} messages)'.format(p[0], p[1], self.backlog(p)) for p in held))))
+
+    def refresh(self, force=False):
+        if not self.pairs or (not force and time.time() - self.checked < env.kraken_rt_backlog_poll):
+            return
+        self.checked = time.time()
+        try:
+            self.depths = get_kraken_queue_depths(self.pairs, self.admin)
+        except Exception as e:
+            print(yellow("WARNING: could not read the rt queues depths: {}".format(e)))
+            self.depths = {}
+
+    def backlog(self, pair):
+        return self.depths.get(pair, {}).get('messages', 0)
+
+    def holds(self, pair):
+        return self.backlog(pair) > env.kraken_rt_backlog_threshold and time.time() < self.deadline
+
+    def report(self, pairs):
+        """ print the depth of the rt queues of the given krakens """
+        self.refresh(force=True)
+        for pair in pairs:
+            if pair in self.depths:
+                print("rt queue of {} on {}: {} messages, {:.1f} msg/s".format(
+                    pair[0], pair[1], self.depths[pair]['messages'], self.depths[pair]['rate']))
+
+
+class KrakenMemoryPlan(object):
+    """
+    Projected memory usage of the engines during a kraken restart wave.
+    A restarting kraken first frees its current RSS, then loads its data file:
+    its peak is estimated as the expected RSS (data.nav.lz4 size * env.kraken_lz4_memory_ratio,
+    or current RSS if bigger) plus the compressed file itself.
+    A kraken fits if the engine stays under the budget while it restarts, or if
+    nothing else restarts on the engine (so that the wave always progresses).
+    """
+    def __init__(self, pairs, budget=None, rss=None, sizes=None):
+        """
+        :param budget: memory budget of an engine in MB, default is env.kraken_memory_budget
+        :param rss: {engine address: {instance name: rss in bytes}}, default is measured
+        :param sizes: {instance name: data.nav.lz4 size in bytes}, default is measured
+        """
+        pairs = list(pairs)
+        self.budget = (budget or env.kraken_memory_budget) * 1024 * 1024
+        self.rss = get_krakens_rss(set(h for _, h in pairs)) if rss is None else rss
+        self.sizes = get_data_nav_sizes(set(i for i, _ in pairs)) if sizes is None else sizes
+        for host, krakens in sorted(self.rss.iteritems()):
+            print(blue("Krakens on {} use {} MB, budget is {} MB".format(
+                host, self.used(host) / 1024 / 1024, self.budget / 1024 / 1024)))
+        for pair in pairs:
+            if self.peak(pair) - self.current(pair) + self.used(pair[1]) > self.budget:
+                print(yellow("WARNING: restart of {} on {} alone exceeds the memory budget".format(*pair)))
+
+    def current(self, pair):
+        instance_name, host = pair
+        return self.rss.get(host, {}).get(instance_name, 0)
+
+    def expected(self, pair):
+        return max(self.current(pair), self.sizes.get(pair[0], 0) * env.kraken_lz4_memory_ratio)
+
+    def peak(self, pair):
+        return self.expected(pair) + self.sizes.get(pair[0], 0)
+
+    def used(self, host):
+        return sum(self.rss.get(host, {}).itervalues())
+
+    def fits(self, pair, running):
+        host = pair[1]
+        others = [p for p in running if p[1] == host]
+        if not others:
+            return True
+        projected = self.used(host) + sum(self.peak(p) - self.current(p) for p in others + [pair])
+        return projected <= self.budget
+
+    def finish(self, pair):
+        instance_name, host = pair
+        self.rss.setdefault(host, {})[instance_name] = self.expected(pair)
+
+
+def get_data_nav_sizes(instances=None):
+    """ get the size (in bytes) of the data.nav.lz4 of the given instance names,
+        in a single call on tyr_master
+    """
+    if not env.roledefs.get('tyr_master'):
+        return {}
+    instances = [get_real_instance(i) for i in (env.instances if instances is None else instances)]
+    states = stat_files((i.target_lz4_file for i in instances), env.roledefs['tyr_master'][0])
+    return dict((i.name, states[i.target_lz4_file][1]) for i in instances if i.target_lz4_file in states)
+
+
+# pid, rss (KB), cumulated cpu time (s), elapsed time since start (s), threads and command of the processes
+_PS_INVENTORY = 'ps -eo pid=,rss=,times=,etimes=,nlwp=,args='
+
+
+def parse_krakens_processes(output, now=None):
+    """ the kraken processes of a _PS_INVENTORY output
+        :return: list of {'pid', 'instance', 'standby', 'rss' (bytes), 'cpu' (s), 'uptime' (s),
+                 'threads', 'start' (timestamp)}
+    """
+    kraken_re = re.compile(r'^\s*(?P<pid>\d+)\s+(?P<rss>\d+)\s+(?P<cpu>\d+)\s+(?P<uptime>\d+)\s+(?P<threads>\d+)\s+'
+                           r'{}/(?P<instance>[^/\s]+)/kraken\b'.format(re.escape(env.kraken_basedir)))
+    now = now or time.time()
+    processes = []
+    for line in output.splitlines():
+        match = kraken_re.match(line)
+        if match:
+            # a standby kraken that took over its instance (see restart_krakens_blue_green) serves it
+            instance_name = match.group('instance')
+            uptime = int(match.group('uptime'))
+            processes.append(dict(pid=int(match.group('pid')), instance=re.sub('_standby2?$', '', instance_name),
+                                  standby=bool(re.search('_standby2?$', instance_name)), rss=int(match.group('rss')) * 1024,
+                                  cpu=int(match.group('cpu')), uptime=uptime, threads=int(match.group('threads')),
+                                  start=int(now - uptime)))
+    return processes
+
+
+def _get_krakens_processes():
+    """ the kraken processes running on the current host, see parse_krakens_processes
+    """
+    with settings(warn_only=True):
+        output = run_command_on_host(env.host_string, _PS_INVENTORY)
+    return parse_krakens_processes(output)
+
+
+def get_krakens_processes(hosts=None):
+    """ inventory of the kraken processes, all engines at the same time
+        :return: list of processes (see parse_krakens_processes) with their 'host' (engine address)
+    """
+    hosts = set(get_host_addr(h) for h in hosts or env.roledefs['eng'])
+    ssh_hosts = [h for h in env.roledefs['eng'] if get_host_addr(h) in hosts]
+    processes = []
+    for ssh_host, host_processes in execute_parallel(_get_krakens_processes, ssh_hosts).iteritems():
+        for process in host_processes or []:
+            process['host'] = get_host_addr(ssh_host)
+            processes.append(process)
+    return processes
+
+
+def get_krakens_rss(hosts=None):
+    """ get the RSS of the kraken processes, all engines at the same time
+        :return: {engine address: {instance name: rss in bytes}}
+    """
+    rss = dict((get_host_addr(h), {}) for h in hosts or env.roledefs['eng'])
+    for process in get_krakens_processes(hosts):
+        krakens = rss.setdefault(process['host'], {})
+        krakens[process['instance']] = krakens.get(process['instance'], 0) + process['rss']
+    return rss
+
+
+def _backlog_gate(pairs):
+    """ a KrakenBacklogGate if some of the krakens are realtime ones and the gate is enabled
+    """
+    if env.kraken_rt_backlog_threshold is None or \
+            not any(env.instances[name].enable_realtime and env.instances[name].rt_topics for name, _ in pairs):
+        return None
+    return KrakenBacklogGate(pairs)
+
+
+def _restart_krakens_on_host(plan):
+    """ restart krakens of the instances plan[env.host_string] on the current host
+    """
+    control_services(['kraken_' + instance_name for instance_name in plan[env.host_string]], 'restart',
+                     only_once=env.KRAKEN_START_ONLY_ONCE)
+
+
+def _restart_kraken_pairs(pairs):
+    """ restart the given (instance name, engine address) krakens, all engines at the same time
+    """
+    plan = _ssh_hosts(pairs)
+    execute_parallel(_restart_krakens_on_host, plan.keys(), plan)
+
+
+def _prewarm_log(instance_name):
+    return env.kraken_prewarm_log.format(instance=instance_name)
+
+
+def _prewarm_script(files):
+    """ shell script reading files to /dev/null, env.kraken_prewarm_parallel at a time,
+        and writing '<path> <elapsed ms>' to the log of each file
+        :param files: [(file path, log path), ...]
+    """
+    read = ('s=$(date +%s%N); dd if="$0" of=/dev/null bs=1M 2>/dev/null; '
+            'echo "$0 $(( ($(date +%s%N) - s) / 1000000 ))" > "$1"')
+    return "printf '%s\\0' {} | xargs -0 -P {} -n 2 sh -c {}".format(
+        ' '.join(quote(p) for f in files for p in f), env.kraken_prewarm_parallel, quote(read))
+
+
+def _start_prewarm_on_host(plan):
+    """ read the data files of the instances plan[env.host_string] into the page cache of the current host,
+        in background. The pid of the prewarm process is written next to the log of each instance.
+    """
+    names = plan[env.host_string]
+    logs = ' '.join(quote(_prewarm_log(name)) for name in names)
+    script = _prewarm_script([(env.instances[name].kraken_database, _prewarm_log(name)) for name in names])
+    run('rm -f {logs}; nohup sh -c {} > /dev/null 2>&1 & pid=$!; for f in {logs}; do echo $pid > "$f.pid"; done'
+        .format(quote(script), logs=logs), pty=False)
+
+
+def _collect_prewarm_on_host(plan):
+    """ wait for the prewarm of the instances plan[env.host_string] on the current host to be over
+        :return: {data file path: seconds spent reading it} from their prewarm logs
+    """
+    script = '; '.join(
+        'while kill -0 $(cat {0}.pid 2>/dev/null) 2>/dev/null; do sleep 1; done; rm -f {0}.pid; cat {0} 2>/dev/null'
+        .format(quote(_prewarm_log(name))) for name in plan[env.host_string])
+    with settings(warn_only=True):
+        output = run_command_on_host(env.host_string, script)
+    durations = {}
+    for line in output.splitlines():
+        path, _, elapsed = line.strip().rpartition(' ')
+        if path and elapsed.isdigit():
+            durations[path] = int(elapsed) / 1000.0
+    return durations
+
+
+def _ssh_hosts(pairs):
+    """ {ssh host: [instance name, ...]} of (instance name, engine address) krakens
+    """
+    plan = {}
+    for instance_name, host in pairs:
+        ssh_host = [h for h in env.instances[instance_name].kraken_engines if get_host_addr(h) == host][0]
+        plan.setdefault(ssh_host, []).append(instance_name)
+    return plan
+
+
+def start_prewarm(pairs):
+    """ start reading the data files of the krakens into the page cache of their engine,
+        in the given order, in background and on all engines at the same time
+    """
+    plan = dict((h, [name for name in names if name not in env.excluded_instances])
+                for h, names in _ssh_hosts(pairs).iteritems())
+    plan = dict((h, names) for h, names in plan.iteritems() if names)
+    print(blue("Prewarming data files on {}".format(', '.join(sorted(plan)))))
+    execute_parallel(_start_prewarm_on_host, plan.keys(), plan)
+
+
+def collect_prewarm(pairs):
+    """ :return: {(instance name, engine address): seconds spent reading its data file}
+    """
+    plan = dict((h, [name for name in names if name not in env.excluded_instances])
+                for h, names in _ssh_hosts(pairs).iteritems())
+    logs = execute_parallel(_collect_prewarm_on_host, plan.keys(), plan)
+    durations = {}
+    for ssh_host, instance_names in plan.iteritems():
+        for instance_name in instance_names:
+            elapsed = (logs.get(ssh_host) or {}).get(env.instances[instance_name].kraken_database)
+            if elapsed is not None:
+                durations[(instance_name, get_host_addr(ssh_host))] = elapsed
+    return durations
+
+
+def _report_prewarm(durations, sizes):
+    for host in sorted(set(h for _, h in durations)):
+        pairs = [p for p in durations if p[1] == host]
+        total = sum(durations[p] for p in pairs)
+        size = sum(sizes.get(i, 0) for i, _ in pairs)
+        print(blue("Prewarmed {} data files on {} in {:.1f}s ({:.0f} MB/s)".format(
+            len(pairs), host, total, size / 1024.0 / 1024 / total if total else 0)))
+
+
+def get_data_nav_checksums(instances):
+    """ md5 of the data.nav.lz4 of the given instances, computed in a single call on tyr_master
+        :return: {instance name: md5}, missing files are absent
+    """
+    instances = [get_real_instance(i) for i in instances]
+    files = dict((i.target_lz4_file, i.name) for i in instances)
+    if not files:
+        return {}
+    with settings(warn_only=True):
+        output = run_command_on_host(env.roledefs['tyr_master'][0],
+                                     "md5sum {} 2>/dev/null".format(' '.join(quote(f) for f in sorted(files))))
+    checksums = {}
+    for line in output.splitlines():
+        md5, _, path = line.strip().partition('  ')
+        if path in files:
+            checksums[files[path]] = md5
+    return checksums
+
+
+def _staging_script(copies):
+    """ shell script copying data files to the local disk, a list of (name, source, destination, md5).
+        A copy is skipped if the destination already has the right checksum, else the source
+        is copied aside with a bandwidth limit, verified, then renamed over the destination.
+        Prints 'STAGED <name> <status>' per copy, status being 'ok', 'uptodate' or 'failed'.
+    """
+    commands = []
+    for name, source, destination, md5 in copies:
+        staging = quote(destination + '.staging')
+        check = "printf '%s  %s\\n' {} {{}} | md5sum -c --status".format(quote(md5))
+        commands.append(
+            'if [ -e {dst} ] && {check_dst}; then echo "STAGED {name} uptodate"; '
+            'elif mkdir -p {dir} && rsync --bwlimit={bwlimit} {src} {staging} && {check_staging} && '
+            'mv -f {staging} {dst}; then echo "STAGED {name} ok"; '
+            'else rm -f {staging}; echo "STAGED {name} failed"; fi'.format(
+                name=name, src=quote(source), dst=quote(destination), staging=staging,
+                dir=quote(os.path.dirname(destination)), bwlimit=env.kraken_staging_bwlimit,
+                check_dst=check.format(quote(destination)), check_staging=check.format(staging)))
+    return '; '.join(commands)
+
+
+def _stage_data_files_on_host(plan):
+    """ copy the data files plan[env.host_string] to the local disk of the current host
+        :return: {instance name: status}
+    """
+    with settings(warn_only=True):
+        output = sudo(_staging_script(plan[env.host_string]), user=env.KRAKEN_USER)
+    status = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == 'STAGED':
+            status[fields[1]] = fields[2]
+    return status
+
+
+def stage_data_files(pairs):
+    """ copy the data.nav.lz4 of the krakens from the shared tyr destination directory
+        to the local disk of their engine (instance.kraken_database), all engines at the same time.
+        Each copy is verified against a checksum computed once on tyr_master.
+        :return: the krakens whose data file could not be staged
+    """
+    pairs = [p for p in pairs if p[0] not in env.excluded_instances]
+    checksums = get_data_nav_checksums(set(i for i, _ in pairs))
+    failed = [p for p in pairs if p[0] not in checksums]
+    plan = dict((h, [(name, env.instances[name].target_lz4_file, env.instances[name].kraken_database,
+                      checksums[name]) for name in names if name in checksums])
+                for h, names in _ssh_hosts(pairs).iteritems())
+    plan = dict((h, copies) for h, copies in plan.iteritems() if copies)
+    with time_that(blue("Data files staged in {elapsed}")):
+        results = execute_parallel(_stage_data_files_on_host, plan.keys(), plan)
+    for ssh_host, copies in plan.iteritems():
+        status = results.get(ssh_host) or {}
+        for name, _, _, _ in copies:
+            if status.get(name) not in ('ok', 'uptodate'):
+                failed.append((name, get_host_addr(ssh_host)))
+    if failed:
+        print(red("ERROR: could not stage the data file of {}".format(
+            ', '.join('{} on {}'.format(*pair) for pair in failed))))
+    return failed
+
+
+def _stage_before_restart(pairs):
+    """ stage the data files if env.kraken_local_staging, and drop the krakens
+        whose data file could not be staged: they keep their current data
+    """
+    if not env.kraken_local_staging:
+        return pairs
+    failed = stage_data_files(pairs)
+    return [p for p in pairs if p not in failed]
+
+
+def _get_canary(pairs, canary=None):
+    """ a KrakenCanary of the instances of the krakens if canary (default is env.kraken_canary)
+    """
+    canary = env.kraken_canary if canary is None else get_bool_from_cli(canary)
+    if not canary:
+        return None
+    instances = [env.instances[name] for name in sorted(set(i for i, _ in pairs)) if name not in env.excluded_instances]
+    print(blue("Measuring the latency of {} coverages before the restart".format(len(instances))))
+    return KrakenCanary(instances)
+
+
+def _run_kraken_restarts(scheduler, prewarm=False, canary=None):
+    """ restart the krakens of a scheduler, wave after wave, and wait for them to be loaded,
+        each one within its own deadline (see KrakenReadiness).
+        The load time of each kraken is recorded in the history (see fabfile.history).
+        :param prewarm: read the data files into the page cache of the engines, in the
+                        restart order, while the first krakens restart
+        :param canary: a KrakenCanary; once the first kraken of an instance is loaded, the other ones
+                       are not restarted if the latency of the instance is degraded, and the instance
+                       is rolled back if env.kraken_canary_rollback
+        :return: the list of krakens that did not load in time, or that degraded their instance
+    """
+    started, next_probe, attempts, failed, records = {}, {}, {}, [], []
+    gate = KrakenCanaryGate(canary, scheduler) if canary else None
+    pairs = list(scheduler.pending)
+    sizes = scheduler.memory.sizes if scheduler.memory else \
+        get_data_nav_sizes(set(i for i, _ in pairs))
+    readiness = KrakenReadiness(set(i for i, _ in pairs), sizes)
+    if prewarm:
+        start_prewarm(pairs)
+    while scheduler:
+        batch = scheduler.next_batch()
+        if batch:
+            print(blue("Restarting krakens: {}".format(', '.join('{} on {}'.format(*pair) for pair in batch))))
+            now = time.time()
+            _restart_kraken_pairs(batch)
+            for pair in batch:
+                started[pair], next_probe[pair], attempts[pair] = now, now, 0
+        finished = [pair for pair in scheduler.running if pair[0] in env.excluded_instances]
+        for instance_name, host in finished:
+            print(yellow("Coverage '{}' has no data, not testing it on {}".format(instance_name, host)))
+        now = time.time()
+        waiting = [pair for pair in scheduler.running if pair not in finished and next_probe[pair] <= now]
+        results = probe_krakens(waiting)
+        for instance_name, host in waiting:
+            pair = (instance_name, host)
+            result = results[instance_name][host]
+            elapsed = time.time() - started[pair]
+            if _kraken_is_loaded(result) or elapsed > readiness.deadline(instance_name):
+                if not _report_kraken_result(instance_name, host, result):
+                    failed.append(pair)
+                finished.append(pair)
+                if env.kraken_history_file:
+                    records.append(dict(instance=instance_name, host=host, elapsed=elapsed,
+                                        loaded=_kraken_is_loaded(result), data_size=sizes.get(instance_name),
+                                        kraken_version=(result or {}).get('kraken_version')))
+            else:
+                attempts[pair] += 1
+                next_probe[pair] = time.time() + readiness.poll_period(instance_name, attempts[pair])
+        for pair in finished:
+            scheduler.finish(pair)
+        if gate:
+            failed.extend(gate.check(finished, failed))
+        if finished:
+            left = scheduler.instances_left()
+            if left:
+                print(blue("Instances left: {}".format(','.join(left))))
+        elif scheduler.running:
+            time.sleep(max(0, min(next_probe[pair] for pair in scheduler.running) - time.time()))
+        elif scheduler:
+            # only krakens held by the backlog gate are left
+            time.sleep(env.kraken_rt_backlog_poll)
+    if prewarm:
+        durations = collect_prewarm(pairs)
+        _report_prewarm(durations, sizes)
+        for record in records:
+            record['prewarm'] = durations.get((record['instance'], record['host']))
+    if scheduler.backlog:
+        scheduler.backlog.report(scheduler.done)
+    history.record_kraken_loads(records)
+    if gate:
+        gate.rollback()
+    return failed
+
+
+class KrakenCanaryGate(object):
+    """
+    Check the latency of each instance once its first kraken is restarted and loaded
+    (see fabfile.canary.KrakenCanary). If it is degraded, the restart of its other krakens
+    is cancelled, and the instance is rolled back at the end if env.kraken_canary_rollback.
+    """
+    def __init__(self, canary, scheduler):
+        self.canary = canary
+        self.scheduler = scheduler
+        self.checked = set()
+        self.degraded = []
+
+    def check(self, finished, failed):
+        """ :param finished: the krakens that just finished their restart
+            :param failed: the krakens that did not load
+            :return: the krakens that degraded the latency of their instance
+        """
+        degraded = []
+        for instance_name, host in finished:
+            if instance_name in self.checked or (instance_name, host) in failed or \
+                    instance_name in env.excluded_instances:
+                continue
+            self.checked.add(instance_name)
+            if self.is_degraded(instance_name, host):
+                degraded.append((instance_name, host))
+                self.degraded.append(instance_name)
+        return degraded
+
+    def is_degraded(self, instance_name, host):
+        is_degraded, baseline, current = self.canary.check(instance_name)
+        if baseline is None:
+            return False
+
+        def latency(stats):
+            return 'p50 {} p95 {} errors {}'.format(
+                *['{:.3f}s'.format(stats[p]) if stats[p] is not None else '-' for p in ('p50', 'p95')] +
+                [stats['errors']])
+
+        message = "Latency of {} after the restart on {}: {}, before: {}".format(
+            instance_name, host, latency(current), latency(baseline))
+        if not is_degraded:
+            print(green(message))
+            return False
+        print(red(message))
+        cancelled = self.scheduler.cancel(instance_name)
+        if cancelled:
+            print(red("ERROR: latency of {} degraded, not restarting its krakens on {}".format(
+                instance_name, ', '.join(h for _, h in cancelled))))
+        return True
+
+    def rollback(self):
+        if self.degraded and env.kraken_canary_rollback:
+            for instance_name in self.degraded:
+                print(red("Rolling back {}".format(instance_name)))
+                # a canary on the rollback would roll it back again, to the new data
+                execute(rollback_instance, instance_name, canary=False, blue_green=False)
+
+
+# a navitia Task message with action RELOAD (field 1, varint 1), serialized by hand
+# to avoid depending on the navitia protobuf modules, it is the message tyr sends
+KRAKEN_RELOAD_TASK = b'\x08\x01'
+
+
+def reload_krakens(pairs, admin=None):
+    """ ask running krakens to reload their data instead of restarting them: one RELOAD task per
+        instance is published on the broker task exchange (env.kraken_broker_exchange), all the
+        krakens of the instance receive it. A reload is confirmed when the monitor reports a kraken
+        loaded with a new publication date (or a new load date, when the data did not change).
+        Krakens that do not confirm within their deadline (see KrakenReadiness) are restarted.
+        :return: the krakens that did not load in time, even after a restart
+    """
+    pairs = [p for p in _stage_before_restart(pairs) if p[0] not in env.excluded_instances]
+    if not pairs:
+        return []
+    names = sorted(set(i for i, _ in pairs))
+    before = probe_krakens(pairs)
+    admin = admin or rabbitmq.RabbitMQAdmin(vhost=env.kraken_broker_vhost)
+    print(blue("Reloading krakens of {}".format(', '.join(names))))
+    sent = admin.publish_all(env.kraken_broker_exchange,
+                             dict(('{}.task.reload'.format(name), KRAKEN_RELOAD_TASK) for name in names))
+    delivered = set()
+    for name in names:
+        routed = sent['{}.task.reload'.format(name)]
+        if routed is True:
+            delivered.add(name)
+        else:
+            print(yellow("WARNING: reload task of {} not delivered: {}".format(name, routed or 'no kraken queue')))
+
+    def reloaded(pair, result):
+        previous = before[pair[0]][pair[1]] or {}
+        return _kraken_is_loaded(result) and any(
+            result.get(key) and result.get(key) != previous.get(key) for key in ('publication_date', 'last_load_at'))
+
+    waiting = [p for p in pairs if p[0] in delivered]
+    sizes = get_data_nav_sizes(names)
+    ready_at = {}
+    results = wait_krakens_loaded(waiting, KrakenReadiness(names, sizes), reloaded, ready_at) if waiting else {}
+    confirmed = [p for p in waiting if p in ready_at]
+    # the krakens not confirmed are recorded by their restart
+    _record_loads(dict((p, p) for p in confirmed), results, ready_at, None, sizes)
+    if confirmed:
+        print(green("Krakens reloaded: {}".format(', '.join('{} on {}'.format(*p) for p in confirmed))))
+    unconfirmed = [p for p in pairs if p not in confirmed]
+    if not unconfirmed:
+        return []
+    print(yellow("WARNING: reload not confirmed, restarting: {}".format(
+        ', '.join('{} on {}'.format(*p) for p in unconfirmed))))
+    return _run_kraken_restarts(KrakenRestartScheduler(unconfirmed, backlog=_backlog_gate(unconfirmed)))
+
+
+@task
+def reload_kraken(instance):
+    """ Reload the data of the krakens of an instance through the broker, without restarting
+        them, see reload_krakens
+    """
+    instance = get_real_instance(instance)
+    failed = reload_krakens(kraken_pairs([instance], hosts=env.roledefs['eng']))
+    if failed:
+        print(red("ERROR: krakens not loaded: {}".format(', '.join('{} on {}'.format(*p) for p in failed))))
+
+
+@task
+def reload_all_krakens():
+    """ Reload the data of all krakens through the broker, without restarting them,
+        see reload_krakens
+    """
+    execute(require_monitor_kraken_started)
+    failed = reload_krakens(kraken_pairs(hosts=env.roledefs['eng']))
+    if failed:
+        print(red("ERROR: krakens not loaded: {}".format(', '.join('{} on {}'.format(*p) for p in failed))))
 
 
 @task
@@ -300,10 +1297,9 @@ def require_kraken_started(instance):
     """start a kraken instance on all servers if it is not already started
     """
     instance = get_real_instance(instance)
-    kraken = 'kraken_' + instance.name
     for host in instance.kraken_engines:
         with settings(host_string=host):
-            start_or_stop_with_delay(kraken, 4000, 500, only_once=True)
+            control_services(['kraken_' + instance.name], 'start')
 
 
 @task
@@ -311,17 +1307,17 @@ def stop_kraken(instance):
     """Stop a kraken instance on all servers
     """
     instance = get_real_instance(instance)
-    kraken = 'kraken_' + instance.name
     for host in instance.kraken_engines:
         with settings(host_string=host):
-            start_or_stop_with_delay(kraken, 4000, 500, start=False, only_once=True)
+            control_services(['kraken_' + instance.name], 'stop')
 
 
-def _test_kraken(query, fail_if_error=True):
+def _test_kraken(query, fail_if_error=True, verbose=True):
     """
     poll on kraken monitor until it gets a 'running' status
     """
-    print("calling : {}".format(query))
+    if verbose:
+        print("calling : {}".format(query))
     try:
         response = requests.get(query, timeout=2)
     except requests.exceptions.Timeout as t:
@@ -337,6 +1333,209 @@ def _test_kraken(query, fail_if_error=True):
     return json.loads(response.text)
 
 
+def _monitor_url(host, instance_name):
+    return 'http://{}:{}/{}/?instance={}'.format(host,
+        env.kraken_monitor_port, env.kraken_monitor_location_dir, instance_name)
+
+
+# keep-alive http sessions to kraken monitors, one per engine
+_monitor_sessions = {}
+
+
+def _get_monitor_session(host):
+    if host not in _monitor_sessions:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=env.kraken_monitor_pool_size))
+        _monitor_sessions[host] = session
+    return _monitor_sessions[host]
+
+
+def kraken_pairs(instances=None, hosts=None):
+    """
+    list the (instance name, engine address) pairs of the given instances
+    :param instances: instances or instance names, defaults to all instances
+    :param hosts: if given, only keep the krakens running on these engines
+    """
+    instances = env.instances.values() if instances is None else map(get_real_instance, instances)
+    hosts = hosts and set(get_host_addr(h) for h in hosts)
+    return [(instance.name, host) for instance in instances for host in instance.kraken_engines_url
+            if not hosts or host in hosts]
+
+
+def probe_krakens(pairs, timeout=None):
+    """
+    query the kraken monitor for many krakens at once
+    requests are sent concurrently, with at most env.kraken_monitor_pool_size
+    requests in flight, reusing a keep-alive session per engine
+    :param pairs: iterable of (instance name, engine address), see kraken_pairs()
+    :return: dict {instance name: {engine address: monitor result or None}},
+             result is None when the monitor could not be reached
+    """
+    pairs = list(pairs)
+    timeout = timeout or env.kraken_monitor_timeout
+    # sessions are created here, not in the threads
+    for host in set(host for _, host in pairs):
+        _get_monitor_session(host)
+
+    def probe(pair):
+        instance_name, host = pair
+        try:
+            response = _monitor_sessions[host].get(_monitor_url(host, instance_name), timeout=timeout)
+            return json.loads(response.text)
+        except Exception as e:
+            print(yellow("WARNING: cannot get status of kraken {} on {}: {}".format(instance_name, host, e)))
+            return None
+
+    results = {}
+    if not pairs:
+        return results
+    with Parallel(min(len(pairs), env.kraken_monitor_pool_size)) as pool:
+        statuses = pool.map(probe, pairs)
+    for (instance_name, host), status in zip(pairs, statuses):
+        results.setdefault(instance_name, {})[host] = status
+    return results
+
+
+class KrakenReadiness(object):
+    """
+    Per-instance deadlines and polling periods of the krakens that are loading.
+    The expected load time of an instance is the median of its last loads in the
+    history, or else it is estimated from the size of its data.nav.lz4.
+    A kraken is given env.kraken_ready_margin times its expected load time, between
+    env.KRAKEN_READY_MIN_DELAY and env.KRAKEN_READY_MAX_DELAY, or env.KRAKEN_RESTART_DELAY
+    if nothing is known. Polling starts every env.kraken_poll_min seconds and slows down
+    up to a tenth of the expected load time (at most env.kraken_poll_max).
+    """
+    def __init__(self, instance_names, sizes=None, loads=None):
+        """
+        :param sizes: {instance name: data.nav.lz4 size in bytes}
+        :param loads: load history, default is read from env.kraken_history_file
+        """
+        if loads is None:
+            loads = history.get_kraken_loads() if env.kraken_history_file else {}
+        self.expected = {}
+        for instance_name in instance_names:
+            elapsed = [r['elapsed'] for r in loads.get(instance_name, []) if r['loaded']]
+            if elapsed:
+                self.expected[instance_name] = history.median(elapsed[-env.kraken_ready_history:])
+            elif sizes and sizes.get(instance_name):
+                self.expected[instance_name] = float(sizes[instance_name]) / 1024 / 1024 / env.kraken_load_rate
+
+    def alias(self, aliases):
+        """ give krakens probed under another name (eg standby krakens) the deadline and polling of their instance
+            :param aliases: {name: instance name}
+        """
+        for name, instance_name in aliases.iteritems():
+            if instance_name in self.expected:
+                self.expected[name] = self.expected[instance_name]
+
+    def deadline(self, instance_name):
+        """ seconds given to a kraken of the instance to load """
+        expected = self.expected.get(instance_name)
+        if expected is None:
+            return env.KRAKEN_RESTART_DELAY
+        return min(max(expected * env.kraken_ready_margin, env.KRAKEN_READY_MIN_DELAY), env.KRAKEN_READY_MAX_DELAY)
+
+    def poll_period(self, instance_name, attempt):
+        """ seconds to wait before the next probe of a kraken """
+        ceiling = self.expected.get(instance_name, env.KRAKEN_RESTART_DELAY) / 10.0
+        return min(env.kraken_poll_min * 1.5 ** attempt, max(env.kraken_poll_min, min(ceiling, env.kraken_poll_max)))
+
+
+def wait_krakens_loaded(pairs, readiness=None, is_ready=None, ready_at=None):
+    """
+    probe krakens until they are all loaded or their deadline is over (see KrakenReadiness)
+    :param is_ready: function (pair, monitor result) telling if a kraken is ready, default is loaded
+    :param ready_at: if given, dict filled with {pair: seconds until the kraken was ready}
+    :return: last results, same as probe_krakens()
+    """
+    is_ready = is_ready or (lambda pair, result: _kraken_is_loaded(result))
+    ready_at = {} if ready_at is None else ready_at
+    if readiness is None:
+        instance_names = set(i for i, _ in pairs)
+        readiness = KrakenReadiness(instance_names, get_data_nav_sizes(instance_names))
+    start = time.time()
+
+    def still_waiting(waiting):
+        left = []
+        for p in waiting:
+            if is_ready(p, results[p[0]][p[1]]):
+                ready_at[p] = time.time() - start
+            else:
+                left.append(p)
+        return left
+
+    with time_that(blue("Krakens probed in {elapsed}")):
+        results = probe_krakens(pairs)
+        attempt = 0
+        waiting = still_waiting(pairs)
+        while waiting:
+            waiting = [p for p in waiting if time.time() - start < readiness.deadline(p[0])]
+            if not waiting:
+                break
+            attempt += 1
+            time.sleep(min(readiness.poll_period(i, attempt) for i, _ in waiting))
+            for instance_name, hosts in probe_krakens(waiting).iteritems():
+                results[instance_name].update(hosts)
+            waiting = still_waiting(waiting)
+    return results
+
+
+def _record_loads(pairs, results, ready_at, waited, sizes):
+    """ record in the history the loads of krakens waited by wait_krakens_loaded
+        :param pairs: {(instance name, engine address): pair probed by the monitor}
+        :param waited: seconds waited for the krakens that were not ready
+    """
+    if not env.kraken_history_file:
+        return
+    records = []
+    for (instance_name, host), probed in pairs.iteritems():
+        result = results.get(probed[0], {}).get(probed[1])
+        records.append(dict(instance=instance_name, host=host, elapsed=ready_at.get(probed, waited),
+                            loaded=probed in ready_at, data_size=sizes.get(instance_name),
+                            kraken_version=(result or {}).get('kraken_version')))
+    history.record_kraken_loads(records)
+
+
+def loaded_instances(instance_names):
+    """ probe all the krakens of the instances
+        :return: the names of the instances whose krakens are all loaded
+    """
+    results = probe_krakens(kraken_pairs(instance_names)) if instance_names else {}
+    return [name for name in instance_names
+            if results.get(name) and all(_kraken_is_loaded(r) for r in results[name].itervalues())]
+
+
+def _kraken_is_loaded(result):
+    return bool(result and result.get('loaded'))
+
+
+def _kraken_is_dead(result):
+    return not result or result.get('status') == 'timeout' or result.get('loaded') is False
+
+
+def _kraken_has_data(result):
+    return bool(result and result.get('status') == 'running' and
+                result.get('is_connected_to_rabbitmq') and result.get('loaded'))
+
+
+def _report_kraken_result(instance_name, host, result):
+    """ print the status of a kraken as test_kraken does, return True if it is fine
+    """
+    if not result:
+        print(red("ERROR: could not reach {} on {}".format(instance_name, host)))
+    elif result.get('status') != 'running':
+        print(yellow("WARNING: Instance {} is not running on {} ! ({})".format(instance_name, host, result)))
+    elif not result.get('is_connected_to_rabbitmq'):
+        print(yellow("WARNING: Instance {} is not connected to rabbitmq on {}".format(instance_name, host)))
+    elif not result.get('loaded'):
+        print(yellow("WARNING: instance {} has no loaded data on {}".format(instance_name, host)))
+    else:
+        print(green("OK: instance {} has correct values on {}: {}".format(instance_name, host, result)))
+        return True
+    return False
+
+
 @task
 def test_kraken(instance, fail_if_error=True, wait=False, loaded_is_ok=None, hosts=None):
     """Test kraken with '?instance='"""
@@ -345,16 +1544,20 @@ def test_kraken(instance, fail_if_error=True, wait=False, loaded_is_ok=None, hos
 
     hosts = [e.split('@')[1] for e in hosts or instance.kraken_engines]
     will_return = len(hosts) == 1
+    if wait:
+        readiness = KrakenReadiness([instance.name], get_data_nav_sizes([instance]))
     for host in hosts:
-        request = 'http://{}:{}/{}/?instance={}'.format(host,
-            env.kraken_monitor_port, env.kraken_monitor_location_dir, instance.name)
+        request = _monitor_url(host, instance.name)
 
         if wait:
             # we wait until we get a response and the instance is 'loaded'
+            print("waiting for {} to be loaded, at most {:.0f}s: {}".format(
+                instance.name, readiness.deadline(instance.name), request))
             try:
-                result = Retrying(stop_max_delay=env.KRAKEN_RESTART_DELAY * 1000,
-                                  wait_fixed=1000, retry_on_result=lambda x: x is None or not x['loaded']) \
-                    .call(_test_kraken, request, fail_if_error)
+                result = Retrying(stop_max_delay=readiness.deadline(instance.name) * 1000,
+                                  wait_func=lambda attempt, _: readiness.poll_period(instance.name, attempt) * 1000,
+                                  retry_on_result=lambda x: x is None or not x['loaded']) \
+                    .call(_test_kraken, request, fail_if_error, verbose=False)
             except Exception as e:
                 print(red("ERROR: could not reach {}, too many retries ! ({})".format(instance.name, e)))
                 result = {'status': False}
@@ -412,22 +1615,26 @@ def test_kraken(instance, fail_if_error=True, wait=False, loaded_is_ok=None, hos
 @task
 @roles('eng')
 def update_monitor_configuration():
-
-    _upload_template('kraken/monitor_kraken.wsgi.jinja', env.kraken_monitor_wsgi_file,
+    changed = _upload_template('kraken/monitor_kraken.wsgi.jinja', env.kraken_monitor_wsgi_file,
             context={'env': env})
-    _upload_template('kraken/monitor_settings.py.jinja', env.kraken_monitor_config_file,
+    changed |= _upload_template('kraken/monitor_settings.py.jinja', env.kraken_monitor_config_file,
             context={'env': env})
+    return changed
 
 
 @task
 def update_eng_instance_conf(instance, host=None):
+    """ deploy the kraken.ini and the service file of an instance
+        :return: the engines where one of them changed
+    """
     instance = get_real_instance(instance)
     hosts = [host] if host else instance.kraken_engines
+    changed = []
     for host in hosts:
         with settings(host_string=host):
             require.files.directory(os.path.join(instance.kraken_basedir, instance.name),
                                     owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
-            _upload_template("kraken/kraken.ini.jinja", "%s/%s/kraken.ini" %
+            host_changed = _upload_template("kraken/kraken.ini.jinja", "%s/%s/kraken.ini" %
                              (env.kraken_basedir, instance.name),
                              context={
                                  'env': env,
@@ -436,7 +1643,7 @@ def update_eng_instance_conf(instance, host=None):
             )
 
             if env.use_systemd:
-                _upload_template("kraken/systemd_kraken.jinja",
+                host_changed |= _upload_template("kraken/systemd_kraken.jinja",
                                  "{}".format(env.service_name('kraken_{}'.format(instance.name))),
                                  context={'env': env,
                                           'instance': instance.name,
@@ -445,7 +1652,7 @@ def update_eng_instance_conf(instance, host=None):
                                  mode='644'
                 )
             else:
-                _upload_template("kraken/kraken.initscript.jinja",
+                host_changed |= _upload_template("kraken/kraken.initscript.jinja",
                                  "{}".format(env.service_name('kraken_{}'.format(instance.name))),
                                  context={'env': env,
                                           'instance': instance.name,
@@ -455,58 +1662,100 @@ def update_eng_instance_conf(instance, host=None):
                 )
             # TODO check this, make it consistent with env.use_systemd
             update_init(host='eng')
+            if host_changed:
+                changed.append(host)
+    return changed
+
+
+def _create_eng_instance_on_host(instance):
+    """ create the kraken of an instance on the current host
+        :return: (state of the service, pid of the kraken or None)
+    """
+    # base_conf
+    require.files.directory(instance.kraken_basedir,
+                            owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
+    # logs
+    require.files.directory(env.kraken_log_basedir,
+                            owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
+
+    update_eng_instance_conf(instance, env.host_string)
+
+    # kraken.ini, pid and binary symlink
+    kraken_bin = "{}/{}/kraken".format(env.kraken_basedir, instance.name)
+    if not is_link(kraken_bin):
+        idempotent_symlink("/usr/bin/kraken", kraken_bin, use_sudo=True)
+        sudo('chown -h {user} {bin}'.format(user=env.KRAKEN_USER, bin=kraken_bin))
+
+    kraken = "kraken_{}".format(instance.name)
+    state = 'running'
+    if not service.is_running(kraken):
+        # TODO test this on systemd machines
+        if env.use_systemd:
+            sudo("systemctl enable kraken_{}.service".format(instance.name))
+        else:
+            sudo("update-rc.d kraken_{} defaults".format(instance.name))
+        # wait for the service to be running instead of a fixed delay
+        state, _ = control_services([kraken], 'start', only_once=env.KRAKEN_START_ONLY_ONCE)[kraken]
+
+    with settings(warn_only=True):
+        pid = run("pgrep --oldest --full {}".format(kraken_bin))
+    return state, int(pid) if pid.succeeded and pid.strip().isdigit() else None
 
 
 @task
 def create_eng_instance(instance):
-    """ Create a new kraken instance (idempotent)
+    """ Create a new kraken instance (idempotent), on all its engines at the same time
         * Install requirements
         * Deploy the binary, the templatized ini configuration in a dedicated
           directory with rights to www-data and the logdir
         * Deploy initscript and add it to startup
-        * Start the service
+        * Start the service, and check that the kraken is running
     """
     instance = get_real_instance(instance)
+    with time_that(blue("Kraken {} created in {{elapsed}}".format(instance.name))):
+        results = execute_parallel(_create_eng_instance_on_host, instance.kraken_engines, instance)
+    failed = []
     for host in instance.kraken_engines:
-        with settings(host_string=host):
-            # base_conf
-            require.files.directory(instance.kraken_basedir,
-                                    owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
-            # logs
-            require.files.directory(env.kraken_log_basedir,
-                                    owner=env.KRAKEN_USER, group=env.KRAKEN_USER, use_sudo=True)
+        state, pid = results.get(host) or ('failed', None)
+        if state == 'running' and pid:
+            print(green("INFO: kraken {} instance is running on {} (pid {})".format(
+                instance.name, get_host_addr(host), pid)))
+        else:
+            failed.append(host)
+            print(red("ERROR: kraken {} instance is not running on {} ({})".format(
+                instance.name, get_host_addr(host), state)))
+    return failed
 
-            update_eng_instance_conf(instance, host)
 
-            # kraken.ini, pid and binary symlink
-            kraken_bin = "{}/{}/kraken".format(env.kraken_basedir, instance.name)
-            if not is_link(kraken_bin):
-                idempotent_symlink("/usr/bin/kraken", kraken_bin, use_sudo=True)
-                sudo('chown -h {user} {bin}'.format(user=env.KRAKEN_USER, bin=kraken_bin))
-
-            kraken = "kraken_{}".format(instance.name)
-            if not service.is_running(kraken):
-                # TODO test this on systemd machines
-                if env.use_systemd:
-                    sudo("systemctl enable kraken_{}.service".format(instance.name))
-                else:
-                    sudo("update-rc.d kraken_{} defaults".format(instance.name))
-                print(blue("INFO: kraken {instance} instance is starting on {server}, "
-                           "waiting 5 seconds, we will check if processus is running"
-                    .format(instance=instance.name, server=get_host_addr(env.host_string))))
-                service.start(kraken)
-                run("sleep 5")  # we wait a bit for the kraken to pop
-
-            with settings(warn_only=True):
-                run("pgrep --list-name --full /srv/kraken/{}/kraken".format(instance.name))
-            print(blue("INFO: kraken {instance} instance is running on {server}".
-                       format(instance=instance.name, server=get_host_addr(host))))
+def _remove_kraken_instance_on_host(instance, purge_logs=False):
+    """ remove the kraken of an instance from the current host
+        :return: state of the service once stopped
+    """
+    with settings(warn_only=True):
+        kraken = 'kraken_{}'.format(instance.name)
+        # wait for the service to be stopped instead of a fixed delay
+        state, _ = control_services([kraken], 'stop')[kraken]
+        # TODO test this on systemd machines
+        if env.use_systemd:
+            run("systemctl disable kraken_{}.service".format(instance.name))
+            run('systemctl daemon-reload')
+            run("rm -f {}/kraken_{}.service".format(env.service_path(), instance.name))
+        else:
+            run("rm -f {}/kraken_{}".format(env.service_path(), instance.name))
+        run("rm -rf {}/{}/".format(env.kraken_basedir, instance.name))
+        # left by blue/green restarts, see restart_krakens_blue_green
+        for standby_name in _standby_names(instance.name):
+            run("rm -rf {}/{}/".format(env.kraken_basedir, standby_name))
+        if purge_logs:
+            run("rm -f {}".format(' '.join('{}/{}.log'.format(env.kraken_log_basedir, name)
+                                           for name in (instance.name,) + _standby_names(instance.name))))
+    return state
 
 
 @task
 def remove_kraken_instance(instance, purge_logs=False, apply_on='engines'):
     """
-    Remove a kraken instance entirely
+    Remove a kraken instance entirely, on all engines at the same time
       * Stop the service
       * Remove startup at boot time
       * Remove initscript
@@ -526,25 +1775,49 @@ def remove_kraken_instance(instance, purge_logs=False, apply_on='engines'):
     else:
         abort("Bad 'apply_on' parameter value: {}".format(apply_on))
 
-    for host in set(hosts) - set(exclude_hosts):
-        with settings(
-            host_string=host,
-            warn_only=True
-        ):
-            print("INFO: removing kraken instance {} from {}".format(instance.name, get_host_addr(host)))
+    hosts = sorted(set(hosts) - set(exclude_hosts))
+    for host in hosts:
+        print("INFO: removing kraken instance {} from {}".format(instance.name, get_host_addr(host)))
+    results = execute_parallel(_remove_kraken_instance_on_host, hosts, instance, purge_logs)
+    for host in hosts:
+        state = results.get(host)
+        if state == 'stopped':
+            print(green("INFO: kraken {} instance removed from {}".format(instance.name, get_host_addr(host))))
+        else:
+            print(yellow("WARNING: kraken {} instance removed from {}, but its service was not stopped ({})".format(
+                instance.name, get_host_addr(host), state)))
 
-            service.stop('kraken_{}'.format(instance.name))
-            run("sleep 3")
-            # TODO test this on systemd machines
-            if env.use_systemd:
-                run("systemctl disable kraken_{}.service".format(instance.name))
-                run('systemctl daemon-reload')
-                run("rm -f {}/kraken_{}.service".format(env.service_path(), instance.name))
-            else:
-                run("rm -f {}/kraken_{}".format(env.service_path(), instance.name))
-            run("rm -rf {}/{}/".format(env.kraken_basedir, instance.name))
-            if purge_logs:
-                run("rm -f {}/{}.log".format(env.kraken_log_basedir, instance.name))
+
+def _kraken_queues_to_delete(instances, apply_on):
+    """ names of the rabbitmq queues of the given instances, for the engines selected by apply_on
+    """
+    queues = []
+    for instance in instances:
+        if apply_on == 'engines':
+            hosts, exclude_hosts = instance.kraken_engines, ()
+        elif apply_on == 'reverse':
+            hosts, exclude_hosts = env.roledefs['eng'], instance.kraken_engines
+        elif apply_on == 'all':
+            hosts, exclude_hosts = env.roledefs['eng'], ()
+        else:
+            abort("Bad 'apply_on' parameter value: {}".format(apply_on))
+        for host in set(hosts) - set(exclude_hosts):
+            queues.extend(rabbitmq.kraken_queue_names(instance.name, host))
+    return queues
+
+
+def delete_kraken_queues(instances, apply_on='reverse'):
+    """ delete the existing queues of the instances in a single listing and concurrent deletions
+    """
+    admin = rabbitmq.RabbitMQAdmin(vhost=env.kraken_broker_vhost)
+    existing = set(q['name'] for q in admin.list_queues(prefix='kraken_'))
+    queues = [q for q in _kraken_queues_to_delete(instances, apply_on) if q in existing]
+    for queue, result in sorted(admin.delete_queues(queues).iteritems()):
+        if isinstance(result, Exception):
+            print(red("ERROR: could not delete queue {}: {}".format(queue, result)))
+        else:
+            print("INFO: queue {} deleted".format(queue))
+    return queues
 
 
 @task
@@ -552,29 +1825,7 @@ def delete_kraken_queue_to_rabbitmq(instance, apply_on='reverse'):
     """
     Remove queue for a kraken
     """
-    instance = get_real_instance(instance)
-    if apply_on == 'engines':
-        hosts, exclude_hosts = instance.kraken_engines, ()
-    elif apply_on == 'reverse':
-        hosts, exclude_hosts = env.roledefs['eng'], instance.kraken_engines
-    elif apply_on == 'all':
-        hosts, exclude_hosts = env.roledefs['eng'], ()
-    else:
-        abort("Bad 'apply_on' parameter value: {}".format(apply_on))
-
-    if env.rabbitmq_host_api == 'localhost':
-        host_string = env.roledefs['tyr_master'][0]
-    else:
-        host_string = env.rabbitmq_host_api
-
-    for host in set(hosts) - set(exclude_hosts):
-        with settings(host_string=host_string):
-            run('curl -i -u {}:{} -XDELETE "http://localhost:{}/api/queues/%2F/kraken_{}_{}_rt"'
-                .format(env.rabbitmq_user, env.rabbitmq_pass, env.rabbitmq_port_api,
-                        get_host_addr(host).split('.')[0], instance))
-            run('curl -i -u {}:{} -XDELETE "http://localhost:{}/api/queues/%2F/kraken_{}_{}_task"'
-                .format(env.rabbitmq_user, env.rabbitmq_pass, env.rabbitmq_port_api,
-                        get_host_addr(host).split('.')[0], instance))
+    delete_kraken_queues([get_real_instance(instance)], apply_on)
 
 
 @task
@@ -582,8 +1833,59 @@ def delete_all_kraken_queues_to_rabbitmq():
     """
     Remove all queues
     """
+    delete_kraken_queues(env.instances.values())
+
+
+def kraken_queue_policies():
+    """ the rabbitmq policies the kraken queues should have:
+        one for all krakens, and one with a higher priority per instance with overrides
+        :return: {policy name: (pattern, definition, priority)}
+    """
+    policies = {'kraken_queues': (rabbitmq.kraken_queue_pattern(), dict(env.kraken_queue_policy), 0)}
     for instance in env.instances.values():
-        execute(delete_kraken_queue_to_rabbitmq, instance.name)
+        if instance.kraken_queue_policy:
+            definition = dict(env.kraken_queue_policy)
+            definition.update(instance.kraken_queue_policy)
+            # a queue gets a single policy, the one of highest priority
+            definition = dict((k, v) for k, v in definition.iteritems() if v is not None)
+            policies['kraken_queues_' + instance.name] = (
+                rabbitmq.kraken_queue_pattern(instance.name), definition, 1)
+    return policies
+
+
+@task
+def update_kraken_queue_policies(check=False):
+    """ Declare or update the rabbitmq policies (max length, message TTL, lazy mode...) of the
+        rt and task queues of the krakens, see env.kraken_queue_policy.
+        :param check: only report the policies to update and the kraken queues without policy
+    """
+    check = get_bool_from_cli(check)
+    admin = rabbitmq.RabbitMQAdmin(vhost=env.kraken_broker_vhost)
+    expected = kraken_queue_policies()
+    existing = dict((name, p) for name, p in admin.list_policies().iteritems()
+                    if name == 'kraken_queues' or name.startswith('kraken_queues_'))
+    to_update = sorted(name for name, (pattern, definition, priority) in expected.iteritems()
+                       if name not in existing or (existing[name]['pattern'], existing[name]['definition'],
+                                                   existing[name]['priority']) != (pattern, definition, priority))
+    to_delete = sorted(set(existing) - set(expected))
+    for name in to_update:
+        print(yellow("policy {} {}: {}".format(name, 'to update' if check else 'updated', expected[name][1])))
+        if not check:
+            admin.put_policy(name, *expected[name])
+    for name in to_delete:
+        print(yellow("policy {} {}".format(name, 'to delete' if check else 'deleted')))
+        if not check:
+            admin.delete_policy(name)
+    if not to_update and not to_delete:
+        print(green("Kraken queue policies are up to date"))
+    if check:
+        pattern = re.compile(rabbitmq.kraken_queue_pattern())
+        orphans = [q['name'] for q in admin.list_queues(prefix='kraken_', columns=('name', 'policy'))
+                   if pattern.match(q['name']) and not q.get('policy')]
+        if orphans:
+            print(red("Kraken queues without policy: {}".format(', '.join(sorted(orphans)))))
+        else:
+            print(green("All kraken queues have a policy"))
 
 
 @task
@@ -598,8 +1900,7 @@ def is_not_synchronized(instance, hosts=None):
     hosts = [e.split('@')[1] for e in hosts or instance.kraken_engines]
     publication_dates = set()
     for host in hosts:
-        request = 'http://{}:{}/{}/?instance={}'.format(host,
-            env.kraken_monitor_port, env.kraken_monitor_location_dir, instance.name)
+        request = _monitor_url(host, instance.name)
         result = _test_kraken(request, fail_if_error=False)
         publication_dates.add(result.get('publication_date'))
 
@@ -629,6 +1930,207 @@ def check_kraken_data_synchronization():
         print(green('All krakens have synchronized data'))
 
 
+def plan_kraken_placement(mapping, memory, cpu, engines, max_moves=None, tolerance=None):
+    """
+    Balance the krakens over the engines, moving as few krakens as possible.
+    The load of an engine is the biggest of its share of the platform memory and of
+    its share of the platform queries. The most loaded engine gives one of its krakens
+    to another engine, the move that lowers the most the highest load first, as long as
+    both engines end up below the load of the most loaded engine minus 'tolerance'.
+    :param mapping: {instance name: [engine address, ...]}, current placement
+    :param memory: {instance name: memory used by one of its krakens}
+    :param cpu: {instance name: share of the queries of one of its krakens}
+    :param engines: list of the engine addresses
+    :param max_moves: max number of krakens moved, default is no limit
+    :param tolerance: min decrease of the highest load for a move, default is env.kraken_placement_tolerance
+    :return: (new mapping, [(instance name, from engine, to engine), ...])
+    """
+    tolerance = env.kraken_placement_tolerance if tolerance is None else tolerance
+    mapping = dict((name, list(hosts)) for name, hosts in mapping.iteritems())
+    total_memory = float(sum(memory.get(name, 0) * len(hosts) for name, hosts in mapping.iteritems()) or 1)
+    total_cpu = float(sum(cpu.get(name, 0) * len(hosts) for name, hosts in mapping.iteritems()) or 1)
+    usage = dict((engine, [0, 0]) for engine in engines)
+    for name, hosts in mapping.iteritems():
+        for host in hosts:
+            usage[host][0] += memory.get(name, 0)
+            usage[host][1] += cpu.get(name, 0)
+
+    def load(engine, name=None, sign=0):
+        return max((usage[engine][0] + sign * memory.get(name, 0)) / total_memory,
+                   (usage[engine][1] + sign * cpu.get(name, 0)) / total_cpu)
+
+    moves = []
+    while max_moves is None or len(moves) < int(max_moves):
+        worst = max(engines, key=load)
+        peak = load(worst)
+        best = None
+        for name in sorted(n for n, hosts in mapping.iteritems() if worst in hosts):
+            for target in engines:
+                if target in mapping[name]:
+                    continue
+                # both engines must end up clearly below the current peak, so that
+                # engines sharing the peak are relieved one after the other
+                moved = max(load(worst, name, -1), load(target, name, 1))
+                if moved >= peak - tolerance:
+                    continue
+                new_peak = max([moved] + [load(e) for e in engines if e not in (worst, target)])
+                if best is None or (new_peak, moved) < best[:2]:
+                    best = (new_peak, moved, name, target)
+        if best is None:
+            break
+        _, _, name, target = best
+        mapping[name][mapping[name].index(worst)] = target
+        usage[worst][0] -= memory.get(name, 0)
+        usage[worst][1] -= cpu.get(name, 0)
+        usage[target][0] += memory.get(name, 0)
+        usage[target][1] += cpu.get(name, 0)
+        # a kraken moved twice is a single move
+        previous = [m for m in moves if m[0] == name and m[2] == worst]
+        if previous:
+            moves.remove(previous[0])
+            worst = previous[0][1]
+        if worst != target:
+            moves.append((name, worst, target))
+    return mapping, moves
+
+
+def get_engines_load(mapping, memory, cpu, engines):
+    """ {engine address: (share of the platform memory, share of the platform queries)}
+    """
+    total_memory = float(sum(memory.get(name, 0) * len(hosts) for name, hosts in mapping.iteritems()) or 1)
+    total_cpu = float(sum(cpu.get(name, 0) * len(hosts) for name, hosts in mapping.iteritems()) or 1)
+    return dict((engine, (sum(memory.get(name, 0) for name, hosts in mapping.iteritems() if engine in hosts) /
+                          total_memory,
+                          sum(cpu.get(name, 0) for name, hosts in mapping.iteritems() if engine in hosts) /
+                          total_cpu))
+                for engine in engines)
+
+
+def _get_hardware():
+    """ (number of cores, RAM in bytes) of the current host
+    """
+    output = run_command_on_host(env.host_string, "nproc; awk '/^MemTotal:/ {print $2}' /proc/meminfo")
+    cores, ram = output.split()
+    return int(cores), int(ram) * 1024
+
+
+def get_engines_hardware(hosts=None):
+    """ {engine address: (number of cores, RAM in bytes)}, all engines at the same time
+    """
+    hosts = hosts or env.roledefs['eng']
+    return dict((get_host_addr(h), hardware) for h, hardware in execute_parallel(_get_hardware, hosts).iteritems())
+
+
+def plan_kraken_sizing(mapping, hardware, memory, sizes, shares):
+    """
+    Compute the number of threads and the raptor cache size of the krakens.
+    On each engine, the threads (env.kraken_cpu_ratio per core) and the RAM left by the
+    krakens (env.kraken_memory_ratio of the engine RAM minus their memory) are shared by
+    its krakens according to their query share. An instance gets the smallest values
+    of its engines, so that no engine is oversubscribed.
+    :param mapping: {instance name: [engine address, ...]}
+    :param hardware: {engine address: (cores, RAM in bytes)}
+    :param memory: {instance name: memory used by one of its krakens}
+    :param sizes: {instance name: size of its data.nav.lz4}, the cache size of instances
+                  without size is not computed
+    :param shares: {instance name: query share}
+    :return: {instance name: (nb threads, raptor cache size or None)}
+    """
+    sizing = {}
+    for engine, (cores, ram) in hardware.iteritems():
+        names = [name for name, hosts in mapping.iteritems() if engine in hosts]
+        total_share = float(sum(shares.get(name, 1) for name in names) or 1)
+        free = max(0, ram * env.kraken_memory_ratio - sum(memory.get(name, 0) for name in names))
+        for name in names:
+            share = shares.get(name, 1) / total_share
+            threads = max(1, int(cores * env.kraken_cpu_ratio * share))
+            cache = None
+            if sizes.get(name):
+                cache = int(free * share / (sizes[name] * env.kraken_raptor_entry_ratio))
+                cache = min(max(1, cache), env.kraken_raptor_cache_max)
+            if name in sizing:
+                old_threads, old_cache = sizing[name]
+                threads = min(threads, old_threads)
+                cache = min(cache, old_cache) if cache and old_cache else cache or old_cache
+            sizing[name] = (threads, cache)
+    return sizing
+
+
+@task
+def size_krakens(apply=False):
+    """ Compute the number of threads and the raptor cache size of every kraken from the
+        cores and RAM of the engines, the query_share of the instances and the size of their data.
+        Shows the old and new values, and with apply=True deploys them in the kraken.ini files
+        (the krakens must then be restarted, and the kraken_threads and cache_raptor
+        parameters of add_instance updated accordingly).
+    """
+    mapping = dict((name, instance.kraken_engines_url) for name, instance in env.instances.iteritems())
+    hardware = get_engines_hardware()
+    rss = get_krakens_rss()
+    sizes = get_data_nav_sizes(mapping)
+    memory = {}
+    for name, hosts in mapping.iteritems():
+        measured = [rss.get(h, {}).get(name) for h in hosts if rss.get(h, {}).get(name)]
+        memory[name] = sum(measured) / len(measured) if measured else sizes.get(name, 0) * env.kraken_lz4_memory_ratio
+    shares = dict((name, instance.query_share) for name, instance in env.instances.iteritems())
+    sizing = plan_kraken_sizing(mapping, hardware, memory, sizes, shares)
+    for engine, (cores, ram) in sorted(hardware.iteritems()):
+        print(blue("{}: {} cores, {} MB".format(engine, cores, ram / 1024 / 1024)))
+    changed = []
+    for name, (threads, cache) in sorted(sizing.iteritems()):
+        instance = env.instances[name]
+        cache = cache or instance.cache_raptor
+        line = "{}: nb_threads {} -> {}, raptor_cache_size {} -> {}".format(
+            name, instance.kraken_nb_threads, threads, instance.cache_raptor or 'default', cache or 'default')
+        if (threads, cache) != (instance.kraken_nb_threads, instance.cache_raptor):
+            print(yellow(line))
+            changed.append((instance, threads, cache))
+        else:
+            print(line)
+    if not changed:
+        print(green("Krakens are correctly sized"))
+        return
+    if not get_bool_from_cli(apply):
+        print(blue("Use apply=True to deploy the new values"))
+        return
+    for instance, threads, cache in changed:
+        instance.kraken_nb_threads, instance.cache_raptor = threads, cache
+        update_eng_instance_conf(instance)
+    print(yellow("kraken.ini updated for {}, restart the krakens to use them".format(
+        ', '.join(i.name for i, _, _ in changed))))
+
+
+@task
+def kraken_inventory(sort='rss', output=None):
+    """ Inventory of the kraken processes of all engines: pid, RSS, CPU time, threads and start time,
+        ranked by memory (sort='rss') or CPU time (sort='cpu').
+        A kraken whose RSS exceeds env.kraken_lz4_memory_ratio times its data.nav.lz4 is highlighted,
+        it may leak memory between data updates.
+        :param output: also write the inventory to this JSON file
+    """
+    if sort not in ('rss', 'cpu'):
+        abort(yellow("Error: sort parameter must be 'rss' or 'cpu', found '{}'".format(sort)))
+    processes = sorted(get_krakens_processes(), key=lambda p: (p[sort], p['rss' if sort == 'cpu' else 'cpu']),
+                       reverse=True)
+    sizes = get_data_nav_sizes(set(p['instance'] for p in processes if p['instance'] in env.instances))
+    print("{:<20} {:<25} {:>7} {:>9} {:>10} {:>6} {:>7} {:>19}".format(
+        'instance', 'host', 'pid', 'rss (MB)', 'cpu (s)', 'cpu %', 'threads', 'started'))
+    for process in processes:
+        size = sizes.get(process['instance'])
+        process['data_size'] = size
+        line = "{:<20} {:<25} {:>7} {:>9} {:>10} {:>6.1f} {:>7} {:>19}".format(
+            process['instance'] + (' (standby)' if process['standby'] else ''), process['host'], process['pid'],
+            process['rss'] / 1024 / 1024, process['cpu'], 100.0 * process['cpu'] / max(process['uptime'], 1),
+            process['threads'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(process['start'])))
+        print(yellow(line) if size and process['rss'] > size * env.kraken_lz4_memory_ratio else line)
+    print(blue("{} krakens, {} MB".format(len(processes), sum(p['rss'] for p in processes) / 1024 / 1024)))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(processes, f, indent=2)
+        print(blue("Inventory written to {}".format(output)))
+    return processes
+
+
 @task
 def redeploy_kraken(instance, create=True):
     """
@@ -0,0 +1,158 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of fabric_navitia, the provisioning and deployment tool
+#     of Navitia, the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+"""
+Client of the RabbitMQ management HTTP API (env.rabbitmq_host_api:env.rabbitmq_port_api)
+"""
+import base64
+import re
+import urllib
+
+import requests
+from requests.adapters import HTTPAdapter
+from fabric.api import env
+
+# WARNING: the way fabric_navitia imports are done as a strong influence
+#          on the resulting naming of tasks, wich can break integration tests
+from fabfile.utils import get_host_addr, Parallel
+
+
+class RabbitMQAdmin(object):
+    """
+    Keep-alive session on the management API of a RabbitMQ server
+    """
+    def __init__(self, host=None, port=None, user=None, password=None, vhost='/', pool_size=None, timeout=None):
+        """
+        Parameters default to the env.rabbitmq_* settings. When env.rabbitmq_host_api is
+        'localhost', the API of tyr_master is used.
+        """
+        host = host or env.rabbitmq_host_api
+        if host == 'localhost':
+            host = get_host_addr(env.roledefs['tyr_master'][0])
+        self.base_url = 'http://{}:{}/api'.format(host, port or env.rabbitmq_port_api)
+        self.vhost = vhost
+        self.pool_size = pool_size or env.rabbitmq_api_pool_size
+        self.timeout = timeout or env.rabbitmq_api_timeout
+        self.session = requests.Session()
+        self.session.auth = (user or env.rabbitmq_user, password or env.rabbitmq_pass)
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+
+    def _url(self, *path):
+        return '/'.join([self.base_url] + [urllib.quote(p, safe='') for p in path])
+
+    def _request(self, method, path, expected=(200, 201, 204), **kwargs):
+        response = self.session.request(method, self._url(*path), timeout=self.timeout, **kwargs)
+        if response.status_code not in expected:
+            raise RuntimeError("RabbitMQ API {} {} failed: {} {}".format(
+                method, '/'.join(path), response.status_code, response.text))
+        return response
+
+    def list_queues(self, prefix=None, columns=('name', 'messages', 'consumers')):
+        """ all the queues of the vhost in a single call
+            :param prefix: only keep the queues whose name starts with prefix
+            :return: list of dicts with the given columns
+        """
+        response = self._request('GET', ('queues', self.vhost), params={'columns': ','.join(columns)})
+        return [q for q in response.json() if not prefix or q['name'].startswith(prefix)]
+
+    def delete_queue(self, name):
+        """ :return: True if the queue was deleted, False if it does not exist
+        """
+        return self._request('DELETE', ('queues', self.vhost, name), expected=(204, 404)).status_code == 204
+
+    def _concurrently(self, func, items):
+        """ call func on all items, with at most self.pool_size requests at the same time
+            :return: {item: result of func, or the error}
+        """
+        items = list(items)
+        if not items:
+            return {}
+
+        def call(item):
+            try:
+                return func(item)
+            except Exception as e:
+                return e
+
+        with Parallel(min(len(items), self.pool_size)) as pool:
+            results = pool.map(call, items)
+        return dict(zip(items, results))
+
+    def delete_queues(self, names):
+        """ delete queues concurrently
+            :return: {queue name: True if deleted, False if it did not exist, or the error}
+        """
+        return self._concurrently(self.delete_queue, names)
+
+    def publish(self, exchange, routing_key, payload):
+        """ publish a message on an exchange of the vhost
+            :return: True if the message was routed to at least one queue
+        """
+        response = self._request('POST', ('exchanges', self.vhost, exchange, 'publish'), json={
+            'properties': {}, 'routing_key': routing_key,
+            'payload': base64.b64encode(payload), 'payload_encoding': 'base64'})
+        return response.json()['routed']
+
+    def publish_all(self, exchange, messages):
+        """ publish messages concurrently
+            :param messages: {routing key: payload}
+            :return: {routing key: True if routed, False if not, or the error}
+        """
+        return self._concurrently(lambda key: self.publish(exchange, key, messages[key]), messages)
+
+    def list_policies(self):
+        """ :return: {policy name: policy dict} of the vhost
+        """
+        return dict((p['name'], p) for p in self._request('GET', ('policies', self.vhost)).json())
+
+    def put_policy(self, name, pattern, definition, priority=0, apply_to='queues'):
+        """ create or update a policy of the vhost
+        """
+        self._request('PUT', ('policies', self.vhost, name), json={
+            'pattern': pattern, 'definition': definition, 'priority': priority, 'apply-to': apply_to})
+
+    def delete_policy(self, name):
+        self._request('DELETE', ('policies', self.vhost, name), expected=(204, 404))
+
+
+def kraken_queue_names(instance_name, host):
+    """ names of the rt and task queues of a kraken
+    """
+    prefix = 'kraken_{}_{}'.format(get_host_addr(host).split('.')[0], instance_name)
+    return [prefix + '_rt', prefix + '_task']
+
+
+def kraken_queue_pattern(instance_name=None):
+    """ regex matching the rt and task queues of the krakens of an instance, or of all krakens
+    """
+    if instance_name is None:
+        return r'^kraken_.+_(rt|task)$'
+    return r'^kraken_[^_]+_{}_(rt|task)$'.format(re.escape(instance_name))
@@ -32,6 +32,8 @@
 import StringIO
 import ConfigParser
 from io import BytesIO
+import datetime
+import multiprocessing
 import os
 from retrying import Retrying, RetryError
 import time
@@ -48,17 +50,19 @@ from fabtools import require, python, files
 #          on the resulting naming of tasks, wich can break integration tests
 import fabfile.component as component
 from fabfile.component import db, load_balancer
+from fabfile import binarization, history, journal
 from fabfile.utils import (_install_packages, _upload_template, update_init, Parallel,
                            start_or_stop_with_delay, supervision_downtime, time_that,
                            get_real_instance, require_directories, require_directory,
                            run_once_per_host, execute_flat, idempotent_symlink, collapse_op,
-                           get_processes, get_bool_from_cli, watchdog_manager, restart_apache)
+                           get_processes, get_bool_from_cli, watchdog_manager, restart_apache,
+                           control_services, changed_on_any_host, execute_parallel)
 
 
 @task
 @roles('tyr')
 def update_tyr_config_file():
-    _upload_template("tyr/settings.py.jinja", env.tyr_settings_file,
+    changed = _upload_template("tyr/settings.py.jinja", env.tyr_settings_file,
                      context={
                         'env': env,
                         'tyr_broker_username': env.tyr_broker_username,
@@ -76,10 +80,11 @@ def update_tyr_config_file():
                         'tyr_redis_password': env.tyr_redis_password,
                         'tyr_redis_db': env.tyr_redis_db
                      })
-    _upload_template('tyr/tyr.wsgi.jinja', env.tyr_wsgi_file,
+    changed |= _upload_template('tyr/tyr.wsgi.jinja', env.tyr_wsgi_file,
                      context={
                          'tyr_settings_file': env.tyr_settings_file
                      })
+    return changed
 
 
 @task
@@ -180,9 +185,8 @@ def upgrade_tyr_packages():
 def upgrade_db_tyr(pilot_tyr_beat=True):
     with cd(env.tyr_basedir), shell_env(TYR_CONFIG_FILE=env.tyr_settings_file), settings(user=env.KRAKEN_USER):
         run('python manage.py db upgrade')
-    if pilot_tyr_beat:
-        require.service.start('tyr_beat')
-    require.service.start('tyr_worker')
+    control_services(['tyr_beat', 'tyr_worker'] if pilot_tyr_beat else ['tyr_worker'], 'start',
+                     only_once=env.TYR_START_ONLY_ONCE)
 
 
 @task
@@ -320,8 +324,7 @@ def restart_tyr_beat():
 @roles('tyr')
 def start_services():
     require.postgres.server()
-    require.service.started('rabbitmq-server')
-    require.service.started('redis-server')
+    control_services(['rabbitmq-server', 'redis-server'], 'start')
 
 
 @task
@@ -406,8 +409,14 @@ def get_tyr_config(instance):
 @task
 @roles('tyr_master')
 @run_once_per_host
-def launch_rebinarization_upgrade(pilot_supervision=True, pilot_tyr_beat=True, instances=None):
-    """launch binarization on all instances for the upgrade"""
+def launch_rebinarization_upgrade(pilot_supervision=True, pilot_tyr_beat=True, instances=None, on_success=None,
+                                  resume=False):
+    """launch binarization on all instances for the upgrade
+       on_success(instance name) is called as soon as the binarization of an instance succeeds
+       resume: skip the ed migrations and binarizations already recorded in the upgrade journal
+       (see fabfile.journal), the upgrade recorded is started by upgrade_all
+    """
+    resume = get_bool_from_cli(resume)
     if pilot_supervision:
         supervision_downtime(step='tyr_beat')
         supervision_downtime(step='bina')
@@ -431,15 +440,27 @@ def launch_rebinarization_upgrade(pilot_supervision=True, pilot_tyr_beat=True, i
             instances2process = set(env.instances)
         else:
             instances2process = set(instances)
+        done = journal.completed() if resume else {}
+
+        records = []
 
         def binarize_instance(i_name):
             with time_that(blue("Binarization of " + i_name + " completed in {elapsed}")):
                 if i_name in env.excluded_instances:
                     print(blue("NOTICE: instance {} has been excluded, skipping it".format(i_name)))
                     instances2process.remove(i_name)
-                elif launch_rebinarization(i_name, True):
-                    # remove instance only if bina succeeds
-                    instances2process.remove(i_name)
+                else:
+                    start = time.time()
+                    success = bool(launch_rebinarization(i_name, True))
+                    records.append(dict(instance=i_name, host=env.roledefs['tyr_master'][0],
+                                        elapsed=time.time() - start, success=success,
+                                        input_size=sizes.get(i_name)))
+                    if success:
+                        # remove instance only if bina succeeds
+                        instances2process.remove(i_name)
+                        journal.record(i_name, 'binarization')
+                        if on_success:
+                            on_success(i_name)
             # print instances not yet binarized, this allows to easily resume the binarization
             # process in case of crash or freeze (use include:x,y,z,....)
             # see http://jira.canaltp.fr/browse/DEVOP-408
@@ -465,20 +486,159 @@ def launch_rebinarization_upgrade(pilot_supervision=True, pilot_tyr_beat=True, i
                             abort(red("aborted"))
                         break
 
-        for instance in instances2process:
-            update_ed_db(instance)
+        for instance in sorted(instances2process):
+            if journal.is_done(done, instance, 'binarization'):
+                print(blue("NOTICE: instance {} is already binarized, skipping it".format(instance)))
+                instances2process.remove(instance)
+            elif not journal.is_done(done, instance, 'ed_migration'):
+                update_ed_db(instance)
+                journal.record(instance, 'ed_migration')
+        # longest binarizations first, so that the last ones to finish are short
+        sizes = get_last_datasets_size(instances2process)
+        predictions = binarization.predict_durations(instances2process, history.get_binarization_durations(), sizes)
+        order = binarization.longest_first(predictions)
+        print(blue("Binarization order: {}".format(','.join(order))))
         run_watchdog = True
-        with watchdog_manager(bina_watchdog):
-            # run the bina in parallel (if you want sequential, set env.nb_thread_for_bina = 1)
-            with Parallel(env.nb_thread_for_bina) as pool:
-                pool.map(binarize_instance, instances2process)
-            run_watchdog = False
+        start = time.time()
+        concurrency = None
+        slots = {env.roledefs['tyr_master'][0]: env.nb_thread_for_bina}
+        if env.bina_adaptive and not env.bina_distributed:
+            concurrency = binarization.AdaptiveConcurrency(env.bina_min_thread, env.bina_max_thread,
+                                                           env.nb_thread_for_bina)
+            # forked before the watchdog and the binarization threads start
+            concurrency.start_sampler(env.roledefs['tyr_master'], env.roledefs['db'])
+        try:
+            with watchdog_manager(bina_watchdog):
+                if env.bina_distributed:
+                    for i_name in set(order) & set(env.excluded_instances):
+                        print(blue("NOTICE: instance {} has been excluded, skipping it".format(i_name)))
+                        instances2process.remove(i_name)
+                        order.remove(i_name)
+                    slots = {host: env.bina_slots.get(host, env.nb_thread_for_bina) for host in env.roledefs['tyr']}
+                    assignment = binarization.assign_slots(predictions, order, slots)
+                    for host in sorted(assignment):
+                        print(blue("Binarizations on {}: {}".format(host, ','.join(assignment[host]))))
+                    # the host processes send each binarization record as soon as it is done
+                    completed = multiprocessing.Queue()
+
+                    def collect_binarizations():
+                        for record in iter(completed.get, None):
+                            records.append(record)
+                            if record['success']:
+                                # remove instance only if bina succeeds
+                                instances2process.remove(record['instance'])
+                                journal.record(record['instance'], 'binarization')
+                                if on_success:
+                                    on_success(record['instance'])
+                            print(blue("Instances left: {}".format(','.join(instances2process))))
+
+                    with watchdog_manager(collect_binarizations):
+                        try:
+                            with warn_only():
+                                results = execute_parallel(binarize_instances_on_host, env.roledefs['tyr'],
+                                                           assignment, sizes, completed)
+                        finally:
+                            completed.put(None)
+                    for host, result in results.iteritems():
+                        if not isinstance(result, list):
+                            print(red("ERROR: binarizations failed on {}: {}".format(host, result)))
+                elif concurrency:
+                    with watchdog_manager(concurrency.watch):
+                        try:
+                            binarization.run_adaptive(binarize_instance, order, concurrency)
+                        finally:
+                            concurrency.stop()
+                else:
+                    # run the bina in parallel (if you want sequential, set env.nb_thread_for_bina = 1)
+                    with Parallel(env.nb_thread_for_bina) as pool:
+                        for _ in pool.imap_unordered(binarize_instance, order):
+                            pass
+                run_watchdog = False
+        finally:
+            if concurrency:
+                concurrency.stop()
+            history.record_binarizations(records)
+            print_binarization_report(predictions, order, records, time.time() - start, slots, concurrency)
         return tuple(instances2process)
     finally:
         if pilot_tyr_beat:
             start_tyr_beat()
 
 
+def binarize_instances_on_host(assignment, sizes, completed=None):
+    """ binarize the instances assigned to env.host_string, see execute_parallel
+        :param assignment: {host: [instance names]}
+        :param sizes: {instance name: size of its last dataset}
+        :param completed: queue receiving each binarization record as soon as it is done
+        :return: the binarization records (see history.record_binarizations)
+    """
+    records = []
+
+    def binarize_instance(i_name):
+        start = time.time()
+        success = bool(launch_rebinarization(i_name, True))
+        records.append(dict(instance=i_name, host=env.host_string, elapsed=time.time() - start,
+                            success=success, input_size=sizes.get(i_name)))
+        if completed is not None:
+            completed.put(records[-1])
+        print((blue if success else red)("Binarization of {} {} on {} in {}".format(
+            i_name, 'completed' if success else 'failed', env.host_string,
+            datetime.timedelta(seconds=int(records[-1]['elapsed'])))))
+
+    with Parallel(env.bina_slots.get(env.host_string, env.nb_thread_for_bina)) as pool:
+        for _ in pool.imap_unordered(binarize_instance, assignment.get(env.host_string, [])):
+            pass
+    return records
+
+
+def get_last_datasets_size(instance_names):
+    """ :return: {instance name: size in bytes of the last dataset backuped by tyr}
+        instances without backup are missing
+    """
+    if not instance_names:
+        return {}
+    script = ' ; '.join(
+        'echo {} $(du -sb $(ls -td {}/*/ 2>/dev/null | head -1) 2>/dev/null | cut -f1)'.format(
+            name, get_real_instance(name).backup_dir) for name in instance_names)
+    with settings(host_string=env.roledefs['tyr_master'][0]), hide('output'), warn_only():
+        output = run(script)
+    sizes = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[1].isdigit():
+            sizes[fields[0]] = int(fields[1])
+    return sizes
+
+
+def print_binarization_report(predictions, order, records, elapsed, slots, concurrency=None):
+    """ print the predicted and actual durations of the binarizations of an upgrade,
+        and the changes of the number of parallel binarizations if it was adaptive
+        :param slots: {host: number of parallel binarizations}, unless concurrency is given
+        :param concurrency: the binarization.AdaptiveConcurrency of an adaptive run
+    """
+    actual = {r['instance']: r for r in records}
+    print(blue("{:<30} {:<20} {:>10} {:>10}".format('instance', 'host', 'predicted', 'actual')))
+    for name in order:
+        record = actual.get(name, {})
+        print("{:<30} {:<20} {:>10} {:>10}".format(
+            name, record.get('host', '-'), int(predictions[name]),
+            int(record['elapsed']) if record else '-'))
+    if concurrency:
+        # the number of threads moved between the bounds of the adaptive concurrency
+        print(blue("Binarization makespan: predicted {}s with {} thread(s) to {}s with {}, actual {}s".format(
+            int(binarization.predict_makespan(predictions, order, concurrency.minimum)), concurrency.minimum,
+            int(binarization.predict_makespan(predictions, order, concurrency.maximum)), concurrency.maximum,
+            int(elapsed))))
+        changes = [d for d in concurrency.decisions if d[1] != d[2]]
+        print(blue("Binarization concurrency: {} decisions, {} changes{}".format(
+            len(concurrency.decisions), len(changes),
+            ''.join(" {} {}->{} {}".format(*d) for d in changes))))
+    else:
+        print(blue("Binarization makespan: predicted {}s with {} thread(s), actual {}s".format(
+            int(binarization.predict_makespan(predictions, order, sum(slots.values()))),
+            sum(slots.values()), int(elapsed))))
+
+
 @task
 @roles('tyr_master')
 @run_once_per_host
@@ -600,10 +760,13 @@ def test_tyr_backup_file_presence():
 
 @task
 def update_tyr_confs():
-    execute_flat(update_tyr_config_file)
+    """ :return: True if the configuration of the tyr workers changed on a host
+    """
+    changed = changed_on_any_host(execute_flat(update_tyr_config_file))
     for instance in env.instances.values():
-        execute_flat(update_tyr_instance_conf, instance)
+        changed |= changed_on_any_host(execute_flat(update_tyr_instance_conf, instance))
     execute(update_cities_conf)
+    return changed
 
 
 @task
@@ -619,7 +782,9 @@ def update_cities_conf():
 @task
 @roles('tyr')
 def update_tyr_instance_conf(instance):
-    _upload_template("tyr/instance.ini.jinja",
+    """ :return: True if the instance configuration of the tyr workers changed
+    """
+    changed = _upload_template("tyr/instance.ini.jinja",
                      "{}/{}.ini".format(env.tyr_base_instances_dir, instance.name),
                      context={
                          'env': env,
@@ -647,6 +812,8 @@ def update_tyr_instance_conf(instance):
                          'instance': instance,
                      },
     )
+    # the alembic and settings.sh files are not used by the workers
+    return changed
 
 
 @task
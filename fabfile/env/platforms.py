@@ -91,6 +91,14 @@ env.KRAKEN_RABBITMQ_WRONG_PORT = 56722
 env.PUPPET_RESTART_DELAY = 30
 # max time (in s) that a kraken can take to restart
 env.KRAKEN_RESTART_DELAY = 90
+# max number of krakens restarting at the same time on an engine and on the whole
+# platform (see restart_all_krakens)
+env.KRAKEN_RESTART_MAX_PER_ENGINE = 2
+env.KRAKEN_RESTART_MAX_TOTAL = 8
+# bounds (in s) of the time given to a kraken to load, when its expected load time
+# is known (see KrakenReadiness), else KRAKEN_RESTART_DELAY applies
+env.KRAKEN_READY_MIN_DELAY = 10
+env.KRAKEN_READY_MAX_DELAY = 600
 env.TYR_WORKER_START_DELAY = 10
 env.APACHE_START_DELAY = 8
 env.KRAKEN_START_ONLY_ONCE = True
@@ -139,6 +147,14 @@ env.KRAKEN_RE_PORT = re.compile('^tcp://.*\:(?P<port>[0-9]*)')
 
 # kraken.ini defaults number of thread for an instance
 env.KRAKEN_NB_THREADS = 4
+# automatic sizing of the krakens (see size_krakens): the threads of an engine
+# (kraken_cpu_ratio per core) and the RAM left by the krakens (kraken_memory_ratio
+# of the engine RAM) are shared by its krakens according to their query_share.
+# A raptor cache entry is estimated to kraken_raptor_entry_ratio * size of data.nav.lz4
+env.kraken_cpu_ratio = 1.0
+env.kraken_memory_ratio = 0.8
+env.kraken_raptor_entry_ratio = 0.5
+env.kraken_raptor_cache_max = 20
 env.KRAKEN_START_PORT = 30000
 
 env.AT_BASE_LOGDIR = '/var/log/connectors-rt'
@@ -180,6 +196,17 @@ env.rabbitmq_host = 'localhost'
 env.rabbitmq_port = 5672
 env.rabbitmq_host_api = 'localhost'
 env.rabbitmq_port_api = 15672
+# restarts of realtime krakens are delayed while their rt queue holds more than
+# kraken_rt_backlog_threshold messages (None to disable), at most kraken_rt_backlog_max_wait s
+env.kraken_rt_backlog_threshold = 50000
+env.kraken_rt_backlog_max_wait = 300
+env.kraken_rt_backlog_poll = 5
+# rabbitmq policy of the rt and task queues of the krakens (see update_kraken_queue_policies),
+# it can be overridden for an instance with the kraken_queue_policy parameter of add_instance
+env.kraken_queue_policy = {'max-length': 100000, 'message-ttl': 24 * 3600 * 1000, 'queue-mode': 'lazy'}
+# concurrent requests and timeout (in s) of the management API client (see component.rabbitmq)
+env.rabbitmq_api_pool_size = 16
+env.rabbitmq_api_timeout = 10
 
 env.stat_broker_exchange = 'stat_persistor_exchange'
 
@@ -326,6 +353,10 @@ env.kraken_monitor_listen_port = env.kraken_monitor_port
 env.kraken_monitor_basedir = '/srv/monitor'
 env.kraken_monitor_wsgi_file = os.path.join(env.kraken_monitor_basedir, 'monitor.wsgi')
 env.kraken_monitor_config_file = os.path.join(env.kraken_monitor_basedir, 'settings.py')
+# monitor sweeps (see probe_krakens): max number of requests in flight and
+# timeout (in s) of a single request
+env.kraken_monitor_pool_size = 64
+env.kraken_monitor_timeout = 2
 
 env.feed_publisher = False
 
@@ -393,6 +424,33 @@ env.dry_run = False
 #number of parallele binarization
 env.nb_thread_for_bina = 1
 env.acceptable_bina_fail_rate = 0.08
+# the upgrade binarizations are launched longest first: an instance is expected to take the median
+# of its last bina_history binarizations (see env.kraken_history_file), or else the size of its
+# last dataset / bina_input_rate (MB/s, calibrated on the instances with a history when possible)
+env.bina_history = 5
+env.bina_input_rate = 1
+# if True, the number of parallel upgrade binarizations starts at nb_thread_for_bina and follows the
+# load of the tyr and db hosts, sampled every bina_sample_interval seconds, between bina_min_thread
+# and bina_max_thread: it shrinks if a host has a load average per cpu over bina_max_load, less than
+# bina_min_free_memory MB available or more than bina_max_pg_backends active postgres backends,
+# it grows if all the hosts are under bina_grow_ratio of these limits
+env.bina_adaptive = False
+env.bina_min_thread = 1
+env.bina_max_thread = 4
+env.bina_sample_interval = 60
+env.bina_max_load = 1.0
+env.bina_min_free_memory = 2048
+env.bina_max_pg_backends = 20
+env.bina_grow_ratio = 0.7
+# if True, the upgrade binarizations are spread on all the tyr hosts (not only tyr_master), which
+# must share the ed directories; bina_slots gives the number of parallel binarizations per host,
+# nb_thread_for_bina for the hosts not listed, eg: {'root@tyr2': 2}
+env.bina_distributed = False
+env.bina_slots = {}
+# number of instances swapped, restarted and tested at the same time by the pipelined upgrade
+# (fab upgrade_all:pipeline=True), as soon as their binarization succeeds; their krakens are
+# restarted one instance at a time, within the limits of the kraken restarts
+env.upgrade_lanes = 2
 
 #instances configurations
 env.instances = {}
@@ -400,12 +458,73 @@ env.instances = {}
 # threshold for kraken update abort
 env.kraken_threshold = 0.15
 
+# min decrease of the highest engine load (share of the platform memory or queries)
+# for place_krakens to move a kraken
+env.kraken_placement_tolerance = 0.02
+
+# memory (in MB) that restarting krakens may use on an engine, None to disable
+# the memory planning of restart_all_krakens
+env.kraken_memory_budget = None
+# expected ratio between the memory used by a kraken and the size of its data.nav.lz4
+env.kraken_lz4_memory_ratio = 4
+
+# a kraken is given kraken_ready_margin times its expected load time, that is the median of
+# its last kraken_ready_history loads, or else the size of its data.nav.lz4 / kraken_load_rate (MB/s)
+env.kraken_ready_margin = 2
+env.kraken_ready_history = 5
+env.kraken_load_rate = 20
+# polling period (in s) of the monitor while a kraken loads, growing from min to max
+env.kraken_poll_min = 0.5
+env.kraken_poll_max = 5
+
+# restart the krakens without downtime: a standby kraken loads the new data on another socket
+# while the old one keeps serving, then takes its socket (ipc zmq sockets and init scripts only).
+# An engine needs kraken_blue_green_margin times the memory of its standby krakens available.
+env.kraken_blue_green = False
+env.kraken_blue_green_margin = 1.2
+
+# canary of the kraken restarts: once the first kraken of a coverage is restarted, its p50 and p95
+# latencies through jormungandr (kraken_canary_repeat times kraken_canary_size places and journeys
+# requests, or the canary_queries of the instance) are compared to the ones measured before the
+# restart. If one is kraken_canary_ratio times and kraken_canary_min_increase seconds worse, or if
+# kraken_canary_ratio times and at least kraken_canary_min_errors more requests fail, the other krakens
+# of the coverage are not restarted, and the coverage is rolled back if kraken_canary_rollback
+env.kraken_canary = False
+env.kraken_canary_size = 3
+env.kraken_canary_repeat = 5
+env.kraken_canary_ratio = 1.5
+env.kraken_canary_min_increase = 0.05
+env.kraken_canary_min_errors = 3
+env.kraken_canary_timeout = 10
+env.kraken_canary_rollback = False
+
+# read the data files into the page cache of the engines before restarting the krakens,
+# kraken_prewarm_parallel files at a time on each engine. The time spent reading the data file of an
+# instance is written in kraken_prewarm_log, where {instance} is replaced by the instance name
+env.kraken_prewarm = False
+env.kraken_prewarm_parallel = 2
+env.kraken_prewarm_log = '/tmp/kraken_prewarm_{instance}.log'
+
+# local SQLite file where the load times of the krakens are recorded, None to disable
+env.kraken_history_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                       'kraken_history.sqlite')
+
+# local append-only journal of the steps completed by each instance during an upgrade, read by
+# upgrade_all:resume=True to skip them after an interruption, None to disable
+env.upgrade_journal_file = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                        'upgrade_journal.jsonl')
+
 # those 3 strings template will be formated with base = tyr base directory and instance = name of the instance
 env.tyr_backup_dir_template = '{base}/{instance}/backup'
 env.tyr_source_dir_template = '{base}/{instance}/source'
 env.tyr_destination_dir_template = '{base}/destination'
 
 env.kraken_database_file = '{base_dest}/{instance}/data.nav.lz4'
+# copy the data file of each kraken on the local disk of its engine before restarting it,
+# instead of loading it from kraken_database_file (the kraken configuration must then be updated)
+env.kraken_local_staging = False
+# bandwidth limit of each engine while copying data files, in KB/s
+env.kraken_staging_bwlimit = 100000
 
 #in general we don't want to configure apache
 env.setup_apache = False
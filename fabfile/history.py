@@ -0,0 +1,197 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of fabric_navitia, the provisioning and deployment tool
+#     of Navitia, the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+"""
+Local history of the kraken load times, stored in a SQLite file (env.kraken_history_file).
+Each restart of a kraken records how long it took to go from stop to 'loaded'.
+The durations of the upgrade binarizations are stored in the same file.
+"""
+
+from contextlib import closing
+import datetime
+import os.path
+import sqlite3
+
+from fabric.api import env
+
+# identifies the records of the current fabric run
+RUN_ID = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kraken_load (
+    run TEXT NOT NULL,
+    date TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    host TEXT NOT NULL,
+    elapsed REAL NOT NULL,
+    loaded INTEGER NOT NULL,
+    data_size INTEGER,
+    kraken_version TEXT,
+    prewarm REAL
+);
+CREATE INDEX IF NOT EXISTS kraken_load_instance ON kraken_load (instance, date);
+CREATE TABLE IF NOT EXISTS binarization (
+    run TEXT NOT NULL,
+    date TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    host TEXT,
+    elapsed REAL NOT NULL,
+    success INTEGER NOT NULL,
+    input_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS binarization_instance ON binarization (instance, date);
+"""
+
+COLUMNS = ('run', 'date', 'instance', 'host', 'elapsed', 'loaded', 'data_size', 'kraken_version', 'prewarm')
+
+BINARIZATION_COLUMNS = ('run', 'date', 'instance', 'host', 'elapsed', 'success', 'input_size')
+
+# columns added after the first version of the schema
+ADDED_COLUMNS = (('prewarm', 'REAL'),)
+
+
+def _connect(path=None):
+    connection = sqlite3.connect(path or env.kraken_history_file)
+    connection.executescript(SCHEMA)
+    existing = set(row[1] for row in connection.execute("PRAGMA table_info(kraken_load)"))
+    for name, kind in ADDED_COLUMNS:
+        if name not in existing:
+            connection.execute("ALTER TABLE kraken_load ADD COLUMN {} {}".format(name, kind))
+    return connection
+
+
+def record_kraken_loads(records, path=None):
+    """ store load records, a list of dicts with keys instance, host, elapsed (seconds),
+        loaded (bool), data_size (bytes or None), kraken_version (or None) and
+        prewarm (seconds spent reading the data file before the restart, or None)
+        Nothing is stored if env.kraken_history_file is not set.
+    """
+    if not records or not (path or env.kraken_history_file):
+        return
+    now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    with closing(_connect(path)) as connection, connection:
+        connection.executemany(
+            "INSERT INTO kraken_load ({}) VALUES ({})".format(', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+            [(RUN_ID, now, r['instance'], r['host'], r['elapsed'], bool(r['loaded']),
+              r.get('data_size'), r.get('kraken_version'), r.get('prewarm')) for r in records])
+
+
+def get_kraken_loads(instance=None, path=None):
+    """ :return: {instance: [record, ...]}, records as dicts, oldest first.
+        Empty if there is no history file.
+    """
+    if not os.path.exists(path or env.kraken_history_file or ''):
+        return {}
+    query = "SELECT {} FROM kraken_load".format(', '.join(COLUMNS))
+    params = ()
+    if instance:
+        query += " WHERE instance = ?"
+        params = (instance,)
+    loads = {}
+    with closing(_connect(path)) as connection:
+        for row in connection.execute(query + " ORDER BY date, rowid", params):
+            record = dict(zip(COLUMNS, row))
+            record['loaded'] = bool(record['loaded'])
+            loads.setdefault(record['instance'], []).append(record)
+    return loads
+
+
+def record_binarizations(records, path=None):
+    """ store binarization records, a list of dicts with keys instance, host, elapsed (seconds),
+        success (bool) and input_size (bytes of the last dataset, or None)
+        Nothing is stored if env.kraken_history_file is not set.
+    """
+    if not records or not (path or env.kraken_history_file):
+        return
+    now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    with closing(_connect(path)) as connection, connection:
+        connection.executemany(
+            "INSERT INTO binarization ({}) VALUES ({})".format(', '.join(BINARIZATION_COLUMNS),
+                                                               ', '.join('?' * len(BINARIZATION_COLUMNS))),
+            [(RUN_ID, now, r['instance'], r.get('host'), r['elapsed'], bool(r['success']), r.get('input_size'))
+             for r in records])
+
+
+def get_binarization_durations(path=None):
+    """ :return: {instance: [elapsed seconds of the successful binarizations, oldest first]}
+        Empty if there is no history file.
+    """
+    if not os.path.exists(path or env.kraken_history_file or ''):
+        return {}
+    durations = {}
+    with closing(_connect(path)) as connection:
+        for instance, elapsed in connection.execute(
+                "SELECT instance, elapsed FROM binarization WHERE success ORDER BY date, rowid"):
+            durations.setdefault(instance, []).append(elapsed)
+    return durations
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def analyze_kraken_loads(records, last=10, outlier_ratio=1.5):
+    """ compare the last run of an instance to its previous loads
+        :param records: records of a single instance, oldest first
+        :param last: number of previous runs taken as reference
+        :param outlier_ratio: a load is an outlier if it is slower than ratio * reference median
+        :return: a dict with the reference median, the median of the last run,
+                 the trend (last / reference), the data size trend, the outliers
+                 (records of the last run that are too slow or failed), and the
+                 medians of all the loads with and without prewarm
+    """
+    runs = []
+    for record in records:
+        if not runs or runs[-1][0] != record['run']:
+            runs.append((record['run'], []))
+        runs[-1][1].append(record)
+    last_run = runs[-1][1] if runs else []
+    reference = [r for _, rs in runs[-last - 1:-1] for r in rs if r['loaded']]
+    ref_median = median([r['elapsed'] for r in reference])
+    last_median = median([r['elapsed'] for r in last_run if r['loaded']])
+    ref_size = median([r['data_size'] for r in reference if r['data_size']])
+    last_size = median([r['data_size'] for r in last_run if r['data_size']])
+    return {
+        'runs': len(runs),
+        'reference': ref_median,
+        'last': last_median,
+        'trend': last_median / ref_median if ref_median and last_median else None,
+        'size_trend': float(last_size) / ref_size if ref_size and last_size else None,
+        'kraken_version': last_run[-1]['kraken_version'] if last_run else None,
+        'outliers': [r for r in last_run if not r['loaded'] or
+                     (ref_median and r['elapsed'] > outlier_ratio * ref_median)],
+        'prewarmed': median([r['elapsed'] for r in records if r['loaded'] and r['prewarm'] is not None]),
+        'cold': median([r['elapsed'] for r in records if r['loaded'] and r['prewarm'] is None]),
+    }
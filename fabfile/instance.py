@@ -39,7 +39,8 @@ class Instance:
                  is_free=False, chaos_database=None, rt_topics=[],
                  zmq_socket_port=None, db_name=None, db_user=None, source_dir=None,
                  enable_realtime=False, realtime_proxies=[], street_network=None, cache_raptor=None, zmq_server=None,
-                 kraken_threads=None):
+                 kraken_threads=None, query_share=1, kraken_queue_policy=None,
+                 canary_queries=None):
         self.name = name
         self.db_password = db_password
         self.is_free = is_free
@@ -91,6 +92,13 @@ class Instance:
         self.realtime_proxies = realtime_proxies
         self.cache_raptor = cache_raptor
         self.street_network = street_network
+        # relative volume of queries of the instance, used to place its krakens (see place_krakens)
+        self.query_share = query_share
+        # overrides of env.kraken_queue_policy for the rabbitmq queues of the instance krakens
+        self.kraken_queue_policy = kraken_queue_policy
+        # requests (relative to the coverage url) used to check the latency of the instance
+        # during kraken restarts, they are generated if not given (see fabfile.canary)
+        self.canary_queries = canary_queries
 
     @property
     def kraken_engines_url(self):
@@ -102,6 +110,9 @@ class Instance:
 
     @property
     def kraken_database(self):
+        if env.kraken_local_staging:
+            # the data file is copied on the engine before each restart, see kraken.stage_data_files
+            return os.path.join(self.kraken_basedir, 'data.nav.lz4')
         return env.kraken_database_file.format(base_dest=env.tyr_base_destination_dir, instance=self.name, ed_basedir=env.ed_basedir)
 
     @property
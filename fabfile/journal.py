@@ -0,0 +1,106 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of fabric_navitia, the provisioning and deployment tool
+#     of Navitia, the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+"""
+Journal of the upgrades (see tasks.upgrade_all), an append-only file of JSON lines (env.upgrade_journal_file).
+The completed steps of each instance are appended as they complete, so that an interrupted upgrade
+can be resumed (resume=True) without doing them again. An upgrade started without resume begins
+a new segment of the journal, the previous ones are kept but ignored.
+"""
+
+import datetime
+import json
+import os
+from threading import Lock
+
+from fabric.api import env
+
+STEPS = ('ed_migration', 'binarization', 'swap', 'restart', 'test')
+
+# the binarizations and the upgrade lanes record their steps from several threads
+_lock = Lock()
+
+
+def _append(entry, path=None):
+    path = path or env.upgrade_journal_file
+    if not path:
+        return
+    entry['date'] = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+    with _lock, open(path, 'a+') as journal:
+        # a line truncated by an interruption must not swallow the new entry
+        journal.seek(0, os.SEEK_END)
+        if journal.tell():
+            journal.seek(-1, os.SEEK_END)
+            truncated = journal.read(1) != '\n'
+            journal.seek(0, os.SEEK_END)
+            if truncated:
+                journal.write('\n')
+        journal.write(json.dumps(entry, sort_keys=True) + '\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def start(path=None):
+    """ begin a new upgrade in the journal """
+    _append({'step': 'start'}, path)
+
+
+def record(instance_name, step, path=None):
+    """ append a completed step of an instance, see STEPS """
+    if step not in STEPS:
+        raise ValueError("unknown upgrade step {}".format(step))
+    _append({'instance': instance_name, 'step': step}, path)
+
+
+def completed(path=None):
+    """ :return: {instance name: set of the steps completed since the start of the last upgrade}
+        A truncated last line (interruption while writing) is ignored.
+    """
+    path = path or env.upgrade_journal_file
+    steps = {}
+    if not path or not os.path.exists(path):
+        return steps
+    with open(path) as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('step') == 'start':
+                steps = {}
+            elif entry.get('instance'):
+                steps.setdefault(entry['instance'], set()).add(entry['step'])
+    return steps
+
+
+def is_done(steps, instance_name, step):
+    """ :param steps: the result of completed() """
+    return step in steps.get(instance_name, ())
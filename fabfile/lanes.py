@@ -0,0 +1,157 @@
+# coding=utf-8
+
+# Copyright (c) 2001-2015, Canal TP and/or its affiliates. All rights reserved.
+#
+# This file is part of fabric_navitia, the provisioning and deployment tool
+#     of Navitia, the software to build cool stuff with public transport.
+#
+# Hope you'll enjoy and contribute to this project,
+#     powered by Canal TP (www.canaltp.fr).
+# Help us simplify mobility and open public transport:
+#     a non ending quest to the responsive locomotion way of traveling!
+#
+# LICENCE: This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Stay tuned using
+# twitter @navitia
+# IRC #navitia on freenode
+# https://groups.google.com/d/forum/navitia
+# www.navitia.io
+
+"""
+Pipelined upgrade (see tasks.upgrade_all): the data of an instance is swapped and its krakens are
+restarted and tested in a lane of its own as soon as its binarization succeeds, while the other
+binarizations go on.
+"""
+
+from contextlib import contextmanager
+import datetime
+import multiprocessing
+import threading
+import time
+
+from fabric import state
+from fabric.colors import blue, green, red
+
+from fabfile import journal
+
+# completed steps of the lanes, sent by the lane processes to the main process (see UpgradeLanes)
+_steps = None
+# held by the lane restarting its krakens
+_restart_lock = None
+
+
+def _init_lane_process(steps, restart_lock):
+    global _steps, _restart_lock
+    _steps = steps
+    _restart_lock = restart_lock
+    # the ssh connections of the main process are shared with it, a lane opens its own
+    state.connections.clear()
+
+
+def record_step(instance_name, step):
+    """ record a completed step of a lane in the upgrade journal (see fabfile.journal).
+        In a lane process, the step is sent to the main process, the only one writing the journal.
+    """
+    if _steps is None:
+        journal.record(instance_name, step)
+    else:
+        _steps.put((instance_name, step))
+
+
+@contextmanager
+def restart_turn():
+    """ wait for the other lanes to restart their krakens: a lane restarts the krakens of its
+        instance within the limits of kraken.KrakenRestartScheduler, but the lanes run at the same time
+    """
+    if _restart_lock is None:
+        yield
+        return
+    with _restart_lock:
+        yield
+
+
+def _run_lane(lane, instance_name, args, start):
+    """ run a lane in a lane process, see UpgradeLanes """
+    lane_start = time.time()
+    try:
+        result = dict(lane(instance_name, *args))
+    except BaseException as e:
+        result = {'failed': 'lane', 'error': str(e)}
+    result['lane'] = time.time() - lane_start
+    result['ready'] = time.time() - start
+    if result.get('failed'):
+        print(red("ERROR: upgrade lane of {} failed at step {}".format(instance_name, result['failed'])))
+    else:
+        print(green("upgrade lane of {} completed in {}".format(
+            instance_name, datetime.timedelta(seconds=int(result['lane'])))))
+    return result
+
+
+class UpgradeLanes(object):
+    """ run lane(instance name, *args[instance name]) in at most size processes for each submitted instance
+        lane is a module level function returning a dict {step: seconds} with the key 'failed' set to the
+        failed step, if any. It records its completed steps with record_step, and restarts krakens
+        in its restart_turn.
+        An exception stays in its lane and is reported as a failure of the step 'lane'.
+        The lane processes are forked when the lanes are created: create them before starting threads
+        (a forked thread lock may be held forever), eg the binarizations.
+        use it as RAII, leaving waits for all the lanes, eg:
+        with UpgradeLanes(my_lane, 2, {'fr-nw': (arg,)}) as lanes:
+            lanes.submit('fr-nw')
+        print(lanes.results)
+    """
+    def __init__(self, lane, size, args=None):
+        self.lane = lane
+        self.args = args or {}
+        self.start = time.time()
+        self.pending = {}
+        self.results = {}
+        self.steps = multiprocessing.Queue()
+        self.pool = multiprocessing.Pool(max(1, size), _init_lane_process, (self.steps, multiprocessing.Lock()))
+        self.recorder = threading.Thread(target=self._record_steps)
+        self.recorder.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.pool.close()
+        self.pool.join()
+        self.steps.put(None)
+        self.recorder.join()
+        for name, result in self.pending.iteritems():
+            self.results[name] = result.get()
+
+    def _record_steps(self):
+        for instance_name, step in iter(self.steps.get, None):
+            journal.record(instance_name, step)
+
+    def submit(self, instance_name):
+        print(blue("NOTICE: starting the upgrade lane of {}".format(instance_name)))
+        self.pending[instance_name] = self.pool.apply_async(
+            _run_lane, (self.lane, instance_name, tuple(self.args.get(instance_name, ())), self.start))
+
+    @property
+    def succeeded(self):
+        return sorted(name for name, result in self.results.iteritems() if not result.get('failed'))
+
+    def report(self, steps):
+        """ :return: the timings of the lanes, one line per instance in order of completion """
+        columns = ('instance',) + tuple(steps) + ('lane', 'ready', 'failed')
+        lines = [''.join('{:>12}'.format(c) if i else '{:<30}'.format(c) for i, c in enumerate(columns))]
+        for name, result in sorted(self.results.iteritems(), key=lambda item: item[1]['ready']):
+            values = [int(result[c]) if c in result and c != 'failed' else result.get(c) or '-' for c in columns[1:]]
+            lines.append('{:<30}'.format(name) + ''.join('{:>12}'.format(v) for v in values))
+        return '\n'.join(lines)
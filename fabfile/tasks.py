@@ -32,6 +32,7 @@
 import datetime
 import os
 import requests
+import time
 
 from fabric.api import run, env, task, execute, roles, abort
 from fabric.colors import blue, red, yellow, green
@@ -44,7 +45,9 @@ from component.load_balancer import _adc_connection
 from utils import (get_bool_from_cli, show_version, get_host_addr,
                    show_dead_kraken_status, TimeCollector, compute_instance_status,
                    show_time_deploy, host_app_mapping, send_mail,
-                   supervision_downtime, get_real_instance)
+                   supervision_downtime, get_real_instance, changed_on_any_host)
+from lanes import UpgradeLanes, record_step, restart_turn
+import journal
 from prod_tasks import (remove_kraken_vip, switch_to_first_phase,
                         switch_to_second_phase, switch_to_third_phase, enable_all_nodes)
 import random
@@ -104,13 +107,33 @@ def upgrade_all_packages():
 
 @task
 def upgrade_all(up_tyr=True, up_confs=True, check_version=True, send_mail='no',
-                manual_lb=False, check_dead=True, check_bina=True):
-    """Upgrade all navitia packages, databases and launch rebinarisation of all instances """
+                manual_lb=False, check_dead=True, check_bina=True, pipeline=False, resume=False):
+    """Upgrade all navitia packages, databases and launch rebinarisation of all instances
+       :param pipeline: swap the data and restart the krakens of each instance as soon as
+                        its binarization succeeds (see upgrade_pipelined)
+       :param resume: resume an interrupted upgrade, skipping the steps of the instances
+                      already recorded in the upgrade journal (see fabfile.journal)
+    """
     up_tyr = get_bool_from_cli(up_tyr)
     up_confs = get_bool_from_cli(up_confs)
     check_version = get_bool_from_cli(check_version)
     check_dead = get_bool_from_cli(check_dead)
     check_bina = get_bool_from_cli(check_bina)
+    pipeline = get_bool_from_cli(pipeline) and up_tyr
+    if pipeline and env.eng_hosts_1 and env.ws_hosts_1:
+        abort(red("The pipelined upgrade can not be used with the two phases upgrade (env.eng_hosts_1)"))
+    resume = get_bool_from_cli(resume)
+    if resume:
+        done = journal.completed()
+        if done and check_version:
+            print(yellow("NOTICE: the packages have already been upgraded, their version is not checked on resume"))
+            check_version = False
+        print(blue("Resuming the upgrade, steps already done: {}".format(
+            ', '.join('{} ({})'.format(i, ', '.join(s for s in journal.STEPS if s in done[i])) for i in sorted(done))
+            or 'none')))
+    else:
+        done = {}
+        journal.start()
 
     if check_version:
         execute(compare_version_candidate_installed, host_name='tyr')
@@ -130,22 +153,51 @@ def upgrade_all(up_tyr=True, up_confs=True, check_version=True, send_mail='no',
     time_dict = TimeCollector()
     time_dict.register_start('total_deploy')
 
-    if up_tyr:
-        execute(update_tyr_step, time_dict, only_bina=False, check_bina=check_bina)
-
-    if check_version:
-        execute(compare_version_candidate_installed)
-    execute(kraken.swap_all_data_nav)
-
-    # Upgrade kraken/jormun on first hosts set
-    if env.eng_hosts_1 and env.ws_hosts_1:
-        env.roledefs['eng'] = env.eng_hosts_1
-        env.roledefs['ws'] = env.ws_hosts_1
-        if manual_lb:
-            raw_input(yellow("Please disable ENG1,3/WS7-9 and enable ENG2,4/WS10-12"))
-        else:
-            execute(switch_to_first_phase, env.eng_hosts_1, env.ws_hosts_1, env.ws_hosts_2)
-    execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs, supervision=True)
+    # on resume, only restart the krakens of the instances not restarted yet
+    to_restart = [i for i in env.instances if not journal.is_done(done, i, 'restart')] if resume else None
+    restart_failed = []
+
+    def record_restarts():
+        failed = set(instance_name for instance_name, _ in restart_failed)
+        restarted = [i for i in (env.instances if to_restart is None else to_restart) if i not in failed]
+        for instance_name in restarted:
+            journal.record(instance_name, 'restart')
+        # the krakens are tested again, whatever the restart scheme
+        for instance_name in kraken.loaded_instances(restarted):
+            journal.record(instance_name, 'test')
+
+    if pipeline:
+        upgrade_pipelined(time_dict, up_confs=up_confs, check_version=check_version, check_bina=check_bina,
+                          resume=resume)
+    else:
+        if up_tyr:
+            execute(update_tyr_step, time_dict, only_bina=False, check_bina=check_bina, resume=resume)
+
+        if check_version:
+            execute(compare_version_candidate_installed)
+        execute(kraken.swap_all_data_nav)
+        # only the instances binarized by this upgrade have new data
+        binarized = journal.completed()
+        for instance_name in env.instances:
+            if journal.is_done(binarized, instance_name, 'binarization') and \
+                    not journal.is_done(done, instance_name, 'swap'):
+                journal.record(instance_name, 'swap')
+
+        # Upgrade kraken/jormun on first hosts set
+        if env.eng_hosts_1 and env.ws_hosts_1:
+            env.roledefs['eng'] = env.eng_hosts_1
+            env.roledefs['ws'] = env.ws_hosts_1
+            if manual_lb:
+                raw_input(yellow("Please disable ENG1,3/WS7-9 and enable ENG2,4/WS10-12"))
+            else:
+                execute(switch_to_first_phase, env.eng_hosts_1, env.ws_hosts_1, env.ws_hosts_2)
+        time_dict.register_start('kraken')
+        restart_failed += execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs, supervision=True,
+                                  instances=to_restart).values()[0]
+        # with two phases, the krakens are upgraded until the end of the second one
+        if not (env.eng_hosts_2 and env.ws_hosts_2):
+            time_dict.register_end('kraken')
+            record_restarts()
     if check_dead:
         execute(kraken.check_dead_instances)
     execute(upgrade_jormungandr, reload=False, up_confs=up_confs)
@@ -170,7 +222,11 @@ def upgrade_all(up_tyr=True, up_confs=True, check_version=True, send_mail='no',
         else:
             execute(switch_to_third_phase, env.ws_hosts_2)
         env.roledefs['ws'] = env.ws_hosts
-        execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs)
+        restart_failed += execute(upgrade_kraken, wait=env.KRAKEN_RESTART_SCHEME, up_confs=up_confs,
+                                  instances=to_restart).values()[0]
+        time_dict.register_end('kraken')
+        if not pipeline:
+            record_restarts()
 
         # check second hosts set
         for server in env.roledefs['ws']:
@@ -205,16 +261,20 @@ def broadcast_email(kind, status=None):
 
 
 @task
-def update_tyr_step(time_dict=None, only_bina=True, up_confs=True, check_bina=False):
+def update_tyr_step(time_dict=None, only_bina=True, up_confs=True, check_bina=False, resume=False):
     # TODO only_bina is highly error prone
     """ deploy an upgrade of tyr
+        resume: the upgrade of tyr is skipped if the upgrade journal has recorded steps,
+        as well as the ed migrations and binarizations already done
     """
+    resume = get_bool_from_cli(resume)
     if not time_dict:
         time_dict = TimeCollector()
     execute(tyr.stop_tyr_beat)
-    execute(upgrade_tyr, up_confs=up_confs, pilot_tyr_beat=False)
+    if not (resume and journal.completed()):
+        execute(upgrade_tyr, up_confs=up_confs, pilot_tyr_beat=False)
     time_dict.register_start('bina')
-    instances_failed = execute(tyr.launch_rebinarization_upgrade, pilot_tyr_beat=False).values()[0]
+    instances_failed = execute(tyr.launch_rebinarization_upgrade, pilot_tyr_beat=False, resume=resume).values()[0]
     if check_bina and instances_failed:
         if float(len(instances_failed)) / len(env.instances) <= env.acceptable_bina_fail_rate:
             print(yellow("  WARNING: {} binarisation(s) have failed, process again".format(len(instances_failed))))
@@ -234,6 +294,102 @@ def update_tyr_step(time_dict=None, only_bina=True, up_confs=True, check_bina=Fa
     return time_dict
 
 
+UPGRADE_LANE_STEPS = ('swap', 'restart', 'test')
+
+
+def upgrade_lane(instance_name, skip=()):
+    """ swap the data, restart and test the krakens of an instance with the new binary
+        It runs in a lane process (see UpgradeLanes), so the binarizations running in the
+        threads of the main process keep their env.host_string.
+        Each completed step is recorded in the upgrade journal, the steps in skip are not done.
+        :return: {step: seconds}, with 'failed' set to the step that failed
+    """
+    def restart():
+        execute(kraken.set_kraken_binary, instance_name)
+        # one lane at a time, so that the restart limits hold across lanes
+        with restart_turn():
+            failed = execute(kraken.restart_kraken, instance_name, wait=env.KRAKEN_RESTART_SCHEME).values()[0]
+        if failed:
+            abort(red("krakens not loaded: {}".format(', '.join('{} on {}'.format(*p) for p in failed))))
+
+    result = {}
+    steps = (('swap', lambda: execute(kraken.swap_data_nav, instance_name)),
+             ('restart', restart),
+             ('test', lambda: execute(kraken.test_kraken, instance_name, fail_if_error=True, wait=True)))
+    with settings(host_string=env.roledefs['tyr_master'][0], parallel=False):
+        for step, func in steps:
+            if step in skip:
+                continue
+            start = time.time()
+            try:
+                func()
+            except BaseException as e:
+                print(red("ERROR: {} of {} failed: {}".format(step, instance_name, e)))
+                result['failed'] = step
+                return result
+            finally:
+                result[step] = time.time() - start
+            record_step(instance_name, step)
+    return result
+
+
+def upgrade_pipelined(time_dict, up_confs=True, check_version=True, check_bina=True, resume=False):
+    """ upgrade tyr, the kraken packages and confs, then binarize all the instances and run the
+        lane (swap, restart, test) of each instance as soon as its binarization succeeds,
+        env.upgrade_lanes at the same time.
+        Until its lane, an instance keeps the old kraken binary. The instances whose binarization
+        failed are restarted with the new binary at the end, as in the serial upgrade.
+        On resume, the upgrade of the packages is skipped if the upgrade journal has recorded steps,
+        and the lanes of the instances already binarized are started first.
+    """
+    done = journal.completed() if resume else {}
+    execute(tyr.stop_tyr_beat)
+    if not done:
+        execute(upgrade_tyr, up_confs=up_confs, pilot_tyr_beat=False)
+        if check_version:
+            execute(compare_version_candidate_installed)
+        execute(upgrade_kraken, up_confs=up_confs, supervision=True, restart=False)
+        for instance in env.instances.values():
+            execute(kraken.set_kraken_binary, instance, old=True)
+
+    time_dict.register_start('bina')
+    time_dict.register_start('kraken')
+    # the lane processes are forked before the binarization threads start
+    skip = dict((name, (steps,)) for name, steps in done.iteritems())
+    with UpgradeLanes(upgrade_lane, env.upgrade_lanes, skip) as lanes:
+        for instance_name in sorted(done):
+            if 'binarization' in done[instance_name] and not set(UPGRADE_LANE_STEPS) <= done[instance_name]:
+                lanes.submit(instance_name)
+        instances_failed = execute(tyr.launch_rebinarization_upgrade, pilot_tyr_beat=False,
+                                   on_success=lanes.submit, resume=resume).values()[0]
+        if check_bina and instances_failed:
+            if float(len(instances_failed)) / len(env.instances) <= env.acceptable_bina_fail_rate:
+                print(yellow("  WARNING: {} binarisation(s) have failed, process again".format(len(instances_failed))))
+                instances_failed = execute(tyr.launch_rebinarization_upgrade, pilot_supervision=False,
+                                           pilot_tyr_beat=False, instances=instances_failed,
+                                           on_success=lanes.submit).values()[0]
+            else:
+                print(yellow("  WARNING: Too many ({}) binarisations have failed, do not process again".
+                             format(len(instances_failed))))
+        time_dict.register_end('bina')
+    time_dict.register_end('kraken')
+    print(blue("Upgrade lanes (seconds):\n" + lanes.report(UPGRADE_LANE_STEPS)))
+    lanes_failed = set(lanes.results) - set(lanes.succeeded)
+    if lanes_failed:
+        print(red("ERROR: the upgrade lanes of {} have failed".format(', '.join(sorted(lanes_failed)))))
+    if check_bina and instances_failed:
+        abort(red("\n  ERROR: {} binarisation(s) have failed.".format(len(instances_failed))))
+    for instance_name in set(env.instances) - set(lanes.results):
+        if journal.is_done(done, instance_name, 'restart'):
+            continue
+        execute(kraken.set_kraken_binary, instance_name)
+        failed = execute(kraken.restart_kraken, instance_name, wait=env.KRAKEN_RESTART_SCHEME).values()[0]
+        if failed:
+            print(red("ERROR: krakens not loaded: {}".format(', '.join('{} on {}'.format(*p) for p in failed))))
+        else:
+            journal.record(instance_name, 'restart')
+
+
 @task
 def compare_version_candidate_installed(host_name='eng'):
     """Check candidate version is different from installed"""
@@ -308,8 +464,11 @@ def upgrade_version():
 
 
 @task
-def upgrade_kraken(wait='serial', up_confs=True, supervision=False):
-    """Upgrade and restart all kraken instances"""
+def upgrade_kraken(wait='serial', up_confs=True, supervision=False, prewarm=None, restart=True, instances=None):
+    """Upgrade and restart all kraken instances
+       instances: names of the instances to restart, default all
+       :return: the krakens not loaded after their restart
+    """
     if supervision:
         supervision_downtime(step='kraken')
     execute(kraken.upgrade_engine_packages)
@@ -320,7 +479,12 @@ def upgrade_kraken(wait='serial', up_confs=True, supervision=False):
         execute(kraken.update_monitor_configuration)
         for instance in env.instances.values():
             execute(kraken.update_eng_instance_conf, instance)
-    execute(kraken.restart_all_krakens, wait=wait)
+    if not restart:
+        return []
+    if instances is None:
+        return execute(kraken.restart_all_krakens, wait=wait, prewarm=prewarm).values()[0]
+    execute(kraken.require_monitor_kraken_started)
+    return kraken.restart_krakens(kraken.kraken_pairs(instances, hosts=env.roledefs['eng']), wait, prewarm)
 
 
 @task
@@ -430,25 +594,39 @@ def update_all_instances(kraken_wait='serial'):
 
 
 @task
-def update_all_configurations():
+def update_all_configurations(force=False):
     """
-    update all configuration and restart all services
+    update all configuration and restart the services whose configuration changed
     does not deploy any packages
+    :param force: restart all services, even if their configuration did not change
     """
+    force = get_bool_from_cli(force)
     # TODO refactor this to follow a good orchestration for production
     execute(kraken.get_no_data_instances)
-    execute(jormungandr.update_jormungandr_conf)
+    jormun_changed = changed_on_any_host(execute(jormungandr.update_jormungandr_conf))
     execute(kraken.update_monitor_configuration)
-    execute(tyr.update_tyr_confs)
+    tyr_changed = tyr.update_tyr_confs()
+    kraken_changed = []
     for instance in env.instances.values():
-        execute(tyr.update_tyr_instance_conf, instance)
-        execute(jormungandr.deploy_jormungandr_instance_conf, instance)
-        execute(kraken.update_eng_instance_conf, instance)
-    #once all has been updated, we restart all services for the conf to be taken into account
-    execute(tyr.restart_tyr_worker)
-    execute(tyr.restart_tyr_beat)
-    execute(jormungandr.reload_jormun_safe_all)
-    execute(kraken.restart_all_krakens)
+        jormun_changed |= changed_on_any_host(execute(jormungandr.deploy_jormungandr_instance_conf, instance))
+        hosts = set(get_host_addr(h) for h in kraken.update_eng_instance_conf(instance))
+        kraken_changed.extend(pair for pair in kraken.kraken_pairs([instance], hosts=env.roledefs['eng'])
+                              if force or pair[1] in hosts)
+    #once all has been updated, we restart the services for the conf to be taken into account
+    if tyr_changed or force:
+        execute(tyr.restart_tyr_worker)
+        execute(tyr.restart_tyr_beat)
+    else:
+        print(blue("Tyr configuration unchanged, tyr not restarted"))
+    if jormun_changed or force:
+        execute(jormungandr.reload_jormun_safe_all)
+    else:
+        print(blue("Jormungandr configuration unchanged, jormungandr not reloaded"))
+    if kraken_changed:
+        execute(kraken.require_monitor_kraken_started)
+        kraken.restart_krakens(kraken_changed)
+    else:
+        print(blue("Kraken configurations unchanged, krakens not restarted"))
 
     # and we test the jormungandr
     for server in env.roledefs['ws']:
@@ -511,3 +689,58 @@ def clean_instances(clean=False):
             print("Done.")
         else:
             print("You can specify parameter 'clean=True' to clean jormun DB.")
+
+
+@task
+def place_krakens(apply=False, max_moves=None):
+    """ Propose a placement of the krakens on the engines that balances their memory
+        (measured RSS, or data size) and their queries (query_share of add_instance),
+        moving as few krakens as possible.
+        The number of krakens of each instance is kept.
+        :param apply: redeploy the moved krakens, the zmq_server parameters of the
+                      configuration must then be updated as shown
+    """
+    if env.use_zmq_socket_file:
+        abort(yellow("Krakens run on all engines with zmq socket files, nothing to place"))
+    engines = [get_host_addr(h) for h in env.roledefs['eng']]
+    mapping = dict((name, instance.kraken_engines_url) for name, instance in env.instances.iteritems()
+                   if set(instance.kraken_engines_url) <= set(engines))
+    rss = kraken.get_krakens_rss()
+    sizes = kraken.get_data_nav_sizes(mapping)
+    memory, cpu = {}, {}
+    for name, hosts in mapping.iteritems():
+        measured = [rss.get(h, {}).get(name) for h in hosts if rss.get(h, {}).get(name)]
+        memory[name] = sum(measured) / len(measured) if measured else sizes.get(name, 0) * env.kraken_lz4_memory_ratio
+        cpu[name] = env.instances[name].query_share
+    new_mapping, moves = kraken.plan_kraken_placement(mapping, memory, cpu, engines, max_moves)
+
+    before = kraken.get_engines_load(mapping, memory, cpu, engines)
+    after = kraken.get_engines_load(new_mapping, memory, cpu, engines)
+    for engine in engines:
+        print("{}: memory {:.0%} -> {:.0%}, queries {:.0%} -> {:.0%}".format(
+            engine, before[engine][0], after[engine][0], before[engine][1], after[engine][1]))
+    if not moves:
+        print(green("Krakens are balanced, nothing to move"))
+        return
+    for name, source, target in moves:
+        print(yellow("{}: {} -> {}".format(name, source, target)))
+    for name in sorted(set(m[0] for m in moves)):
+        print("add_instance('{}', ..., zmq_server={})".format(name, new_mapping[name]))
+    if not get_bool_from_cli(apply):
+        print(blue("Use apply=True to move the krakens"))
+        return
+
+    reload_jormun = False
+    for name in sorted(set(m[0] for m in moves)):
+        instance = env.instances[name]
+        instance.kraken_engines = [h for h in env.roledefs['eng'] if get_host_addr(h) in new_mapping[name]]
+        if instance.zmq_server in mapping[name]:
+            # jormungandr talks directly to the single kraken of the instance
+            instance.zmq_server = new_mapping[name][0]
+            instance.jormungandr_zmq_socket_for_instance = 'tcp://{}:{}'.format(
+                instance.zmq_server, instance.kraken_zmq_socket.rsplit(':', 1)[1])
+            execute(jormungandr.deploy_jormungandr_instance_conf, instance)
+            reload_jormun = True
+        kraken.redeploy_kraken(instance)
+    if reload_jormun:
+        execute(jormungandr.reload_jormun_safe_all)
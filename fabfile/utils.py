@@ -37,7 +37,6 @@ from fabric.context_managers import settings
 import os
 from pipes import quote
 import random
-from retrying import Retrying, RetryError
 import string
 from threading import Thread
 from cStringIO import StringIO
@@ -146,7 +145,23 @@ def require_directories(dirs, is_on_nfs4=False, **kwargs):
     require.files.directories(dirs, **kwargs)
 
 
+def _upload_template_script(destination, destination_temp, show_diff=None, backup=False):
+    """ shell script replacing destination by the uploaded destination_temp if their contents differ,
+        printing 'CHANGED' or 'UNCHANGED' last
+    """
+    destination, destination_temp = quote(destination), quote(destination_temp)
+    return ('if [ -e {dst} ] && cmp -s {dst} {tmp}; then rm -f {tmp}; echo UNCHANGED; '
+            'else {diff}{backup}mv -f {tmp} {dst} && echo CHANGED; fi').format(
+        dst=destination, tmp=destination_temp,
+        diff='[ -e {dst} ] && {cmd} {dst} {tmp}; '.format(dst=destination, tmp=destination_temp, cmd=show_diff)
+        if show_diff else '',
+        backup='[ -e {dst} ] && cp {dst} {dst}.bak; '.format(dst=destination) if backup else '')
+
+
 def _upload_template(filename, destination, context=None, chown=True, user='www-data', **kwargs):
+    """ render a template of the templates directory to the destination file
+        :return: True if the file was created or its content changed
+    """
     kwargs['use_jinja'] = True
     kwargs['template_dir'] = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                           os.path.pardir, 'templates')
@@ -155,16 +170,24 @@ def _upload_template(filename, destination, context=None, chown=True, user='www-
     kwargs['chown'] = chown
     kwargs['user'] = user
     kwargs['use_sudo'] = True
-    kwargs['backup'] = env.backup_conf_files
-    if env.show_diff_when_upload and exists(destination):
-        destination_temp = destination + '.temp'
-        upload_template(filename, destination_temp, **kwargs)
-        with warn_only():
-            run('{} {} {}'.format(env.show_diff_when_upload, destination, destination_temp))
-        run('rm {}'.format(destination))
-        run('mv {} {}'.format(destination_temp, destination))
-    else:
-        upload_template(filename, destination, **kwargs)
+    # the file is uploaded aside, and only replaces the destination if it differs
+    kwargs['backup'] = False
+    destination_temp = destination + '.temp'
+    upload_template(filename, destination_temp, **kwargs)
+    with warn_only():
+        output = run(_upload_template_script(destination, destination_temp, env.show_diff_when_upload,
+                                             env.backup_conf_files))
+    lines = output.splitlines()
+    return bool(lines) and lines[-1].strip() == 'CHANGED'
+
+
+def changed_on_any_host(result):
+    """ :param result: value returned by an upload task, directly or through execute() ({host: value})
+        :return: True if the task changed something on a host
+    """
+    if isinstance(result, dict):
+        return any(result.values())
+    return bool(result)
 
 
 def get_psql_version():
@@ -205,7 +228,16 @@ class Parallel:
         self.pool.join()
 
     def map(self, func, param):
-        self.pool.map(func, param)
+        return self.pool.map(func, param)
+
+    def imap_unordered(self, func, param):
+        """ params are handed to the threads one at a time and in order (map hands them
+            by chunks), results are yielded as soon as they are ready
+        """
+        return self.pool.imap_unordered(func, param, chunksize=1)
+
+    def apply_async(self, func, args=()):
+        return self.pool.apply_async(func, args)
 
 
 def run_once_per_host(func):
@@ -264,6 +296,21 @@ def execute_flat(task, *args, **kwargs):
         return execute(task, *args, **kwargs)
 
 
+def execute_parallel(task, hosts, *args, **kwargs):
+    """ Replacement function for fabric.api.execute() that runs the task on all the given
+        hosts at the same time, one forked process per host (see fabric parallel execution).
+        The task is given env.host_string, so per host parameters can be passed
+        as a dict {host: value}.
+        :param pool_size: max number of hosts processed at the same time, default is all
+        Return value is identical to execute(): a dict {host: value}
+    """
+    if not hosts:
+        return {}
+    pool_size = kwargs.pop('pool_size', None) or len(hosts)
+    with settings(parallel=True, pool_size=pool_size):
+        return execute(task, *args, hosts=hosts, **kwargs)
+
+
 def idempotent_symlink(source, destination, use_sudo=False):
     """
     Create a symbolic link to a file or directory, even if it already exists
@@ -306,8 +353,7 @@ def apt_get_update():
 
 @task
 def restart_apache():
-    start_or_stop_with_delay("apache2", 4000, 500, start=False, only_once=True)
-    start_or_stop_with_delay("apache2", 4000, 500, only_once=True)
+    control_services(['apache2'], 'restart')
 
 
 @task
@@ -434,20 +480,85 @@ def get_bool_from_cli(x):
     return x != 'False'
 
 
+def _service_control_script(services, action, delay, wait, only_once):
+    """ shell script starting or stopping services, then polling them until they
+        reach the expected state or the delay (in ms) expires.
+        Prints a line 'SERVICE <name> <state> <elapsed ms>' per service.
+    """
+    want = 0 if action == 'start' else 1
+    services = ' '.join(quote(s) for s in services)
+    # as require.service.started/stopped, a service already in the expected state is left alone
+    issue = ('for s in $pending; do service $s status >/dev/null 2>&1 && st=0 || st=1; '
+             '[ $st -eq {} ] || service $s {} >/dev/null 2>&1; done').format(want, action)
+    script = [
+        'now() { echo $(( $(date +%s%N) / 1000000 )); }',
+        't0=${t0:-$(now)}',
+        'deadline=$(( $(now) + {} ))'.format(delay),
+        'pending="{}"'.format(services),
+        issue,
+        'while [ -n "$pending" ]; do '
+        'left=""; '
+        'for s in $pending; do '
+        'service $s status >/dev/null 2>&1 && st=0 || st=1; '
+        'if [ $st -eq {want} ]; then '
+        'echo "SERVICE $s {state} $(( $(now) - t0 ))"; '
+        'else left="$left $s"; fi; '
+        'done; '
+        'pending=$left; '
+        '[ -z "$pending" ] && break; '
+        'if [ $(now) -ge $deadline ]; then '
+        'for s in $pending; do echo "SERVICE $s timeout $(( $(now) - t0 ))"; done; break; fi; '
+        '{retry}'
+        'sleep {wait}; '
+        'done'.format(want=want, state='running' if want == 0 else 'stopped',
+                      retry='' if only_once else issue + '; ',
+                      wait=wait / 1000.0),
+    ]
+    return '; '.join(script)
+
+
+def control_services(services, action='start', delay=4000, wait=500, only_once=True):
+    """ Start, stop or restart services on the current host in a single remote call.
+        The polling on the services state is done on the remote side.
+        :param services: list of service names
+        :param action: 'start', 'stop' or 'restart'
+        :param delay: max delay (in ms) for each phase (stop, start)
+        :param wait: polling period in ms
+        :param only_once: if False, reissue the start command at each poll (stop is issued once)
+        :return: a dict {service: (state, elapsed seconds)}, state is 'running',
+                 'stopped' or 'timeout'
+    """
+    if action not in ('start', 'stop', 'restart'):
+        raise ValueError("unknown service action '{}'".format(action))
+    services = list(services)
+    if not services:
+        return {}
+    if action == 'restart':
+        script = '; '.join((_service_control_script(services, 'stop', delay, wait, True),
+                            _service_control_script(services, 'start', delay, wait, only_once)))
+    else:
+        script = _service_control_script(services, action, delay, wait, only_once)
+    with settings(hide('running', 'stdout'), warn_only=True):
+        output = run_as_root(script)
+    result = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[0] == 'SERVICE' and fields[1] in services:
+            # with a restart, the start phase line overrides the stop one,
+            # unless the stop phase timed out
+            if result.get(fields[1], (None,))[0] != 'timeout':
+                result[fields[1]] = (fields[2], int(fields[3]) / 1000.0)
+    for name in services:
+        state, elapsed = result.setdefault(name, ('timeout', delay / 1000.0))
+        print((green if state != 'timeout' else red)(
+            "{}: service {} {} ({:.1f}s)".format(env.host_string, name, state, elapsed)))
+    return result
+
+
 def start_or_stop_with_delay(service, delay, wait, start=True, only_once=False, exc_raise=False):
-    # TODO refactor to overcome the SSH problem with respect to "service start"
-    # see: https://github.com/fabric/fabric/issues/395
-    cmd = require.service.started if start else require.service.stopped
-    retry_cond = (lambda x: not require.service.is_running(service)) if start \
-                 else (lambda x: require.service.is_running(service))
-    if only_once:
-        cmd(service)
-        cmd = lambda x: None
-    try:
-        Retrying(stop_max_delay=delay, wait_fixed=wait,
-                 retry_on_result=retry_cond).call(cmd, service)
-    except RetryError as e:
-        message = "Service {} {} failed: ".format(service, 'start' if start else 'stop') + repr(e)
+    state, elapsed = control_services([service], 'start' if start else 'stop', delay, wait, only_once)[service]
+    if state == 'timeout':
+        message = "Service {} {} failed after {:.1f}s".format(service, 'start' if start else 'stop', elapsed)
         if exc_raise:
             raise RuntimeError(message)
         print(red(message))
@@ -0,0 +1,54 @@
+# encoding: utf-8
+
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+
+import pytest
+
+from fabric.api import env
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ base of the stand-in HTTP services of the tests (monitor, jormungandr, rabbitmq management) """
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, code, body=None):
+        body = json.dumps(body) if body is not None else ''
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_server(request):
+    """ serve(handler class) serves it on a free local port until the end of the test
+        and returns the port
+    """
+    def serve(handler):
+        server = StubServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+        request.addfinalizer(stop)
+        return server.server_port
+    return serve
+
+
+@pytest.fixture(autouse=True)
+def instances(monkeypatch):
+    """ the instances registered by a test (see add_instance) are forgotten after it """
+    monkeypatch.setattr(env, 'instances', {})
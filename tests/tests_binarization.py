@@ -0,0 +1,140 @@
+# encoding: utf-8
+
+import Queue
+import threading
+import time
+
+from fabric.api import env
+
+from fabfile import binarization
+from fabfile.component import tyr
+
+
+def test_predict_durations(monkeypatch):
+    monkeypatch.setitem(env, 'bina_history', 2)
+    monkeypatch.setitem(env, 'bina_input_rate', 1)
+    durations = {'fr-nw': [1000, 10, 20], 'fr-ne': [50]}
+    sizes = {'fr-nw': 150, 'fr-ne': 500, 'us-wa': 200}
+    predictions = binarization.predict_durations(['fr-nw', 'fr-ne', 'us-wa', 'fr-se'], durations, sizes)
+    # median of the last 2 durations, then the median rate of fr-nw and fr-ne (10 bytes/s)
+    assert predictions == {'fr-nw': 15, 'fr-ne': 50, 'us-wa': 20, 'fr-se': 20}
+
+    mega = 1024 * 1024
+    predictions = binarization.predict_durations(['fr-nw', 'us-wa'], {}, {'fr-nw': 30 * mega})
+    assert predictions == {'fr-nw': 30, 'us-wa': 30}
+    assert binarization.predict_durations(['fr-nw'], {}, {}) == {'fr-nw': 0}
+
+
+def test_longest_first():
+    predictions = {'a': 1, 'b': 10, 'c': 5, 'd': 5}
+    order = binarization.longest_first(predictions)
+    assert order == ['b', 'c', 'd', 'a']
+    assert binarization.predict_makespan(predictions, order, 2) == 11
+    # the longest job started last stretches the makespan
+    assert binarization.predict_makespan(predictions, ['a', 'c', 'd', 'b'], 2) == 15
+    assert binarization.predict_makespan(predictions, order, 1) == 21
+    assert binarization.predict_makespan({}, [], 3) == 0
+
+
+def test_parse_host_load():
+    assert binarization.parse_host_load("4\n2.00\n8388608\n") == {'load': 0.5, 'memory': 8192, 'backends': None}
+    assert binarization.parse_host_load("2\r\n3.0\r\n1024\r\n 12\r\n")['backends'] == 12
+
+
+def test_adaptive_concurrency(monkeypatch):
+    for key, value in (('bina_max_load', 1.0), ('bina_min_free_memory', 1000),
+                       ('bina_max_pg_backends', 10), ('bina_grow_ratio', 0.5)):
+        monkeypatch.setitem(env, key, value)
+    concurrency = binarization.AdaptiveConcurrency(1, 3, initial=2)
+    idle = {'tyr': dict(load=0.1, memory=4000, backends=None), 'db': dict(load=0.2, memory=3000, backends=2)}
+    # all the slots are not used: no need for more
+    assert concurrency.decide(idle)[1:] == (2, 2, 'steady')
+    concurrency.running = 2
+    assert concurrency.decide(idle)[1:] == (2, 3, 'idle')
+    concurrency.running = 3
+    assert concurrency.decide(idle)[1:] == (3, 3, 'idle')
+    busy = dict(idle, db=dict(load=0.7, memory=3000, backends=2))
+    assert concurrency.decide(busy)[1:] == (3, 3, 'steady')
+    overloaded = dict(idle, db=dict(load=1.5, memory=3000, backends=11))
+    assert concurrency.decide(overloaded)[1:] == (3, 2, 'overloaded (load, backends)')
+    assert concurrency.decide(overloaded)[1:] == (2, 1, 'overloaded (load, backends)')
+    assert concurrency.decide(overloaded)[1:] == (1, 1, 'overloaded (load, backends)')
+    assert concurrency.decide({}) is None
+    assert len(concurrency.decisions) == 7
+
+
+def test_adaptive_concurrency_watch(monkeypatch):
+    for key, value in (('bina_max_load', 1.0), ('bina_min_free_memory', 1000), ('bina_max_pg_backends', 10),
+                       ('bina_grow_ratio', 0.5), ('bina_sample_interval', 0.1), ('host_string', 'tyr1')):
+        monkeypatch.setitem(env, key, value)
+
+    def run_command_on_host(host, cmd):
+        # as settings(host_string=host) would do, for good
+        env.host_string = host
+        return "4\n8.0\n512000\n"
+
+    monkeypatch.setattr(binarization, 'run_command_on_host', run_command_on_host)
+    concurrency = binarization.AdaptiveConcurrency(1, 3, initial=2)
+    concurrency.start_sampler(['tyr2'], ['db'])
+    watcher = threading.Thread(target=concurrency.watch)
+    watcher.start()
+    hosts = set()
+    try:
+        deadline = time.time() + 10
+        while len(concurrency.decisions) < 2 and time.time() < deadline:
+            hosts.add(env.host_string)
+            time.sleep(0.01)
+    finally:
+        concurrency.stop()
+        watcher.join()
+    # the hosts are sampled in another process, the binarizations keep their host
+    assert hosts == {'tyr1'}
+    assert concurrency.decisions[0][1:] == (2, 1, 'overloaded (load, memory)')
+    assert not concurrency.sampler.is_alive()
+
+
+def test_run_adaptive():
+    concurrency = binarization.AdaptiveConcurrency(1, 4, initial=2)
+    started, running = [], []
+
+    def job(item):
+        started.append(item)
+        running.append(concurrency.running)
+        return item * 2
+
+    assert binarization.run_adaptive(job, [3, 1, 2, 5, 4], concurrency) == [6, 2, 4, 10, 8]
+    assert max(running) <= 2
+    assert concurrency.running == 0
+
+
+def test_assign_slots():
+    predictions = {'a': 10, 'b': 8, 'c': 5, 'd': 4, 'e': 2}
+    order = binarization.longest_first(predictions)
+    # tyr1 is busy with 'a' until the other slots have done all the others
+    assert binarization.assign_slots(predictions, order, {'tyr1': 1, 'tyr2': 2}) == \
+        {'tyr1': ['a'], 'tyr2': ['b', 'c', 'd', 'e']}
+    assert binarization.assign_slots(predictions, order, {'tyr1': 2, 'tyr2': 0}) == \
+        {'tyr1': ['a', 'b', 'c', 'd', 'e'], 'tyr2': []}
+
+
+def test_binarize_instances_on_host(monkeypatch):
+    monkeypatch.setitem(env, 'host_string', 'tyr2')
+    monkeypatch.setitem(env, 'bina_slots', {'tyr2': 1})
+    monkeypatch.setattr(tyr, 'launch_rebinarization', lambda name, use_temp: name != 'b')
+    completed = Queue.Queue()
+    records = tyr.binarize_instances_on_host({'tyr1': ['a'], 'tyr2': ['b', 'c']}, {'c': 100}, completed)
+    # each record is sent as soon as its binarization is done
+    assert [completed.get_nowait() for _ in records] == records
+    assert [(r['instance'], r['host'], r['success'], r['input_size']) for r in records] == \
+        [('b', 'tyr2', False, None), ('c', 'tyr2', True, 100)]
+
+
+def test_print_binarization_report(capsys):
+    predictions = {'a': 10, 'b': 8, 'c': 5}
+    records = [dict(instance=name, host='tyr1', elapsed=predictions[name]) for name in predictions]
+    tyr.print_binarization_report(predictions, ['a', 'b', 'c'], records, 14, {'tyr1': 2})
+    assert 'predicted 13s with 2 thread(s), actual 14s' in capsys.readouterr()[0]
+    # the adaptive concurrency moved between its bounds, not env.nb_thread_for_bina
+    tyr.print_binarization_report(predictions, ['a', 'b', 'c'], records, 14, {'tyr1': 2},
+                                  binarization.AdaptiveConcurrency(1, 3))
+    assert 'predicted 23s with 1 thread(s) to 10s with 3, actual 14s' in capsys.readouterr()[0]
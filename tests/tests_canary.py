@@ -0,0 +1,81 @@
+# encoding: utf-8
+
+import urlparse
+
+import pytest
+
+from fabric.api import env
+
+from fabfile import canary
+from fabfile.instance import add_instance
+from tests.conftest import StubHandler
+
+
+class JormungandrHandler(StubHandler):
+    """ stand-in for jormungandr, answering coverage 'fr-nw' only """
+    stop_areas = [{'id': 'sa:1', 'name': 'Gare'}, {'id': 'sa:2', 'name': u'Hôtel de ville'}]
+    requests = []
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.requests.append(self.path)
+        parts = url.path.split('/')
+        if parts[3] != 'fr-nw':
+            code, body = 404, {'error': 'unknown coverage'}
+        elif parts[4] == 'stop_areas':
+            code, body = 200, {'stop_areas': self.stop_areas}
+        else:
+            code, body = 200, {}
+        self.reply(code, body)
+
+
+@pytest.fixture
+def jormungandr(http_server, monkeypatch):
+    del JormungandrHandler.requests[:]
+    monkeypatch.setitem(env, 'jormungandr_url', '127.0.0.1:{}'.format(http_server(JormungandrHandler)))
+    monkeypatch.setitem(env, 'jormungandr_url_prefix', '')
+    monkeypatch.setitem(env, 'use_zmq_socket_file', True)
+    monkeypatch.setitem(env, 'roledefs', {'eng': ('root@eng1',)})
+    return JormungandrHandler
+
+
+def test_percentile():
+    assert canary.percentile([], 50) is None
+    assert canary.percentile([3, 1, 2], 50) == 2
+    assert canary.percentile(range(1, 101), 95) == 95
+    assert canary.percentile([0.1], 95) == 0.1
+
+
+def test_is_degraded(monkeypatch):
+    monkeypatch.setitem(env, 'kraken_canary_min_increase', 0.05)
+    monkeypatch.setitem(env, 'kraken_canary_min_errors', 3)
+    baseline = {'p50': 0.1, 'p95': 0.2, 'errors': 0}
+    assert not canary.is_degraded(baseline, {'p50': 0.12, 'p95': 0.25, 'errors': 0}, ratio=1.5)
+    assert canary.is_degraded(baseline, {'p50': 0.1, 'p95': 0.4, 'errors': 0}, ratio=1.5)
+    assert canary.is_degraded(baseline, {'p50': 0.1, 'p95': 0.2, 'errors': 3}, ratio=1.5)
+    # a single extra failed request is not a degradation, nor a few more on an already failing coverage
+    assert not canary.is_degraded(baseline, {'p50': 0.1, 'p95': 0.2, 'errors': 1}, ratio=1.5)
+    assert not canary.is_degraded(dict(baseline, errors=10), {'p50': 0.1, 'p95': 0.2, 'errors': 13}, ratio=1.5)
+    # fast requests getting slower by a few ms are not a degradation
+    assert not canary.is_degraded({'p50': 0.001, 'p95': 0.002, 'errors': 0},
+                                  {'p50': 0.004, 'p95': 0.008, 'errors': 0}, ratio=1.5)
+
+
+def test_canary_queries(jormungandr):
+    assert canary.canary_queries(add_instance('fr-nw', 'passwd')) == [
+        'places?q=Gare', 'places?q=H%C3%B4tel%20de%20ville', 'journeys?from=sa:1&to=sa:2', 'journeys?from=sa:2&to=sa:1']
+    assert canary.canary_queries(add_instance('us-wa', 'passwd', canary_queries=['places?q=Seattle'])) == \
+        ['places?q=Seattle']
+
+
+def test_kraken_canary(jormungandr, monkeypatch):
+    monkeypatch.setitem(env, 'kraken_canary_repeat', 2)
+    instances = [add_instance('fr-nw', 'passwd'), add_instance('us-wa', 'passwd', canary_queries=['places?q=x'])]
+    check = canary.KrakenCanary(instances)
+    assert check.baseline['fr-nw']['errors'] == 0 and check.baseline['fr-nw']['p95'] is not None
+    # us-wa is not served, all its requests fail
+    assert check.baseline['us-wa'] == {'p50': None, 'p95': None, 'errors': 2}
+    assert check.check('fr-nw')[0] is False
+    # a coverage without stop areas has no canary
+    monkeypatch.setattr(JormungandrHandler, 'stop_areas', [])
+    assert canary.canary_queries(instances[0]) == []
@@ -0,0 +1,59 @@
+# encoding: utf-8
+
+import sqlite3
+
+from fabfile import history
+
+
+def test_kraken_load_history(tmpdir, monkeypatch):
+    path = str(tmpdir.join('history.sqlite'))
+    for run, elapsed in enumerate((10, 12, 11, 30)):
+        monkeypatch.setattr(history, 'RUN_ID', 'run{}'.format(run))
+        history.record_kraken_loads([
+            dict(instance='fr-nw', host='eng1', elapsed=elapsed, loaded=True, data_size=100 + run,
+                 prewarm=1.5 if run == 2 else None),
+            dict(instance='fr-nw', host='eng2', elapsed=11, loaded=run != 3, data_size=100 + run,
+                 kraken_version='v2.{}'.format(run)),
+            dict(instance='us-wa', host='eng1', elapsed=5, loaded=True),
+        ], path=path)
+    loads = history.get_kraken_loads(path=path)
+    assert sorted(loads) == ['fr-nw', 'us-wa']
+    assert len(history.get_kraken_loads('fr-nw', path=path)['fr-nw']) == 8
+
+    report = history.analyze_kraken_loads(loads['fr-nw'])
+    assert report['runs'] == 4
+    assert report['reference'] == 11
+    assert report['last'] == 30
+    assert report['kraken_version'] == 'v2.3'
+    assert [(r['host'], r['loaded']) for r in report['outliers']] == [('eng1', True), ('eng2', False)]
+    assert report['prewarmed'] == 11
+    assert report['cold'] == 11
+
+    report = history.analyze_kraken_loads(loads['us-wa'])
+    assert report['trend'] == 1
+    assert report['size_trend'] is None
+    assert report['outliers'] == []
+
+
+def test_kraken_load_history_migration(tmpdir):
+    path = str(tmpdir.join('history.sqlite'))
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE kraken_load (run TEXT NOT NULL, date TEXT NOT NULL, instance TEXT NOT NULL, "
+                       "host TEXT NOT NULL, elapsed REAL NOT NULL, loaded INTEGER NOT NULL, data_size INTEGER, "
+                       "kraken_version TEXT)")
+    connection.execute("INSERT INTO kraken_load VALUES ('run0', '2016-01-01', 'fr-nw', 'eng1', 10, 1, 100, 'v1')")
+    connection.commit()
+    connection.close()
+    history.record_kraken_loads([dict(instance='fr-nw', host='eng1', elapsed=8, loaded=True, prewarm=2)], path=path)
+    assert [(r['elapsed'], r['prewarm']) for r in history.get_kraken_loads(path=path)['fr-nw']] == [(10, None), (8, 2)]
+
+
+def test_binarization_history(tmpdir):
+    path = str(tmpdir.join('history.sqlite'))
+    assert history.get_binarization_durations(path=path) == {}
+    history.record_binarizations([
+        dict(instance='fr-nw', host='tyr1', elapsed=100, success=True, input_size=1000),
+        dict(instance='us-wa', host='tyr1', elapsed=3, success=False),
+    ], path=path)
+    history.record_binarizations([dict(instance='fr-nw', host='tyr1', elapsed=120, success=True)], path=path)
+    assert history.get_binarization_durations(path=path) == {'fr-nw': [100, 120]}
@@ -131,3 +131,15 @@ def test_multiple_zmq_server():
     assert instance.kraken_engines == ['root@bbb', 'root@ccc']
     assert instance.jormungandr_zmq_socket_for_instance == 'tcp://vip.truc:30001'
     assert instance.kraken_zmq_socket == 'tcp://*:30001'
+
+
+def test_kraken_database_local_staging():
+    env.use_zmq_socket_file = True
+    env.roledefs = {
+        'eng': ('root@aaa', 'root@bbb')
+    }
+    instance = add_instance('toto', 'passwd')
+    with settings(kraken_local_staging=True):
+        assert instance.kraken_database == '/srv/kraken/toto/data.nav.lz4'
+    with settings(tyr_base_destination_dir='/srv/ed/data'):
+        assert instance.kraken_database == '/srv/ed/data/toto/data.nav.lz4'
@@ -0,0 +1,30 @@
+# encoding: utf-8
+
+import pytest
+
+from fabfile import journal
+
+
+def test_upgrade_journal(tmpdir):
+    path = str(tmpdir.join('journal.jsonl'))
+    assert journal.completed(path) == {}
+    journal.record('fr-nw', 'binarization', path)
+    journal.start(path)
+    journal.record('fr-nw', 'ed_migration', path)
+    journal.record('fr-nw', 'binarization', path)
+    journal.record('us-wa', 'ed_migration', path)
+    with pytest.raises(ValueError):
+        journal.record('us-wa', 'bina', path)
+    # interrupted while writing
+    with open(path, 'a') as f:
+        f.write('{"instance": "us-wa", "st')
+
+    done = journal.completed(path)
+    assert done == {'fr-nw': {'ed_migration', 'binarization'}, 'us-wa': {'ed_migration'}}
+    assert journal.is_done(done, 'fr-nw', 'binarization')
+    assert not journal.is_done(done, 'us-wa', 'binarization')
+    assert not journal.is_done(done, 'fr-se', 'ed_migration')
+
+    journal.start(path)
+    assert journal.completed(path) == {}
+    assert len(open(path).readlines()) == 7
@@ -0,0 +1,376 @@
+# encoding: utf-8
+
+import hashlib
+import os
+import socket
+import subprocess
+import urlparse
+
+import pytest
+
+from fabric.api import env
+
+from fabfile.component import kraken
+from fabfile.instance import add_instance
+from tests.conftest import StubHandler
+
+
+class MonitorHandler(StubHandler):
+    statuses = {}
+
+    def do_GET(self):
+        instance = urlparse.parse_qs(urlparse.urlparse(self.path).query)['instance'][0]
+        self.reply(200, self.statuses[instance])
+
+
+@pytest.fixture
+def monitor(http_server, monkeypatch):
+    MonitorHandler.statuses.clear()
+    monkeypatch.setattr(env, 'kraken_monitor_port', http_server(MonitorHandler))
+    yield MonitorHandler.statuses
+    kraken._monitor_sessions.clear()
+
+
+def test_probe_krakens(monitor):
+    monitor.update({
+        'fr-nw': {'status': 'running', 'loaded': True, 'is_connected_to_rabbitmq': True},
+        'fr-idf': {'status': 'running', 'loaded': False, 'is_connected_to_rabbitmq': True},
+    })
+    results = kraken.probe_krakens([('fr-nw', '127.0.0.1'), ('fr-idf', '127.0.0.1')])
+    assert results == {'fr-nw': {'127.0.0.1': monitor['fr-nw']},
+                       'fr-idf': {'127.0.0.1': monitor['fr-idf']}}
+    assert kraken._kraken_has_data(results['fr-nw']['127.0.0.1'])
+    assert kraken._kraken_is_dead(results['fr-idf']['127.0.0.1'])
+
+
+def test_probe_krakens_unreachable(monitor):
+    monitor['fr-nw'] = {'status': 'running', 'loaded': True, 'is_connected_to_rabbitmq': True}
+    # nothing listens on this port
+    results = kraken.probe_krakens([('fr-nw', '127.0.0.1'), ('fr-nw', '127.0.0.2')], timeout=0.5)
+    assert results['fr-nw']['127.0.0.1']['loaded'] is True
+    assert results['fr-nw']['127.0.0.2'] is None
+    assert kraken._kraken_is_dead(results['fr-nw']['127.0.0.2'])
+
+
+def test_loaded_instances(monkeypatch):
+    results = {'fr-nw': {'eng1': {'loaded': True}, 'eng2': {'loaded': True}},
+               'fr-idf': {'eng1': {'loaded': True}, 'eng2': None},
+               'us-wa': {'eng1': {'loaded': False}}}
+    monkeypatch.setattr(kraken, 'kraken_pairs', lambda names: names)
+    monkeypatch.setattr(kraken, 'probe_krakens', lambda pairs: dict((n, results[n]) for n in pairs))
+    assert kraken.loaded_instances(['fr-nw', 'fr-idf', 'us-wa']) == ['fr-nw']
+    assert kraken.loaded_instances([]) == []
+
+
+def test_restart_scheduler_serial():
+    pairs = [('fr-nw', 'eng1'), ('fr-nw', 'eng2'), ('fr-idf', 'eng1'), ('fr-idf', 'eng2'), ('us-wa', 'eng3')]
+    scheduler = kraken.KrakenRestartScheduler(pairs, max_per_engine=2, max_total=8, serial=True)
+    # one kraken per instance, different instances at the same time
+    assert scheduler.next_batch() == [('fr-nw', 'eng1'), ('fr-idf', 'eng1'), ('us-wa', 'eng3')]
+    assert scheduler.next_batch() == []
+    scheduler.finish(('fr-nw', 'eng1'))
+    assert scheduler.next_batch() == [('fr-nw', 'eng2')]
+    assert scheduler.instances_left() == ['fr-idf', 'fr-nw', 'us-wa']
+
+
+def test_restart_scheduler_caps():
+    pairs = [(name, host) for name in ('a', 'b', 'c', 'd') for host in ('eng1', 'eng2', 'eng3')]
+    scheduler = kraken.KrakenRestartScheduler(pairs, max_per_engine=1, max_total=2, serial=False)
+    batch = scheduler.next_batch()
+    assert batch == [('a', 'eng1'), ('a', 'eng2')]
+    assert scheduler.next_batch() == []
+    scheduler.finish(('a', 'eng1'))
+    # 'a' keeps a kraken on eng1, and 'b' cannot use the busy eng2
+    assert scheduler.next_batch() == [('a', 'eng3')]
+    while scheduler:
+        for pair in list(scheduler.running):
+            scheduler.finish(pair)
+        scheduler.next_batch()
+    assert sorted(scheduler.done) == sorted(pairs)
+
+
+def test_restart_scheduler_memory(monkeypatch):
+    monkeypatch.setitem(env, 'kraken_lz4_memory_ratio', 4)
+    mb = 1024 * 1024
+    pairs = [('small', 'eng1'), ('big', 'eng1'), ('medium', 'eng1'), ('big', 'eng2')]
+    memory = kraken.KrakenMemoryPlan(pairs, budget=1550,
+                                     rss={'eng1': {'small': 100 * mb, 'big': 800 * mb, 'medium': 400 * mb},
+                                          'eng2': {'big': 800 * mb}},
+                                     sizes={'small': 25 * mb, 'big': 200 * mb, 'medium': 100 * mb})
+    assert memory.peak(('big', 'eng1')) == 1000 * mb
+    scheduler = kraken.KrakenRestartScheduler(pairs, max_per_engine=3, max_total=8, serial=True, memory=memory)
+    # biggest first, and 'medium' would push eng1 above 1550 MB while 'big' restarts
+    assert scheduler.next_batch() == [('big', 'eng1'), ('small', 'eng1')]
+    scheduler.finish(('big', 'eng1'))
+    assert scheduler.next_batch() == [('big', 'eng2'), ('medium', 'eng1')]
+
+
+def test_data_nav_swaps(tmpdir, monkeypatch):
+    monkeypatch.setitem(env, 'tyr_base_destination_dir', str(tmpdir))
+    monkeypatch.setitem(env, 'use_zmq_socket_file', True)
+    monkeypatch.setitem(env, 'roledefs', {'eng': ('root@aaa',)})
+    instances = [add_instance(name, 'passwd') for name in ('new', 'old', 'first', 'none')]
+    for name, plain, temp in (('new', 'plain', 'temp'), ('old', 'plain', 'temp'), ('first', None, 'temp')):
+        if plain:
+            tmpdir.join(name, 'data.nav.lz4').write(plain, ensure=True)
+        tmpdir.join(name, 'temp', 'data.nav.lz4').write(temp, ensure=True)
+    states = {}
+    for instance in instances:
+        for mtime, path in enumerate(kraken._data_nav_paths(instance)):
+            if tmpdir.join(path.replace(str(tmpdir), '')).check():
+                # the temp file of 'old' is older than its plain file
+                states[path] = (-mtime if instance.name == 'old' else mtime, 10)
+    plan = kraken.plan_data_nav_swaps(instances, states)
+    assert [(name, action) for name, action, _, _ in plan] == [('new', 'swap'), ('first', 'move')]
+    assert [name for name, _, _, _ in kraken.plan_data_nav_swaps(instances, states, force=True)] == \
+        ['new', 'old', 'first']
+
+    subprocess.check_call(['bash', '-c', kraken._data_nav_swap_script(plan)])
+    assert tmpdir.join('new', 'data.nav.lz4').read() == 'temp'
+    assert tmpdir.join('new', 'temp', 'data.nav.lz4').read() == 'plain'
+    assert not tmpdir.join('new', 'temp', 'data.nav.lz4.swap').check()
+    assert tmpdir.join('old', 'data.nav.lz4').read() == 'plain'
+    assert tmpdir.join('first', 'data.nav.lz4').read() == 'temp'
+    assert not tmpdir.join('first', 'temp', 'data.nav.lz4').check()
+
+
+def test_kraken_readiness():
+    mb = 1024 * 1024
+    loads = {'fr-nw': [{'elapsed': e, 'loaded': l} for e, l in ((40, True), (90, False), (60, True), (50, True))],
+             'tiny': [{'elapsed': 2, 'loaded': True}]}
+    readiness = kraken.KrakenReadiness(['fr-nw', 'tiny', 'fr-idf', 'new'], sizes={'fr-idf': 4000 * mb}, loads=loads)
+    # from the history, failed loads are ignored
+    assert readiness.deadline('fr-nw') == 100
+    assert readiness.deadline('tiny') == env.KRAKEN_READY_MIN_DELAY
+    # from the data size
+    assert readiness.deadline('fr-idf') == 4000 / env.kraken_load_rate * env.kraken_ready_margin
+    assert readiness.deadline('new') == env.KRAKEN_RESTART_DELAY
+    # small instances are polled tightly, bigger ones less and less often
+    assert readiness.poll_period('tiny', 1) == readiness.poll_period('tiny', 10) == env.kraken_poll_min
+    periods = [readiness.poll_period('fr-nw', attempt) for attempt in range(10)]
+    assert periods == sorted(periods)
+    assert periods[0] == env.kraken_poll_min and periods[-1] == env.kraken_poll_max
+    # standby krakens are probed under their own name
+    readiness.alias({'fr-nw_standby': 'fr-nw', 'new_standby2': 'new'})
+    assert readiness.deadline('fr-nw_standby') == readiness.deadline('fr-nw') == 100
+    assert readiness.deadline('new_standby2') == env.KRAKEN_RESTART_DELAY
+    assert readiness.poll_period('new_standby2', 10) == readiness.poll_period('new', 10)
+
+
+def test_prewarm_script(tmpdir):
+    paths = [str(tmpdir.join(name)) for name in ('fr-nw.lz4', 'with space.lz4')]
+    for path in paths:
+        with open(path, 'w') as f:
+            f.write('x' * 1024)
+    logs = [path + '.log' for path in paths]
+    subprocess.check_call(['sh', '-c', kraken._prewarm_script(zip(paths, logs))])
+    # each file has its own log
+    for path, log in zip(paths, logs):
+        logged, elapsed = open(log).read().strip().rsplit(' ', 1)
+        assert logged == path and elapsed.isdigit()
+
+
+def test_staging_script(tmpdir):
+    source = tmpdir.join('nfs', 'fr-nw', 'data.nav.lz4')
+    source.write('new data', ensure=True)
+    md5 = hashlib.md5('new data').hexdigest()
+    tmpdir.join('kraken', 'fr-idf', 'data.nav.lz4').write('new data', ensure=True)
+    copies = [('fr-nw', str(source), str(tmpdir.join('kraken', 'fr-nw', 'data.nav.lz4')), md5),
+              ('fr-idf', str(source), str(tmpdir.join('kraken', 'fr-idf', 'data.nav.lz4')), md5),
+              ('us-wa', str(source), str(tmpdir.join('kraken', 'us-wa', 'data.nav.lz4')), 'corrupted')]
+    # rsync of the engines, without the bandwidth limit
+    script = 'rsync() { cp "$2" "$3"; }; ' + kraken._staging_script(copies)
+    output = subprocess.check_output(['bash', '-c', script])
+    assert output.splitlines() == ['STAGED fr-nw ok', 'STAGED fr-idf uptodate', 'STAGED us-wa failed']
+    assert tmpdir.join('kraken', 'fr-nw', 'data.nav.lz4').read() == 'new data'
+    assert not tmpdir.join('kraken', 'us-wa', 'data.nav.lz4').check()
+    assert not tmpdir.join('kraken', 'us-wa', 'data.nav.lz4.staging').check()
+
+
+class ReloadAdmin(object):
+    """ rabbitmq.RabbitMQAdmin delivering the reload tasks of some instances, reloaded by some krakens """
+    def __init__(self, monitor, delivered, reloaded):
+        self.monitor = monitor
+        self.delivered = delivered
+        self.reloaded = reloaded
+
+    def publish_all(self, exchange, messages):
+        for key in messages:
+            if key.split('.')[0] in self.reloaded:
+                self.monitor[key.split('.')[0]]['publication_date'] = '20261018T120000'
+        return dict((key, key.split('.')[0] in self.delivered) for key in messages)
+
+
+def test_reload_krakens(monitor, monkeypatch):
+    monkeypatch.setitem(env, 'kraken_history_file', None)
+    monkeypatch.setitem(env, 'KRAKEN_RESTART_DELAY', 1)
+    monkeypatch.setitem(env, 'kraken_poll_min', 0.1)
+    monkeypatch.setitem(env, 'kraken_rt_backlog_threshold', None)
+    for name in ('fr-nw', 'fr-idf', 'us-wa'):
+        monitor[name] = {'status': 'running', 'loaded': True, 'publication_date': '20261017T120000'}
+    restarted = []
+    monkeypatch.setattr(kraken, '_run_kraken_restarts', lambda scheduler: restarted.extend(scheduler.pending) or [])
+    pairs = [('fr-nw', '127.0.0.1'), ('fr-idf', '127.0.0.1'), ('us-wa', '127.0.0.1')]
+    assert kraken.reload_krakens(pairs, ReloadAdmin(monitor, ['fr-nw', 'fr-idf'], ['fr-nw'])) == []
+    # fr-idf did not reload its data and no kraken received the task of us-wa
+    assert restarted == [('fr-idf', '127.0.0.1'), ('us-wa', '127.0.0.1')]
+
+
+def test_parse_krakens_processes(monkeypatch):
+    monkeypatch.setitem(env, 'kraken_basedir', '/srv/kraken')
+    output = """
+    1 4052 0 86400 1 /sbin/init
+ 1234 2097152 3600 7200 12 /srv/kraken/fr-nw/kraken
+ 1240 1048576 60 600 8 /srv/kraken/fr-idf_standby/kraken
+ 1250 1048576 60 600 8 /srv/kraken/us-wa_standby2/kraken
+ 1300 1024 0 10 1 grep /srv/kraken/fr-nw/kraken
+"""
+    processes = kraken.parse_krakens_processes(output, now=100000)
+    assert processes == [
+        dict(pid=1234, instance='fr-nw', standby=False, rss=2 * 1024 ** 3, cpu=3600, uptime=7200, threads=12,
+             start=92800),
+        dict(pid=1240, instance='fr-idf', standby=True, rss=1024 ** 3, cpu=60, uptime=600, threads=8, start=99400),
+        dict(pid=1250, instance='us-wa', standby=True, rss=1024 ** 3, cpu=60, uptime=600, threads=8, start=99400),
+    ]
+
+
+def test_plan_blue_green(monkeypatch):
+    monkeypatch.setitem(env, 'kraken_blue_green_margin', 1.5)
+    monkeypatch.setitem(env, 'kraken_lz4_memory_ratio', 4)
+    pairs = [('fr-nw', 'eng1'), ('fr-idf', 'eng1'), ('us-wa', 'eng1'), ('fr-nw', 'eng2')]
+    rss = {'eng1': {'fr-nw': 500, 'fr-idf': 1000}, 'eng2': {}}
+    sizes = {'fr-nw': 100, 'us-wa': 50}
+    # us-wa is expected to use 200 and fr-nw 500, the biggest kraken does not fit
+    blue_green, others = kraken.plan_blue_green(pairs, {'eng1': 1200, 'eng2': 1000}, rss, sizes)
+    assert blue_green == [('us-wa', 'eng1'), ('fr-nw', 'eng2'), ('fr-nw', 'eng1')]
+    assert others == [('fr-idf', 'eng1')]
+
+
+def test_standby_switch_script(tmpdir, monkeypatch):
+    monkeypatch.setitem(env, 'kraken_basedir', str(tmpdir))
+    main, standby = tmpdir.mkdir('fr-nw'), tmpdir.mkdir('fr-nw_standby2')
+    # the old kraken is a daemon, not a child of the test
+    old = int(subprocess.check_output(['sh', '-c', 'sleep 60 > /dev/null 2>&1 & echo $!']))
+    new = subprocess.Popen(['sleep', '60'])
+    main.join('kraken.pid').write(str(old))
+    standby.join('kraken.pid').write(str(new.pid))
+    sockets = []
+    for directory in (main, standby):
+        sockets.append(socket.socket(socket.AF_UNIX))
+        sockets[-1].bind(str(directory.join('kraken.sock')))
+    try:
+        output = subprocess.check_output(['bash', '-c', kraken._switch_standby_script('fr-nw', 'fr-nw_standby2')])
+        assert output.splitlines() == ['SWITCHED fr-nw fr-nw_standby2']
+        assert subprocess.call(['kill', '-0', str(old)], stderr=open(os.devnull, 'w')) != 0
+        assert new.poll() is None
+        assert main.join('kraken.pid').read() == str(new.pid)
+        # the socket of the instance is the one of the standby kraken
+        assert os.stat(str(main.join('kraken.sock'))).st_ino == os.stat(str(standby.join('kraken.sock'))).st_ino
+    finally:
+        new.kill()
+        for s in sockets:
+            s.close()
+
+
+def test_plan_kraken_placement():
+    engines = ['eng1', 'eng2', 'eng3']
+    mapping = {'fr-nw': ['eng1', 'eng2'], 'fr-idf': ['eng1', 'eng2'], 'us-wa': ['eng1'], 'tiny': ['eng3']}
+    memory = {'fr-nw': 400, 'fr-idf': 800, 'us-wa': 300, 'tiny': 10}
+    cpu = {'fr-nw': 1, 'fr-idf': 3, 'us-wa': 1, 'tiny': 1}
+    new_mapping, moves = kraken.plan_kraken_placement(mapping, memory, cpu, engines, tolerance=0.01)
+    # replication is kept and an instance never runs twice on an engine
+    assert all(len(new_mapping[name]) == len(set(new_mapping[name])) == len(hosts)
+               for name, hosts in mapping.iteritems())
+    before = kraken.get_engines_load(mapping, memory, cpu, engines)
+    after = kraken.get_engines_load(new_mapping, memory, cpu, engines)
+    assert max(max(l) for l in after.values()) < max(max(l) for l in before.values())
+    assert len(moves) == sum(len(set(mapping[n]) - set(new_mapping[n])) for n in mapping)
+    assert all(target == 'eng3' for _, _, target in moves)
+
+    # nothing to do on a balanced platform, and max_moves is honored
+    assert kraken.plan_kraken_placement(new_mapping, memory, cpu, engines, tolerance=0.01)[1] == []
+    assert len(kraken.plan_kraken_placement(mapping, memory, cpu, engines, max_moves=1)[1]) == 1
+
+
+def test_plan_kraken_sizing(monkeypatch):
+    monkeypatch.setitem(env, 'kraken_cpu_ratio', 1.0)
+    monkeypatch.setitem(env, 'kraken_memory_ratio', 0.8)
+    monkeypatch.setitem(env, 'kraken_raptor_entry_ratio', 0.5)
+    monkeypatch.setitem(env, 'kraken_raptor_cache_max', 20)
+    gb = 1024 ** 3
+    mapping = {'fr-idf': ['eng1', 'eng2'], 'fr-nw': ['eng1'], 'us-wa': ['eng2']}
+    hardware = {'eng1': (8, 20 * gb), 'eng2': (16, 40 * gb)}
+    memory = {'fr-idf': 4 * gb, 'fr-nw': 2 * gb, 'us-wa': 2 * gb}
+    sizes = {'fr-idf': gb, 'fr-nw': gb / 2}
+    sizing = kraken.plan_kraken_sizing(mapping, hardware, memory, sizes, {'fr-idf': 3, 'fr-nw': 1, 'us-wa': 1})
+    # fr-idf gets the values of eng1, the smallest engine
+    assert sizing['fr-idf'] == (6, 15)
+    assert sizing['fr-nw'] == (2, 10)
+    # no data size, no cache size
+    assert sizing['us-wa'] == (4, None)
+    for engine, (cores, _) in hardware.items():
+        assert sum(sizing[name][0] for name, hosts in mapping.items() if engine in hosts) <= cores
+
+
+def test_restart_scheduler_cancel():
+    pairs = [('fr-nw', 'eng1'), ('fr-nw', 'eng2'), ('fr-nw', 'eng3'), ('us-wa', 'eng1')]
+    scheduler = kraken.KrakenRestartScheduler(pairs, max_per_engine=2, max_total=8, serial=True)
+    assert scheduler.next_batch() == [('fr-nw', 'eng1'), ('us-wa', 'eng1')]
+    scheduler.finish(('fr-nw', 'eng1'))
+    # the canary of fr-nw failed
+    assert scheduler.cancel('fr-nw') == [('fr-nw', 'eng2'), ('fr-nw', 'eng3')]
+    assert scheduler.next_batch() == []
+    assert scheduler.instances_left() == ['us-wa']
+
+
+class QueuesAdmin(object):
+    """ rabbitmq.RabbitMQAdmin serving fixed queues """
+    def __init__(self, queues):
+        self.queues = queues
+
+    def list_queues(self, prefix=None, columns=None):
+        return [dict(name=name, messages=messages, message_stats={'ack_details': {'rate': 10.0}})
+                for name, messages in self.queues.items()]
+
+
+def test_restart_scheduler_backlog(monkeypatch):
+    monkeypatch.setitem(env, 'use_zmq_socket_file', True)
+    monkeypatch.setitem(env, 'roledefs', {'eng': ('root@eng1', 'root@eng2')})
+    monkeypatch.setitem(env, 'kraken_rt_backlog_threshold', 1000)
+    monkeypatch.setitem(env, 'kraken_rt_backlog_max_wait', 60)
+    monkeypatch.setitem(env, 'kraken_rt_backlog_poll', 0)
+    add_instance('fr-rt', 'passwd', enable_realtime=True, rt_topics=['realtime.fr'])
+    add_instance('fr-nw', 'passwd')
+    admin = QueuesAdmin({'kraken_eng1_fr-rt_rt': 5000, 'kraken_eng2_fr-rt_rt': 10, 'kraken_eng1_fr-nw_rt': 5000})
+    pairs = [('fr-rt', 'eng1'), ('fr-rt', 'eng2'), ('fr-nw', 'eng1')]
+    gate = kraken.KrakenBacklogGate(pairs, admin)
+    assert gate.depths == {('fr-rt', 'eng1'): {'messages': 5000, 'rate': 10.0},
+                           ('fr-rt', 'eng2'): {'messages': 10, 'rate': 10.0}}
+    scheduler = kraken.KrakenRestartScheduler(pairs, max_per_engine=2, max_total=8, serial=False, backlog=gate)
+    assert scheduler.pending[-1] == ('fr-rt', 'eng1')
+    assert scheduler.next_batch() == [('fr-rt', 'eng2'), ('fr-nw', 'eng1')]
+    for pair in list(scheduler.running):
+        scheduler.finish(pair)
+    assert scheduler.next_batch() == []
+    # the queue drains
+    admin.queues['kraken_eng1_fr-rt_rt'] = 200
+    assert scheduler.next_batch() == [('fr-rt', 'eng1')]
+
+
+def test_canary_gate_rollback(monkeypatch):
+    for key, value in (('kraken_canary', True), ('kraken_blue_green', True), ('kraken_canary_rollback', True),
+                       ('KRAKEN_RESTART_SCHEME', 'serial'), ('roledefs', {'eng': ('root@eng1',)})):
+        monkeypatch.setitem(env, key, value)
+    add_instance('fr-nw', 'passwd')
+    calls = []
+    monkeypatch.setattr(kraken, 'swap_data_nav', lambda instance, force=False: calls.append(('swap', force)))
+    monkeypatch.setattr(kraken, 'set_kraken_binary', lambda instance, old=False: calls.append(('binary', old)))
+    monkeypatch.setattr(kraken, 'kraken_pairs', lambda instances, hosts: [('fr-nw', 'eng1')])
+    monkeypatch.setattr(kraken, 'restart_krakens_blue_green', lambda pairs: calls.append(('blue_green',)) or pairs)
+    monkeypatch.setattr(kraken, '_run_kraken_restarts',
+                        lambda scheduler, prewarm, canary: calls.append(('restart', canary)) or [])
+    gate = kraken.KrakenCanaryGate(None, None)
+    gate.degraded = ['fr-nw']
+    gate.rollback()
+    # the rollback is restarted without canary, that would roll it back again, nor blue/green
+    assert calls == [('swap', True), ('binary', True), ('restart', None)]
@@ -0,0 +1,61 @@
+# encoding: utf-8
+
+import os
+import time
+
+from fabric.api import env
+
+from fabfile import journal
+from fabfile.lanes import UpgradeLanes, record_step, restart_turn
+
+
+def lane(instance_name, delay=0):
+    if instance_name == 'us-wa':
+        raise SystemExit('aborted')
+    time.sleep(delay)
+    record_step(instance_name, 'swap')
+    if instance_name == 'fr-ne':
+        return {'swap': 1, 'restart': 2, 'failed': 'restart'}
+    record_step(instance_name, 'restart')
+    record_step(instance_name, 'test')
+    return {'swap': 1, 'restart': 20, 'test': 3}
+
+
+def test_upgrade_lanes(tmpdir, monkeypatch):
+    monkeypatch.setitem(env, 'upgrade_journal_file', str(tmpdir.join('journal.jsonl')))
+    journal.start()
+    with UpgradeLanes(lane, 2, {'fr-nw': (0.2,)}) as lanes:
+        for name in ('fr-nw', 'fr-ne', 'us-wa', 'fr-se'):
+            lanes.submit(name)
+    assert lanes.succeeded == ['fr-nw', 'fr-se']
+    assert lanes.results['us-wa']['failed'] == 'lane'
+    assert lanes.results['us-wa']['error'] == 'aborted'
+    assert lanes.results['fr-ne']['failed'] == 'restart'
+    assert lanes.results['fr-nw']['ready'] >= 0.2
+    # the lane processes record their steps through the main process
+    assert journal.completed() == {'fr-nw': {'swap', 'restart', 'test'}, 'fr-se': {'swap', 'restart', 'test'},
+                                   'fr-ne': {'swap'}}
+
+    report = lanes.report(('swap', 'restart', 'test')).splitlines()
+    assert report[0].split() == ['instance', 'swap', 'restart', 'test', 'lane', 'ready', 'failed']
+    # in order of completion, fr-nw is the slowest
+    assert report[-1].split() == ['fr-nw', '1', '20', '3', '0', '0', '-']
+    assert report[1].split()[:4] + report[1].split()[-1:] in (
+        ['fr-ne', '1', '2', '-', 'restart'], ['us-wa', '-', '-', '-', 'lane'], ['fr-se', '1', '20', '3', '-'])
+
+
+def restarting_lane(instance_name, directory):
+    with restart_turn():
+        # fails if another lane is restarting
+        os.mkdir(os.path.join(directory, 'restarting'))
+        time.sleep(0.1)
+        os.rmdir(os.path.join(directory, 'restarting'))
+    return {'restart': 0.1}
+
+
+def test_upgrade_lanes_restart_turn(tmpdir):
+    names = ('fr-nw', 'fr-ne', 'fr-se')
+    with UpgradeLanes(restarting_lane, 3, dict((name, (str(tmpdir),)) for name in names)) as lanes:
+        for name in names:
+            lanes.submit(name)
+    assert lanes.succeeded == sorted(names)
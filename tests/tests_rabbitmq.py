@@ -0,0 +1,167 @@
+# encoding: utf-8
+
+import base64
+import json
+import re
+import urllib
+import urlparse
+
+import pytest
+
+from fabric.api import env
+
+from fabfile.component import kraken, rabbitmq
+from fabfile.instance import add_instance
+from tests.conftest import StubHandler
+
+
+class ManagementHandler(StubHandler):
+    """ stand-in for the RabbitMQ management API, queues and policies of a single vhost """
+    vhost = '/'
+    queues = {}
+    policies = {}
+    published = []
+    requests = []
+
+    def _path(self):
+        if self.headers.get('Authorization') != 'Basic ' + base64.b64encode('guest:secret'):
+            self.reply(401)
+            return None
+        url = urlparse.urlparse(self.path)
+        self.requests.append((self.command, url.path))
+        path = [urllib.unquote(p) for p in url.path.split('/')[2:]]
+        if len(path) < 2 or path[1] != self.vhost:
+            self.reply(404)
+            return None
+        return path, urlparse.parse_qs(url.query)
+
+    def do_GET(self):
+        path = self._path()
+        if path and path[0] == ['queues', self.vhost]:
+            columns = path[1]['columns'][0].split(',')
+            self.reply(200, [dict((c, q.get(c)) for c in columns) for q in self.queues.itervalues()])
+        elif path and path[0] == ['policies', self.vhost]:
+            self.reply(200, self.policies.values())
+        elif path:
+            self.reply(404)
+
+    def do_PUT(self):
+        path = self._path()
+        if path:
+            policy = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            policy.update(name=path[0][2], vhost=self.vhost)
+            self.policies[path[0][2]] = policy
+            self.reply(204)
+
+    def do_POST(self):
+        path = self._path()
+        if path and path[0][0] == 'exchanges' and path[0][3] == 'publish':
+            message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            self.published.append((path[0][2], message['routing_key'], base64.b64decode(message['payload'])))
+            # the task queues of the krakens of an instance are bound to '<instance>.task.*'
+            instance = message['routing_key'].split('.')[0]
+            self.reply(200, {'routed': any(q.endswith('_{}_task'.format(instance)) for q in self.queues)})
+        elif path:
+            self.reply(404)
+
+    def do_DELETE(self):
+        path = self._path()
+        if path:
+            collection = self.queues if path[0][0] == 'queues' else self.policies
+            self.reply(204 if collection.pop(path[0][2], None) else 404)
+
+
+@pytest.fixture
+def management(http_server, monkeypatch):
+    monkeypatch.setattr(ManagementHandler, 'vhost', '/')
+    ManagementHandler.queues.clear()
+    ManagementHandler.policies.clear()
+    del ManagementHandler.published[:]
+    del ManagementHandler.requests[:]
+    return rabbitmq.RabbitMQAdmin('127.0.0.1', http_server(ManagementHandler), 'guest', 'secret', pool_size=4,
+                                  timeout=2)
+
+
+def test_kraken_queue_names():
+    assert rabbitmq.kraken_queue_names('fr-nw', 'root@eng1.canaltp.fr') == \
+        ['kraken_eng1_fr-nw_rt', 'kraken_eng1_fr-nw_task']
+
+
+def test_list_and_delete_queues(management):
+    for name in ('kraken_eng1_fr-nw_rt', 'kraken_eng1_fr-nw_task', 'kraken_eng2_fr-nw_rt', 'tyr_queue'):
+        ManagementHandler.queues[name] = {'name': name, 'messages': 3, 'consumers': 1, 'memory': 100}
+    queues = management.list_queues(prefix='kraken_')
+    assert sorted(q['name'] for q in queues) == ['kraken_eng1_fr-nw_rt', 'kraken_eng1_fr-nw_task',
+                                                 'kraken_eng2_fr-nw_rt']
+    assert queues[0] == {'name': queues[0]['name'], 'messages': 3, 'consumers': 1}
+    assert ManagementHandler.requests == [('GET', '/api/queues/%2F')]
+
+    results = management.delete_queues(['kraken_eng1_fr-nw_rt', 'kraken_eng1_fr-nw_task', 'kraken_eng3_fr-nw_rt'])
+    assert results == {'kraken_eng1_fr-nw_rt': True, 'kraken_eng1_fr-nw_task': True, 'kraken_eng3_fr-nw_rt': False}
+    assert sorted(ManagementHandler.queues) == ['kraken_eng2_fr-nw_rt', 'tyr_queue']
+
+
+def test_api_errors(management):
+    management.session.auth = ('guest', 'wrong')
+    with pytest.raises(RuntimeError):
+        management.list_queues()
+    assert isinstance(management.delete_queues(['kraken_eng1_fr-nw_rt'])['kraken_eng1_fr-nw_rt'], RuntimeError)
+
+
+def test_publish(management):
+    ManagementHandler.queues['kraken_eng1_fr-nw_task'] = {'name': 'kraken_eng1_fr-nw_task'}
+    results = management.publish_all('navitia', {'fr-nw.task.reload': '\x08\x01', 'us-wa.task.reload': '\x08\x01'})
+    assert results == {'fr-nw.task.reload': True, 'us-wa.task.reload': False}
+    assert sorted(ManagementHandler.published) == [('navitia', 'fr-nw.task.reload', '\x08\x01'),
+                                                   ('navitia', 'us-wa.task.reload', '\x08\x01')]
+
+
+def test_kraken_queue_pattern():
+    pattern = re.compile(rabbitmq.kraken_queue_pattern('fr-nw'))
+    assert pattern.match('kraken_eng1_fr-nw_rt') and pattern.match('kraken_eng1_fr-nw_task')
+    assert not pattern.match('kraken_eng1_fr-nw2_rt') and not pattern.match('kraken_eng1_fr-nw_rt2')
+    assert re.match(rabbitmq.kraken_queue_pattern(), 'kraken_eng1_us-wa_rt')
+
+
+def test_update_kraken_queue_policies(management, monkeypatch, capsys):
+    monkeypatch.setattr(rabbitmq, 'RabbitMQAdmin', lambda vhost: management)
+    monkeypatch.setitem(env, 'instances', {})
+    monkeypatch.setitem(env, 'kraken_queue_policy', {'max-length': 1000, 'queue-mode': 'lazy'})
+    add_instance('fr-nw', 'passwd')
+    add_instance('us-wa', 'passwd', kraken_queue_policy={'max-length': 10, 'queue-mode': None})
+    ManagementHandler.policies['kraken_queues_old'] = {'name': 'kraken_queues_old', 'pattern': 'x',
+                                                       'definition': {}, 'priority': 1}
+    ManagementHandler.policies['ha'] = {'name': 'ha', 'pattern': '.*', 'definition': {}, 'priority': 0}
+    ManagementHandler.queues['kraken_eng1_fr-nw_rt'] = {'name': 'kraken_eng1_fr-nw_rt', 'policy': None}
+
+    kraken.update_kraken_queue_policies(check=True)
+    out = capsys.readouterr()[0]
+    assert 'policy kraken_queues to update' in out and 'policy kraken_queues_old to delete' in out
+    assert 'without policy: kraken_eng1_fr-nw_rt' in out
+    assert sorted(ManagementHandler.policies) == ['ha', 'kraken_queues_old']
+
+    kraken.update_kraken_queue_policies()
+    assert sorted(ManagementHandler.policies) == ['ha', 'kraken_queues', 'kraken_queues_us-wa']
+    assert ManagementHandler.policies['kraken_queues']['definition'] == {'max-length': 1000, 'queue-mode': 'lazy'}
+    assert ManagementHandler.policies['kraken_queues_us-wa']['definition'] == {'max-length': 10}
+    assert ManagementHandler.policies['kraken_queues_us-wa']['priority'] == 1
+    capsys.readouterr()
+    kraken.update_kraken_queue_policies(check=True)
+    assert 'up to date' in capsys.readouterr()[0]
+
+
+def test_kraken_queues_on_broker_vhost(management, monkeypatch):
+    monkeypatch.setattr(ManagementHandler, 'vhost', 'navitia')
+    host, port = urlparse.urlparse(management.base_url).netloc.split(':')
+    for key, value in (('rabbitmq_host_api', host), ('rabbitmq_port_api', int(port)), ('rabbitmq_user', 'guest'),
+                       ('rabbitmq_pass', 'secret'), ('kraken_broker_vhost', 'navitia'),
+                       ('kraken_queue_policy', {'max-length': 1000}), ('roledefs', {'eng': ('root@eng1',)})):
+        monkeypatch.setitem(env, key, value)
+    add_instance('fr-nw', 'passwd')
+    ManagementHandler.queues['kraken_eng1_fr-nw_rt'] = {'name': 'kraken_eng1_fr-nw_rt', 'policy': None}
+
+    kraken.update_kraken_queue_policies()
+    assert ManagementHandler.policies['kraken_queues']['vhost'] == 'navitia'
+    assert kraken.delete_kraken_queues([env.instances['fr-nw']], apply_on='all') == ['kraken_eng1_fr-nw_rt']
+    assert ManagementHandler.queues == {}
+    assert ('DELETE', '/api/queues/navitia/kraken_eng1_fr-nw_rt') in ManagementHandler.requests
@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+import subprocess
+
+from fabfile.utils import _service_control_script, _upload_template_script
+
+# fake 'service' command: a service is running when its flag file exists,
+# the 'broken' service never starts, and the start and stop commands are logged in .actions
+SERVICE_STUB = ('service() {{ [ $1 = broken ] && return 3; f={0}/$1; case $2 in '
+                'start) echo "start $1" >> {0}/.actions; touch $f ;; stop) echo "stop $1" >> {0}/.actions; rm -f $f ;; '
+                'status) [ -e $f ] ;; esac; }}; ')
+
+
+def run_script(tmpdir, *scripts):
+    output = subprocess.check_output(['bash', '-c', SERVICE_STUB.format(tmpdir) + '; '.join(scripts)])
+    return [line.split()[:3] for line in output.splitlines()]
+
+
+def test_service_control_restart(tmpdir):
+    tmpdir.join('kraken_fr-nw').write('')
+    lines = run_script(str(tmpdir),
+                       _service_control_script(['kraken_fr-nw', 'kraken_fr-idf'], 'stop', 2000, 100, True),
+                       _service_control_script(['kraken_fr-nw', 'kraken_fr-idf'], 'start', 2000, 100, True))
+    assert lines == [['SERVICE', 'kraken_fr-nw', 'stopped'], ['SERVICE', 'kraken_fr-idf', 'stopped'],
+                     ['SERVICE', 'kraken_fr-nw', 'running'], ['SERVICE', 'kraken_fr-idf', 'running']]
+    assert tmpdir.join('kraken_fr-idf').check()
+
+
+def test_service_control_timeout(tmpdir):
+    lines = run_script(str(tmpdir), _service_control_script(['broken', 'tyr_worker'], 'start', 300, 100, False))
+    assert lines == [['SERVICE', 'tyr_worker', 'running'], ['SERVICE', 'broken', 'timeout']]
+
+
+def test_service_control_already_in_state(tmpdir):
+    tmpdir.join('kraken_fr-nw').write('')
+    lines = run_script(str(tmpdir), _service_control_script(['kraken_fr-nw', 'kraken_fr-idf'], 'start', 2000, 100, False),
+                       _service_control_script(['kraken_fr-idf', 'tyr_beat'], 'stop', 2000, 100, True))
+    assert lines == [['SERVICE', 'kraken_fr-nw', 'running'], ['SERVICE', 'kraken_fr-idf', 'running'],
+                     ['SERVICE', 'kraken_fr-idf', 'stopped'], ['SERVICE', 'tyr_beat', 'stopped']]
+    # the running kraken is not started again, the stopped tyr_beat not stopped
+    assert tmpdir.join('.actions').read().splitlines() == ['start kraken_fr-idf', 'stop kraken_fr-idf']
+
+
+def test_upload_template_script(tmpdir):
+    destination, temp = tmpdir.join('kraken.ini'), tmpdir.join('kraken.ini.temp')
+
+    def upload(content):
+        temp.write(content)
+        return subprocess.check_output(['sh', '-c', _upload_template_script(
+            str(destination), str(temp), show_diff='diff', backup=True)]).splitlines()
+
+    assert upload('nb_threads = 4\n') == ['CHANGED']
+    assert upload('nb_threads = 4\n') == ['UNCHANGED']
+    assert not temp.check()
+    lines = upload('nb_threads = 8\n')
+    assert lines[-1] == 'CHANGED' and '> nb_threads = 8' in lines
+    assert destination.read() == 'nb_threads = 8\n'
+    assert tmpdir.join('kraken.ini.bak').read() == 'nb_threads = 4\n'